@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import numpy as np
+
+ADMIN = "admin"
+
+log = logging.getLogger("analytics")
+
+
+def codes(values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Dictionary-encodes strings: returns the distinct values and the code of every value"""
+    if not values:
+        return np.array([], dtype=str), np.array([], dtype=np.int64)
+    return np.unique(np.array(values, dtype=str), return_inverse=True)
+
+
+def valid_rows(rows: list[list], table: str, width: int, numbers: tuple[int, ...]) -> list[list]:
+    """Rows with a game date, at least width cells and numbers in the given columns.
+    Others (headers, cells edited by hand) are skipped"""
+    valid = []
+    for row in rows:
+        try:
+            if len(row) < width:
+                raise ValueError(f"expected at least {width} values")
+            datetime.strptime(str(row[0]), "%Y-%m-%d")
+            for index in numbers:
+                if len(row) > index and row[index] not in ("", None):
+                    int(row[index])
+        except (ValueError, TypeError) as e:
+            log.info(f"valid_rows: skipping malformed {table} row {row}: {e}")
+            continue
+        valid.append(row)
+    return valid
+
+
+def column(rows: list[list], index: int, dtype=np.int64, default=0) -> np.ndarray:
+    # Rows read from Sheets hold strings, rows from the event views None for missing values
+    values = [row[index] if len(row) > index and row[index] not in ("", None) else default for row in rows]
+    return np.array(values, dtype=dtype) if values else np.array([], dtype=dtype)
+
+
+@dataclass
+class History:
+    """Registrations and auctions over all seasons as columns of NumPy arrays.
+    Strings (dates, user names) are stored once and referenced by integer codes,
+    so every report is a handful of vectorized group-bys"""
+
+    dates: np.ndarray               # distinct game dates, sorted
+    users: np.ndarray               # distinct user names, sorted
+    caps: np.ndarray                # cap per date code
+    reg_date: np.ndarray            # date code per registration
+    reg_user: np.ndarray            # user code per registration
+    reg_playing: np.ndarray         # True if the registration made it into the game
+    slot_date: np.ndarray           # date code per auction row
+    slot_buyer: np.ndarray          # user code of the buyer, -1 if none
+    slot_resold: np.ndarray         # True for a slot sold by a player to another one
+    slot_admin_paid: np.ndarray     # True for a payment through the admin link
+
+
+    @classmethod
+    def from_rows(cls, registrations: list[list], auctions: list[list], games: list[list], default_cap: int) -> "History":
+        registrations = valid_rows(registrations, "registrations", 3, (1, 3))
+        auctions = valid_rows(auctions, "auctions", 2, (2, 4))
+        games = valid_rows(games, "games", 1, (1,))
+        reg_dates = [row[0] for row in registrations]
+        slot_dates = [row[0] for row in auctions]
+        game_dates = [row[0] for row in games]
+        dates, date_codes = codes(reg_dates + slot_dates + game_dates)
+        reg_date = date_codes[:len(reg_dates)]
+        slot_date = date_codes[len(reg_dates):len(reg_dates) + len(slot_dates)]
+        game_date = date_codes[len(reg_dates) + len(slot_dates):]
+
+        reg_users = [row[2] for row in registrations]
+        buyers = [row[5] or "" if len(row) > 5 else "" for row in auctions]
+        users, user_codes = codes(reg_users + buyers)
+        reg_user = user_codes[:len(reg_users)]
+        slot_buyer = user_codes[len(reg_users):]
+
+        caps = np.full(len(dates), default_cap, dtype=np.int64)
+        caps[game_date] = column(games, 1, default=default_cap)
+
+        # Who made it into the game: the first cap registrations by (prio, requested_at)
+        prio = column(registrations, 3)
+        requested_at = column(registrations, 1)
+        order = np.lexsort((requested_at, prio, reg_date))
+        sorted_dates = reg_date[order]
+        first = np.searchsorted(sorted_dates, sorted_dates, side="left")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - first
+        reg_playing = rank < caps[reg_date]
+
+        sellers = np.array([row[1] for row in auctions], dtype=str)
+        links = np.array([row[3] or "" if len(row) > 3 else "" for row in auctions], dtype=str)
+        sent = column(auctions, 4)
+        no_buyer = np.isin(np.array(buyers, dtype=str), ["", "empty"])
+        slot_buyer = np.where(no_buyer, -1, slot_buyer)
+        admin = sellers == ADMIN
+        return cls(
+            dates=dates,
+            users=users,
+            caps=caps,
+            reg_date=reg_date,
+            reg_user=reg_user,
+            reg_playing=reg_playing,
+            slot_date=slot_date,
+            slot_buyer=slot_buyer,
+            slot_resold=~admin & (sent == 1) & ~no_buyer,
+            slot_admin_paid=admin & np.char.startswith(links, "pay to"),
+        )
+
+
+    def seasons(self) -> tuple[np.ndarray, np.ndarray]:
+        """Distinct seasons and the season code of every date"""
+        return np.unique(np.array([date[:4] for date in self.dates], dtype=str), return_inverse=True)
+
+
+    def attendance(self) -> np.ndarray:
+        """Games played per user code"""
+        return np.bincount(self.reg_user[self.reg_playing], minlength=len(self.users))
+
+
+    def per_game(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Per date code: registrations, fill rate, waiting list length and resold slots"""
+        registered = np.bincount(self.reg_date, minlength=len(self.dates))
+        # A game with cap 0 has no places to fill
+        fill_rate = np.divide(
+            np.minimum(registered, self.caps), self.caps,
+            out=np.zeros(len(self.dates)), where=self.caps > 0,
+        )
+        waiting = np.maximum(registered - self.caps, 0)
+        resold = np.bincount(self.slot_date[self.slot_resold], minlength=len(self.dates))
+        return registered, fill_rate, waiting, resold
+
+
+    def report(self, season: str|None = None, top: int = 10) -> str:
+        if not len(self.dates):
+            return "No games yet"
+        names, season_of_date = self.seasons()
+        registered, fill_rate, waiting, resold = self.per_game()
+        admin_paid = np.bincount(self.slot_date[self.slot_admin_paid], minlength=len(self.dates))
+        # Only dates somebody registered for were played
+        played = registered > 0
+
+        lines = [f"{'season':<8}{'games':>6}{'fill':>7}{'wait':>6}{'resold':>8}{'admin':>7}"]
+        games = np.bincount(season_of_date, weights=played, minlength=len(names))
+        fill = np.bincount(season_of_date, weights=fill_rate * played, minlength=len(names))
+        wait = np.bincount(season_of_date, weights=waiting, minlength=len(names))
+        resales = np.bincount(season_of_date, weights=resold, minlength=len(names))
+        admins = np.bincount(season_of_date, weights=admin_paid, minlength=len(names))
+        for i, name in enumerate(names):
+            if not games[i]:
+                continue
+            lines.append(
+                f"{name:<8}{int(games[i]):>6}{fill[i] / games[i]:>7.0%}{wait[i] / games[i]:>6.1f}"
+                f"{int(resales[i]):>8}{int(admins[i]):>7}"
+            )
+
+        playing = self.reg_playing
+        paid = self.slot_admin_paid & (self.slot_buyer >= 0)
+        bought = self.slot_resold
+        title = "all seasons"
+        if season:
+            selected = names == season
+            playing = playing & selected[season_of_date[self.reg_date]]
+            paid = paid & selected[season_of_date[self.slot_date]]
+            bought = bought & selected[season_of_date[self.slot_date]]
+            title = season
+        attended = np.bincount(self.reg_user[playing], minlength=len(self.users))
+        payments = np.bincount(self.slot_buyer[paid], minlength=len(self.users))
+        purchases = np.bincount(self.slot_buyer[bought & (self.slot_buyer >= 0)], minlength=len(self.users))
+        lines.append("")
+        lines.append(f"Top players, {title}")
+        lines.append(f"{'player':<24}{'games':>6}{'bought':>8}{'admin':>7}")
+        for user in np.argsort(-attended, kind="stable")[:top]:
+            if not attended[user]:
+                break
+            lines.append(f"{self.users[user]:<24}{attended[user]:>6}{purchases[user]:>8}{payments[user]:>7}")
+        return "\n".join(lines)
+
+
+# fingerprint of the source rows -> History built from them
+LOADED: OrderedDict[str, History] = OrderedDict()
+MAX_LOADED = 8
+
+
+def load(fingerprint: str, registrations: list[list], auctions: list[list], games: list[list], default_cap: int) -> History:
+    """Builds the History, or returns the one built from the same rows before"""
+
+    if fingerprint in LOADED:
+        LOADED.move_to_end(fingerprint)
+        return LOADED[fingerprint]
+    history = History.from_rows(registrations, auctions, games, default_cap)
+    LOADED[fingerprint] = history
+    while len(LOADED) > MAX_LOADED:
+        LOADED.popitem(last=False)
+    return history
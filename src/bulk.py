@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Bulk import and export of players, games, registrations and auctions.
+
+Rows are streamed in chunks: every chunk of an import is validated with the
+model's from_list and written with a single append, an export reads the table
+(archive tabs included) chunk by chunk. Memory use does not grow with the
+number of rows. Progress and throughput are reported to stderr.
+
+CSV files have a header row with the field names of the model, JSONL files
+one object (or one list of values in field order) per line. "-" stands for
+stdin or stdout.
+
+Usage:
+$ python bulk.py import players players.csv
+$ python bulk.py export registrations registrations.jsonl --chunk 2000
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from contextlib import nullcontext
+from dataclasses import fields
+from typing import Iterator
+
+import database.gs as gs
+from database import Database, create_database
+from models import Storable, Player, Game, Registration, AvailableSlot
+
+TABLES: dict[str, type[Storable]] = {
+    model.sheet_name(): model for model in (Player, Game, Registration, AvailableSlot)
+}
+
+log = logging.getLogger("bulk")
+
+
+class Progress():
+    """Rows done and throughput, reported at most every interval seconds"""
+
+    def __init__(self, action: str, table: str, interval: float = 1):
+        self.action = action
+        self.table = table
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.reported = 0.0
+        self.rows = 0
+        self.invalid = 0
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        rate = self.rows / elapsed if elapsed else 0
+        text = f"{self.action} {self.table}: {self.rows} rows in {elapsed:.1f}s, {rate:.0f} rows/s"
+        if self.invalid:
+            text += f", {self.invalid} invalid rows skipped"
+        return text
+
+    def add(self, rows: int):
+        self.rows += rows
+        if time.perf_counter() - self.reported >= self.interval:
+            self.reported = time.perf_counter()
+            print(self.line(), file=sys.stderr)
+
+
+def open_file(path: str, mode: str):
+    if path == "-":
+        # Used in a with block, which must not close stdin or stdout
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def file_format(path: str, given: str|None) -> str:
+    if given:
+        return given
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+
+def read_values(file, fmt: str, names: list[str]) -> Iterator[tuple[int, list|None]]:
+    """Yields the line number and the values of every record, in field order.
+    None for records that cannot be parsed"""
+
+    if fmt == "csv":
+        reader = csv.reader(file)
+        for row in reader:
+            if reader.line_num == 1 and row == names:
+                continue  # Header
+            yield reader.line_num, row
+        return
+
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield number, None
+            continue
+        if isinstance(record, dict):
+            yield number, [record.get(name, "") for name in names]
+        elif isinstance(record, list):
+            yield number, record
+        else:
+            yield number, None
+
+
+def import_table(db: Database, table: str, path: str, fmt: str, chunk_size: int) -> str:
+    model = TABLES[table]
+    names = [f.name for f in fields(model)]
+    progress = Progress("import", table)
+    chunk: list[Storable] = []
+    with open_file(path, "r") as file:
+        for number, values in read_values(file, fmt, names):
+            try:
+                if values is None:
+                    raise ValueError("not a record")
+                # Missing values come as "" from CSV and None from JSON
+                chunk.append(model.from_list(["" if value is None else value for value in values]))
+            except (ValueError, TypeError) as e:
+                log.warning(f"import: line {number} of {path} is invalid: {e}")
+                progress.invalid += 1
+                continue
+            if len(chunk) == chunk_size:
+                written, err = db.import_rows(table, chunk)
+                if err:
+                    return f"{err}, {progress.rows} rows imported before line {number}"
+                progress.add(written)
+                chunk = []
+        if chunk:
+            written, err = db.import_rows(table, chunk)
+            if err:
+                return f"{err}, {progress.rows} rows imported before the last chunk"
+            progress.add(written)
+    print(progress.line(), file=sys.stderr)
+    return ""
+
+
+def export_table(db: Database, table: str, path: str, fmt: str, chunk_size: int) -> str:
+    names = [f.name for f in fields(TABLES[table])]
+    progress = Progress("export", table)
+    with open_file(path, "w") as file:
+        writer = csv.writer(file) if fmt == "csv" else None
+        if writer:
+            writer.writerow(names)
+        for rows, err in db.export_chunks(table, chunk_size):
+            if err:
+                return f"{err}, {progress.rows} rows exported"
+            for row in rows:
+                # Trailing empty cells are not returned by Sheets
+                row = ["" if value is None else value for value in row] + [""] * (len(names) - len(row))
+                if writer:
+                    writer.writerow(row)
+                else:
+                    file.write(json.dumps(dict(zip(names, row))) + "\n")
+            progress.add(len(rows))
+    print(progress.line(), file=sys.stderr)
+    return ""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stream rows of a table from or to a CSV/JSONL file")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("table", choices=sorted(TABLES))
+    parser.add_argument("path", help='CSV or JSONL file, "-" for stdin/stdout')
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None, help="by the file extension by default")
+    parser.add_argument("--chunk", type=int, default=1000, help="rows per Sheets call")
+    parser.add_argument("--tenant", default=None, help="tenant to work with, the default one if not given")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Storage logs every call, which would dominate the output
+    logging.basicConfig(level=logging.WARNING)
+    if args.tenant:
+        if args.tenant not in gs.TENANTS:
+            sys.exit(f"unknown tenant {args.tenant}")
+        gs.CURRENT_TENANT.set(gs.TENANTS[args.tenant])
+    action = import_table if args.action == "import" else export_table
+    err = action(create_database(), args.table, args.path, file_format(args.path, args.format), args.chunk)
+    if err:
+        sys.exit(err)
@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from telegram import Update
+from telegram.error import TelegramError, RetryAfter
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes, ConversationHandler
+
+log = logging.getLogger("conversations")
+
+EXPIRED_TEXT = "This menu has expired, send /start to get a fresh one"
+
+
+class ConversationSweeper():
+    """Ends idle conversations and keeps the table of conversations bounded.
+    The keyboards of ended conversations are removed in small, rate-limited
+    batches, and their buttons are refused before any handler runs.
+    ConversationHandler can only time out conversations with a JobQueue,
+    which this bot does not use"""
+
+    def __init__(self, timeout: float = 900, interval: float = 60, max_conversations: int = 10000,
+                 edit_batch: int = 20, edit_rate: float = 5):
+        self.timeout = timeout
+        self.interval = interval
+        self.max_conversations = max_conversations
+        self.edit_batch = edit_batch
+        self.edit_rate = edit_rate
+        self.handler: ConversationHandler|None = None
+        self.application: Application|None = None
+        # conversation key -> last activity, least recently active first
+        self.last_seen: OrderedDict[tuple, float] = OrderedDict()
+        # user id -> number of their conversations in last_seen, in private and group chats
+        self.users: dict[int, int] = {}
+        # conversation key -> (chat_id, message_id) of the message with its live keyboard
+        self.keyboards: dict[tuple, tuple[int, int]] = {}
+        # Keyboards waiting to be removed, in the order they went stale
+        self.stale: dict[tuple[int, int], None] = {}
+        self.task: asyncio.Task|None = None
+        self.ended = 0
+
+
+    def watch(self, handler: ConversationHandler):
+        self.handler = handler
+
+
+    def start(self, application: Application):
+        """Starts sweeping, to be called from post_init"""
+
+        self.application = application
+        # Conversations restored by the persistence count as active from now on
+        now = time.monotonic()
+        for key in list(self.handler._conversations):
+            self.seen(key, now)
+        # Not Application.create_task: stopping the application waits for those to finish
+        self.task = asyncio.create_task(self._sweep_forever())
+
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+
+    def key(self, update: Update) -> tuple:
+        # The key ConversationHandler(per_chat=True, per_user=True) uses
+        return update.effective_chat.id, update.effective_user.id
+
+
+    def track(self, update: Update, message):
+        """Remembers the message with the live keyboard of the conversation.
+        The keyboard of the previous menu, if still live, goes away"""
+
+        key = self.key(update)
+        previous = self.keyboards.get(key)
+        current = (message.chat_id, message.message_id)
+        # Menus of ended conversations had their keyboards replaced by the handlers
+        if previous and previous != current and self.active(key):
+            self.stale[previous] = None
+        self.keyboards[key] = current
+
+
+    async def guard(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Runs before all handlers: records activity and refuses buttons of
+        menus that are not the live one of a running conversation"""
+
+        if not update.effective_chat or not update.effective_user:
+            return
+        key = self.key(update)
+        self.seen(key, time.monotonic())
+        self.last_seen.move_to_end(key)
+
+        query = update.callback_query
+        if not query or not query.message:
+            return
+        message = (query.message.chat_id, query.message.message_id)
+        if self.active(key) and self.keyboards.get(key) in (None, message):
+            return
+        await query.answer(text=EXPIRED_TEXT)
+        self.stale[message] = None
+        raise ApplicationHandlerStop
+
+
+    def seen(self, key: tuple, at: float):
+        if key not in self.last_seen:
+            self.users[key[1]] = self.users.get(key[1], 0) + 1
+        self.last_seen[key] = at
+
+
+    def active(self, key: tuple) -> bool:
+        # ConversationHandler does not expose its conversations
+        return key in self.handler._conversations
+
+
+    def end(self, key: tuple):
+        """Ends the conversation and forgets everything about it"""
+
+        if self.last_seen.pop(key, None) is not None:
+            self.users[key[1]] -= 1
+        keyboard = self.keyboards.pop(key, None)
+        if self.active(key):
+            # Conversations ended by their handlers have their keyboards removed already
+            if keyboard:
+                self.stale[keyboard] = None
+            # No public way to end a conversation from outside of its handlers
+            self.handler._update_state(ConversationHandler.END, key)
+            self.ended += 1
+        # Cached player and registrations are loaded again on /start,
+        # unless the user still talks to the bot in another chat
+        if not self.users.get(key[1]):
+            self.users.pop(key[1], None)
+            self.application.drop_user_data(key[1])
+
+
+    def sweep(self):
+        """Ends the idle conversations and the least recently active ones over the limit"""
+
+        deadline = time.monotonic() - self.timeout
+        while self.last_seen:
+            key, seen = next(iter(self.last_seen.items()))
+            if seen > deadline and len(self.last_seen) <= self.max_conversations:
+                break
+            self.end(key)
+        # Should editing fall far behind, the oldest keyboards are left as they are,
+        # their buttons are refused anyway
+        while len(self.stale) > self.max_conversations:
+            del self.stale[next(iter(self.stale))]
+
+
+    async def remove_keyboards(self):
+        """Removes a batch of stale keyboards, no faster than edit_rate per second"""
+
+        for chat_id, message_id in list(itertools.islice(self.stale, self.edit_batch)):
+            try:
+                await self.application.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
+            except RetryAfter as e:
+                # Stays in the queue for the next batch
+                await asyncio.sleep(e.retry_after)
+                return
+            except TelegramError as e:
+                # Deleted, too old to edit or already without a keyboard
+                log.info(f"remove_keyboards: cannot edit {chat_id}/{message_id}: {e}")
+            del self.stale[(chat_id, message_id)]
+            await asyncio.sleep(1 / self.edit_rate)
+
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep()
+                await self.remove_keyboards()
+            except Exception as e:
+                log.info(f"sweep: {e}")
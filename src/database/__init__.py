@@ -1,4 +1,5 @@
 """
 Collection of helper functions
 """
-from .database import Database
\ No newline at end of file
+from .database import Database
+from .events import EventDatabase, create_database
\ No newline at end of file
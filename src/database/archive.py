@@ -0,0 +1,158 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+import database.gs as gs
+from models import Partition
+
+log = logging.getLogger("database")
+
+# Sheets whose past games are moved to per-season archive tabs
+ARCHIVED_TABLES = ["registrations", "auctions"]
+
+# tenant name -> (version of the partitions sheet, {(table, game_date): archive tab})
+ROUTES: dict[str, tuple[int, dict[tuple[str, str], str]]] = {}
+
+
+def archive_sheet_name(table: str, game_date: str) -> str:
+    """Archive tab of the season the game belongs to (e.g. registrations_2024)"""
+    return f"{table}_{game_date[:4]}"
+
+
+def is_date(value) -> bool:
+    try:
+        datetime.strptime(str(value), "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+def load_routes() -> tuple[dict[tuple[str, str], str], str]:
+    """Returns the routing index of the current tenant.
+    It is re-read only after someone has archived something"""
+
+    tenant = gs.current_tenant()
+    version = gs.SHARED.version(tenant.key(Partition.sheet_name()))
+    cached = ROUTES.get(tenant.name)
+    if cached and cached[0] == version:
+        return cached[1], ""
+
+    # Spreadsheets that were never archived do not have the tab
+    _, err = gs.ensure_sheet(Partition.sheet_name())
+    if err:
+        return {}, f"cannot read routes: {err}"
+    values, err = gs.read_sheet(Partition.sheet_name())
+    if err:
+        return {}, f"cannot read routes: {err}"
+    routes = {}
+    for row in values:
+        try:
+            partition = Partition.from_list(row)
+            if not partition.table or not partition.game_date or not partition.sheet:
+                raise ValueError("empty values")
+        except (ValueError, TypeError) as e:
+            log.info(f"load_routes: skipping malformed route {row}: {e}")
+            continue
+        routes[(partition.table, partition.game_date)] = partition.sheet
+    ROUTES[tenant.name] = (version, routes)
+    return routes, ""
+
+
+def route(table: str, game_date: str) -> tuple[list[str], str]:
+    """Returns the tabs holding the rows of the given game.
+    Archived games are read from the hot tab as well, in case something
+    was written to them after they were archived"""
+
+    if table not in ARCHIVED_TABLES:
+        return [table], ""
+    routes, err = load_routes()
+    if err:
+        return [], err
+    if (table, game_date) in routes:
+        return [routes[(table, game_date)], table], ""
+    return [table], ""
+
+
+def history_sheets(table: str) -> tuple[list[str], str]:
+    """Returns the hot tab and all archive tabs of the table, for reporting"""
+
+    routes, err = load_routes()
+    if err:
+        return [], err
+    archives = sorted({sheet for (t, _), sheet in routes.items() if t == table})
+    return [table] + archives, ""
+
+
+def archive_table(table: str, before: str) -> tuple[int, str]:
+    """Moves the rows of all games played before the given date to the archive tabs.
+    Rows are copied and routed first and deleted from the hot tab last,
+    so an interrupted run leaves every game readable and can simply be repeated"""
+
+    try:
+        before = datetime.strptime(before, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return 0, f"cannot archive {table}: {before} is not a date"
+    # Row numbers must not be shifted by other deletes while we are at it
+    with gs.SHARED.lock(gs.current_tenant().key(f"{table}:rows")):
+        return _archive_table(table, before)
+
+
+def _archive_table(table: str, before: str) -> tuple[int, str]:
+    err = gs.validate_sheet(table)
+    if err:
+        return 0, f"cannot archive {table}: {err}"
+    values, err = gs.read_sheet(table)
+    if err:
+        return 0, f"cannot archive {table}: {err}"
+    routes, err = load_routes()
+    if err:
+        return 0, f"cannot archive {table}: {err}"
+
+    # Rows of the hot tab to move, grouped by archive tab
+    to_copy = defaultdict(list)
+    to_route = {}
+    to_delete = []
+    archived = {}
+    for i, row in enumerate(values, start=1):
+        if not row or not is_date(row[0]) or row[0] >= before:
+            continue
+        game_date = row[0]
+        to_delete.append(i)
+        if (table, game_date) not in routes:
+            sheet = archive_sheet_name(table, game_date)
+            to_route[game_date] = sheet
+            to_copy[sheet].append(row)
+            continue
+        # The game was archived before: skip the rows an interrupted run has already copied
+        sheet = routes[(table, game_date)]
+        if sheet not in archived:
+            archived_rows, err = gs.read_sheet(sheet)
+            if err:
+                return 0, f"cannot archive {table}: {err}"
+            archived[sheet] = [tuple(r) for r in archived_rows]
+        if tuple(row) not in archived[sheet]:
+            to_copy[sheet].append(row)
+
+    for sheet, rows in to_copy.items():
+        _, err = gs.ensure_sheet(sheet)
+        if err:
+            return 0, f"cannot archive {table}: {err}"
+        _, err = gs.append_rows(sheet, rows)
+        if err:
+            return 0, f"cannot archive {table}: {err}"
+
+    if to_route:
+        _, err = gs.ensure_sheet(Partition.sheet_name())
+        if err:
+            return 0, f"cannot archive {table}: {err}"
+        partitions = [list(Partition(table, game_date, sheet)) for game_date, sheet in sorted(to_route.items())]
+        _, err = gs.append_rows(Partition.sheet_name(), partitions)
+        if err:
+            return 0, f"cannot archive {table}: {err}"
+
+    if to_delete:
+        _, err = gs.delete_rows(table, to_delete)
+        if err:
+            return 0, f"cannot archive {table}: {err}"
+
+    log.info(f"archive_table: moved {len(to_delete)} rows of {len(to_route)} games from {table}")
+    return len(to_delete), ""
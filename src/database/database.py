@@ -1,13 +1,22 @@
+import asyncio
+import contextvars
+import functools
 import logging
+import threading
+from typing import Callable, Iterator
 import database.gs as gs
-from models import Storable, Player, Game, Registration, AvailableSlot
+import database.archive as archive
+import database.ledger as ledger
+import database.schedule as schedule
+from models import Storable, Player, Game, Registration, AvailableSlot, Partition
 
 
 TABLE_TO_OBJECT_MAP = {
     Player.sheet_name(): Player,
     Game.sheet_name(): Game,
     Registration.sheet_name(): Registration,
-    AvailableSlot.sheet_name(): AvailableSlot
+    AvailableSlot.sheet_name(): AvailableSlot,
+    Partition.sheet_name(): Partition,
 }
     
 class Database():
@@ -17,6 +26,96 @@ class Database():
         self.log = logging.getLogger("database")
 
 
+    def restore(self):
+        """Loads the local snapshot of the sheets and validates it against Sheets in the background"""
+
+        gs.load_snapshots()
+        threading.Thread(target=gs.validate_snapshots, daemon=True).start()
+
+
+    async def run(self, fn, *args):
+        """Runs a blocking call in a thread of the current tenant, as asyncio.to_thread does.
+        A tenant over its Sheets quota cannot take the threads of the others"""
+
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(gs.current_tenant().executor(), call)
+
+
+    def key(self, name: str) -> str:
+        """Name of a lock or an idempotency key, unique across tenants"""
+
+        return gs.current_tenant().key(name)
+
+
+    def lock(self, name: str):
+        """Returns a context manager holding the named lock across all bot workers"""
+
+        return gs.SHARED.lock(self.key(name))
+
+
+    def ledger(self) -> ledger.BalanceLedger:
+        """Balances of the players of the current tenant, see database.ledger"""
+
+        return ledger.current_ledger()
+
+
+    def calendar(self) -> schedule.GameCalendar:
+        """Games of the current tenant, see database.schedule"""
+
+        return schedule.current_calendar()
+
+
+    def flush_ledgers(self) -> tuple[int, str]:
+        """Writes the pending balance changes of all tenants"""
+
+        return ledger.flush_all()
+
+
+    def prewarm(self, game_dates: Callable[[], tuple[list[str], str]], horizon: float = 0) -> tuple[int, str]:
+        """Loads players, games and the rosters and auction books of the games of every tenant,
+        so the next requests find them in memory. game_dates returns the games of the current tenant.
+        Returns the number of warmed sheets"""
+
+        warmed = 0
+        errors = []
+        for tenant in gs.TENANTS.values():
+            gs.CURRENT_TENANT.set(tenant)
+            dates, err = game_dates()
+            if err:
+                errors.append(f"{tenant.name}: {err}")
+                continue
+            sheets, err = self.warm_sheets(dates)
+            if err:
+                errors.append(f"{tenant.name}: {err}")
+                continue
+            for sheet in sheets:
+                _, err = gs.warm_sheet(sheet, horizon)
+                if err:
+                    errors.append(f"{tenant.key(sheet)}: {err}")
+                    continue
+                warmed += 1
+        return warmed, "; ".join(errors)
+
+
+    def warm_sheets(self, game_dates: list[str]) -> tuple[list[str], str]:
+        """Sheets the requests about the given games read"""
+
+        sheets = [Player.sheet_name(), Game.sheet_name()]
+        for table in (Registration.sheet_name(), AvailableSlot.sheet_name()):
+            for game_date in game_dates:
+                routed, err = archive.route(table, game_date)
+                if err:
+                    return [], err
+                sheets.extend(sheet for sheet in routed if sheet not in sheets)
+        return sheets, ""
+
+
+    def use_tenant(self, chat_id: int):
+        """Serves the following calls in this context from the spreadsheet of the chat's tenant"""
+
+        gs.use_tenant(chat_id)
+
+
     def exists(self, data: Storable) -> tuple[bool, str]:
 
         value1, value2 = data.unique_keys
@@ -46,7 +145,9 @@ class Database():
         if not raw_data:
             return None, ""
         
-        assert len(raw_data) == 1, "read should return only 1 value"
+        if len(raw_data) > 1:
+            # Left behind by duplicate writes, the first one is the one that counts
+            self.log.info(f"read: {len(raw_data)} rows in {data.sheet_name()} for {data.unique_keys}, using the first")
         
         storable = TABLE_TO_OBJECT_MAP[data.sheet_name()]
         result = storable.from_list(raw_data[0])
@@ -57,9 +158,16 @@ class Database():
     def read_table(self, table: str, filter: str) -> tuple[list[Storable], str]:
         """Reads the given sheet and returns a list of objects of the corresponding type. If filter is provided, the rows are filtered"""
         
-        raw_data, err = gs.read_by_value(sheet_name=table, search_value=filter)
+        # Past games may live in an archive tab
+        sheets, err = archive.route(table, filter)
         if err:
             return [], f"cannot read table: {err}"
+        raw_data = []
+        for sheet in sheets:
+            rows, err = gs.read_by_value(sheet_name=sheet, search_value=filter)
+            if err:
+                return [], f"cannot read table: {err}"
+            raw_data.extend(rows)
         if not raw_data:
             return [], ""
         
@@ -67,7 +175,6 @@ class Database():
 
         result = []
         for i in range(len(raw_data)):
-            print(raw_data)
             item = storable.from_list(raw_data[i])
             result.append(item)
                 
@@ -75,9 +182,7 @@ class Database():
 
 
     def update(self, data) -> tuple[bool, str]:
-        # TODO: not used yet, adjust to the use case.
-        # The current implementation is a bit odd, 
-        #   since we are updating only metadata and not the key field(s)
+        # Only metadata is updated, the key field(s) identify the row
 
         value1, value2 = data.unique_keys
         _, err = gs.update_row_by_value(sheet_name=data.sheet_name(), search_value=value1, search_value_2=value2, new_data=list(data))
@@ -102,4 +207,64 @@ class Database():
         if err:
             return False, f"cannot delete item: {err}"
         
-        return True, err
\ No newline at end of file
+        return True, err
+
+
+    def history(self, table: str) -> tuple[list[list[str]], str, str]:
+        """Returns the raw rows of the table over all seasons, archive tabs included,
+        and a fingerprint that changes whenever any of those rows do"""
+
+        sheets, err = archive.history_sheets(table)
+        if err:
+            return [], "", f"cannot read history: {err}"
+        rows = []
+        fingerprints = []
+        for sheet in sheets:
+            values, err = gs.read_sheet(sheet)
+            if err:
+                return [], "", f"cannot read history: {err}"
+            rows.extend(values)
+            state = gs.current_tenant().sheets.get(sheet)
+            fingerprints.append(state.fingerprint if state else gs.fingerprint_rows(values))
+        return rows, gs.current_tenant().key("|".join(fingerprints)), ""
+
+
+    def import_rows(self, table: str, items: list[Storable]) -> tuple[int, str]:
+        """Appends the items to the table in a single call, see bulk.py"""
+
+        _, err = gs.append_rows(table, [list(item) for item in items])
+        if err:
+            return 0, f"cannot import: {err}"
+        return len(items), ""
+
+
+    def export_chunks(self, table: str, chunk_size: int) -> Iterator[tuple[list[list], str]]:
+        """Yields the raw rows of the table over all seasons, chunk_size rows per read,
+        archive tabs included. Nothing is cached, so memory stays flat however long the table"""
+
+        sheets, err = archive.history_sheets(table)
+        if err:
+            yield [], f"cannot export: {err}"
+            return
+        for sheet in sheets:
+            first_row = 1
+            while True:
+                rows, err = gs.fetch_range(sheet, first_row=first_row, last_row=first_row + chunk_size - 1)
+                if err:
+                    yield [], f"cannot export: {err}"
+                    return
+                # Empty rows within a chunk come back as [], trailing ones are cut
+                if not rows:
+                    break
+                yield [row for row in rows if row], ""
+                first_row += chunk_size
+
+
+    def archive(self, table: str, before: str) -> tuple[int, str]:
+        """Moves rows of the games played before the given date out of the hot sheet"""
+
+        moved, err = archive.archive_table(table, before)
+        if err:
+            return 0, f"cannot archive: {err}"
+
+        return moved, ""
@@ -0,0 +1,293 @@
+import copy
+import json
+import logging
+import threading
+import time
+from typing import Callable, Iterator
+import database.gs as gs
+from models import Storable, Player, Game, Registration, AvailableSlot, Event
+from .database import Database, TABLE_TO_OBJECT_MAP
+
+# Tables kept as events instead of rows, see EventDatabase
+EVENT_TABLES = {Registration.sheet_name(), AvailableSlot.sheet_name()}
+
+log = logging.getLogger("database")
+
+
+class EventViews():
+    """Registrations and auctions of one tenant, materialized from its event log.
+    Only the events appended since the last refresh are applied.
+    Items behave as the rows of the sheets would: several of them may share the
+    unique keys (e.g. the slots the admin sells), updates and deletes apply to the first one"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        # When the last finished refresh started
+        self.refreshed_at = 0.0
+        # table -> game_date -> items, in the order they were created
+        self.tables: dict[str, dict[str, list[Storable]]] = {}
+        # Number of events applied and the fingerprint of those rows
+        self.applied = 0
+        self.fingerprint = ""
+        self.ready = False
+
+
+    def refresh(self) -> str:
+        """Applies the new events of the log"""
+
+        events = Event.sheet_name()
+        requested_at = time.monotonic()
+        with self.refreshing:
+            # A refresh that started after our request has seen everything we could
+            if self.refreshed_at > requested_at:
+                return ""
+            started_at = time.monotonic()
+            if not self.ready:
+                _, err = gs.ensure_sheet(events)
+                if err:
+                    return err
+                self.ready = True
+
+            tenant = gs.current_tenant()
+            with tenant.lock(events):
+                rows, err = gs.sync_sheet(events)
+                if err:
+                    return err
+                fingerprint = tenant.sheets[events].fingerprint
+                tail = rows[self.applied:]
+
+            with self.lock:
+                if len(rows) < self.applied or gs.fingerprint_rows(tail, self.fingerprint) != fingerprint:
+                    # Events were edited or deleted by hand, start over
+                    log.info(f"refresh: {events} was changed, rebuilding the views")
+                    self.tables, self.applied, self.fingerprint = {}, 0, ""
+                    tail = rows
+
+                for row in tail:
+                    try:
+                        self.apply(Event.from_list(row))
+                    except (ValueError, KeyError) as e:
+                        log.info(f"refresh: skipping malformed event {row}: {e}")
+                self.applied += len(tail)
+                self.fingerprint = fingerprint
+            self.refreshed_at = started_at
+            return ""
+
+
+    def apply(self, event: Event):
+        storable = TABLE_TO_OBJECT_MAP[event.table]
+        items = self.tables.setdefault(event.table, {}).setdefault(event.game_date, [])
+        if event.action == "create":
+            items.append(storable.from_list(json.loads(event.data)))
+            return
+        keys = tuple(json.loads(event.data))
+        if event.action == "update":
+            item = storable.from_list(json.loads(event.data))
+            keys = item.unique_keys
+        index = self._find(items, keys)
+        if index is None:
+            log.info(f"apply: no {event.table} item {keys} to {event.action}")
+        elif event.action == "update":
+            items[index] = item
+        else:
+            del items[index]
+
+
+    @staticmethod
+    def _find(items: list[Storable], keys: tuple) -> int|None:
+        return next((i for i, item in enumerate(items) if item.unique_keys == keys), None)
+
+
+    def get(self, table: str, keys: tuple) -> Storable|None:
+        with self.lock:
+            items = self.tables.get(table, {}).get(keys[0], [])
+            index = self._find(items, keys)
+            # Callers change what they read before writing it back
+            return copy.copy(items[index]) if index is not None else None
+
+
+    def list(self, table: str, game_date: str) -> list[Storable]:
+        with self.lock:
+            return [copy.copy(item) for item in self.tables.get(table, {}).get(game_date, [])]
+
+
+class EventDatabase(Database):
+    """Stores registrations and auctions as an append-only log of events
+    (joins, leaves, slot offers and matches) in the events sheet.
+    Nothing is deleted from Sheets, so writes are single appends and reads are
+    served from the views, which only fetch the tail of the log.
+    Other tables are served by Database"""
+
+    def __init__(self):
+        super().__init__()
+        # tenant name -> its views
+        self.views: dict[str, EventViews] = {}
+        self.views_lock = threading.Lock()
+
+
+    def _views(self) -> tuple[EventViews, str]:
+        with self.views_lock:
+            views = self.views.setdefault(gs.current_tenant().name, EventViews())
+        err = views.refresh()
+        return views, err
+
+
+    def _append(self, table: str, action: str, game_date: str, data: list) -> tuple[bool, str]:
+        # Writes may come before the first refresh created the log
+        _, err = gs.ensure_sheet(Event.sheet_name())
+        if err:
+            return False, err
+        event = Event(int(time.time()), table, action, game_date, json.dumps(data))
+        _, err = gs.write_to_sheet(sheet_name=Event.sheet_name(), new_data=list(event))
+        if err:
+            return False, err
+        return True, ""
+
+
+    def exists(self, data: Storable) -> tuple[bool, str]:
+        if data.sheet_name() not in EVENT_TABLES:
+            return super().exists(data)
+
+        item, err = self.read(data)
+        if err:
+            return False, f"cannot find item: {err}"
+        return item is not None, ""
+
+
+    def create(self, data: Storable) -> tuple[bool, str]:
+        if data.sheet_name() not in EVENT_TABLES:
+            return super().create(data)
+
+        _, err = self._append(data.sheet_name(), "create", data.unique_keys[0], list(data))
+        if err:
+            return False, f"cannot create item: {err}"
+        return True, ""
+
+
+    def read(self, data: Storable) -> tuple[Storable|None, str]:
+        if data.sheet_name() not in EVENT_TABLES:
+            return super().read(data)
+
+        views, err = self._views()
+        if err:
+            return None, f"cannot read item: {err}"
+        return views.get(data.sheet_name(), data.unique_keys), ""
+
+
+    def read_table(self, table: str, filter: str) -> tuple[list[Storable], str]:
+        if table not in EVENT_TABLES:
+            return super().read_table(table, filter)
+
+        views, err = self._views()
+        if err:
+            return [], f"cannot read table: {err}"
+        return views.list(table, filter), ""
+
+
+    def update(self, data) -> tuple[bool, str]:
+        if data.sheet_name() not in EVENT_TABLES:
+            return super().update(data)
+
+        # As for the rows of the sheets, there has to be an item to update
+        exist, err = self.exists(data)
+        if err:
+            return False, f"cannot update item: {err}"
+        if not exist:
+            return False, "cannot update item: no item found"
+
+        _, err = self._append(data.sheet_name(), "update", data.unique_keys[0], list(data))
+        if err:
+            return False, f"cannot update item: {err}"
+        return True, ""
+
+
+    def delete(self, data) -> tuple[bool, str]:
+        if data.sheet_name() not in EVENT_TABLES:
+            return super().delete(data)
+
+        exist, err = self.exists(data)
+        if err:
+            return False, f"cannot delete item: {err}"
+        if not exist:
+            return True, ""
+
+        _, err = self._append(data.sheet_name(), "delete", data.unique_keys[0], list(data.unique_keys))
+        if err:
+            return False, f"cannot delete item: {err}"
+        return True, ""
+
+
+    def prewarm(self, game_dates: Callable[[], tuple[list[str], str]], horizon: float = 0) -> tuple[int, str]:
+        warmed, err = super().prewarm(game_dates, horizon)
+        if err:
+            return warmed, err
+        # The event log is synced already, apply it
+        for tenant in gs.TENANTS.values():
+            gs.CURRENT_TENANT.set(tenant)
+            _, err = self._views()
+            if err:
+                return warmed, f"{tenant.name}: {err}"
+        return warmed, ""
+
+
+    def warm_sheets(self, game_dates: list[str]) -> tuple[list[str], str]:
+        return [Player.sheet_name(), Game.sheet_name(), Event.sheet_name()], ""
+
+
+    def history(self, table: str) -> tuple[list[list[str]], str, str]:
+        if table not in EVENT_TABLES:
+            return super().history(table)
+
+        views, err = self._views()
+        if err:
+            return [], "", f"cannot read history: {err}"
+        with views.lock:
+            rows = [list(item) for items in views.tables.get(table, {}).values() for item in items]
+            fingerprint = gs.current_tenant().key(f"{table}:{views.fingerprint}")
+        return rows, fingerprint, ""
+
+
+    def import_rows(self, table: str, items: list[Storable]) -> tuple[int, str]:
+        if table not in EVENT_TABLES:
+            return super().import_rows(table, items)
+
+        now = int(time.time())
+        events = [list(Event(now, table, "create", item.unique_keys[0], json.dumps(list(item)))) for item in items]
+        _, err = gs.ensure_sheet(Event.sheet_name())
+        if err:
+            return 0, f"cannot import: {err}"
+        _, err = gs.append_rows(Event.sheet_name(), events)
+        if err:
+            return 0, f"cannot import: {err}"
+        return len(items), ""
+
+
+    def export_chunks(self, table: str, chunk_size: int) -> Iterator[tuple[list[list], str]]:
+        if table not in EVENT_TABLES:
+            yield from super().export_chunks(table, chunk_size)
+            return
+
+        # The views are in memory anyway
+        rows, _, err = self.history(table)
+        if err:
+            yield [], f"cannot export: {err}"
+            return
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size], ""
+
+
+    def archive(self, table: str, before: str) -> tuple[int, str]:
+        if table not in EVENT_TABLES:
+            return super().archive(table, before)
+
+        # The event log is the history already, and reads never scan it
+        return 0, ""
+
+
+def create_database() -> Database:
+    """Creates the database for the storage.mode of the settings: "sheets" (default) or "events" """
+
+    if gs.GS_SETTINGS.get("storage.mode", "sheets") == "events":
+        return EventDatabase()
+    return Database()
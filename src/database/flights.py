@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+
+class Flight:
+    """A call in progress and the callers waiting for its result"""
+
+    def __init__(self, generation: Hashable):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException|None = None
+        self.waiters = 0
+
+
+class SingleFlight():
+    """Runs identical concurrent calls once: callers asking for a key that is
+    being fetched already wait for that call and all get its result, or its exception.
+    A call joins only a flight of the same generation (e.g. the version of the
+    sheet), so a caller never gets a result older than a write it has seen"""
+
+    def __init__(self):
+        self.guard = threading.Lock()
+        self.flights: dict[Hashable, Flight] = {}
+        self.calls = 0
+        self.shared = 0
+
+
+    def do(self, key: Hashable, generation: Hashable, fn: Callable):
+        with self.guard:
+            flight = self.flights.get(key)
+            if flight and flight.generation == generation:
+                flight.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                # A newer generation replaces the flight, its waiters keep their reference
+                flight = Flight(generation)
+                self.flights[key] = flight
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.guard:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class Idempotency():
+    """Runs a write once per idempotency key. A duplicate arriving while the write
+    is in progress waits for it, one arriving within the lifetime of a key after
+    the write gets its result right away, neither repeats the write.
+    Failed writes are forgotten, so they can be retried"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self.guard = threading.Lock()
+        # key -> flight of the write and seconds the key lives after it, oldest first.
+        # The generation of a flight is the time its write finished
+        self.flights: OrderedDict[Hashable, tuple[Flight, float]] = OrderedDict()
+        self.duplicates = 0
+
+
+    def _live(self, key: Hashable, now: float) -> Flight|None:
+        flight, ttl = self.flights.get(key, (None, 0))
+        if flight and flight.generation + ttl > now:
+            return flight
+        return None
+
+
+    def _expire(self, now: float):
+        while self.flights:
+            key = next(iter(self.flights))
+            if self._live(key, now) and len(self.flights) <= self.max_keys:
+                break
+            # Waiters of a write in progress keep their reference
+            del self.flights[key]
+
+
+    def do(self, keys: dict[Hashable, float], fn: Callable, ok: Callable = lambda result: not result[-1]):
+        """Returns the result of fn, called unless a write with any of the keys
+        (mapped to their lifetimes) ran recently. ok tells successful results,
+        by default those with no error last"""
+
+        with self.guard:
+            now = time.monotonic()
+            self._expire(now)
+            flight = next(filter(None, (self._live(key, now) for key in keys)), None)
+            leader = flight is None
+            if leader:
+                flight = Flight(generation=float("inf"))
+                for key, ttl in keys.items():
+                    self.flights.pop(key, None)
+                    self.flights[key] = (flight, ttl)
+            else:
+                self.duplicates += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.guard:
+                flight.generation = time.monotonic()
+                if flight.error or not ok(flight.result):
+                    for key in keys:
+                        if self.flights.get(key, (None,))[0] is flight:
+                            del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+    def forget(self, key: Hashable):
+        """Lets the next write with the key run, e.g. joining again after leaving"""
+
+        with self.guard:
+            self.flights.pop(key, None)
@@ -1,8 +1,17 @@
+import hashlib
+import itertools
 import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from dynaconf import Dynaconf
 from functools import lru_cache
+from .snapshot import SnapshotStore
+from .shared import SharedRows, create_shared_store
+from .flights import SingleFlight
+from .tenants import Tenant, FairScheduler, load_tenants
 
 GS_SETTINGS = Dynaconf(
     envvar_prefix="PLUTARCH",
@@ -10,21 +19,63 @@ GS_SETTINGS = Dynaconf(
     sysenv_fallback=True,
 )
 
-SHEET_IDS = {
-    "players": GS_SETTINGS.google.players_sheet_id,
-    "games": GS_SETTINGS.google.games_sheet_id,
-    "registrations": GS_SETTINGS.google.registrations_sheet_id,
-    "auctions": GS_SETTINGS.google.auctions_sheet_id,
+# Every chat is served from the spreadsheet of its tenant,
+# chats without a tenant of their own use the [google] section
+DEFAULT_TENANT, TENANTS, CHAT_TENANTS = load_tenants(GS_SETTINGS)
+CURRENT_TENANT: ContextVar[Tenant] = ContextVar("tenant", default=DEFAULT_TENANT)
+
+# Shares Sheets calls fairly between tenants
+SCHEDULER = FairScheduler(GS_SETTINGS.get("scheduler.max_concurrent", 4))
+
+# Columns (1-based) holding the unique keys of the items of a sheet, enough to find their rows
+SHEET_KEY_COLS = {
+    "players": [1],
+    "games": [1],
+    "registrations": [1, 3],
+    "auctions": [1, 2],
+    "partitions": [1, 2],
+    "ledger": [1, 2],
+    "events": [1, 4],
 }
 
+# Numbers come as numbers, which is what from_list converts strings to anyway.
+# Dates typed by hand into the sheet stay strings
+READ_OPTIONS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
+
 SHEET_NUM_COL = {
     "players": 5,
     "games": 4,
     "registrations": 4,
-    "auctions": 6
+    "auctions": 6,
+    "partitions": 3,
+    "ledger": 4,
+    "events": 5,
 }
 log = logging.getLogger("database")
 
+
+@dataclass
+class SheetState:
+    """What we know about a sheet after the last sync"""
+    rows: list = field(default_factory=list)
+    fingerprint: str = ""
+    synced_at: float = 0.0
+    full_synced_at: float = 0.0
+    # False for rows loaded from the snapshot until they are checked against Sheets
+    validated: bool = True
+    # Version of the sheet in the shared store the rows correspond to
+    version: int = 0
+
+
+# On-disk copy of the tenants' sheet states, see load_snapshots()
+SNAPSHOTS: SnapshotStore|None = None
+
+# Versions, published rows and locks shared with the other workers
+SHARED = create_shared_store(GS_SETTINGS)
+
+# Identical reads in progress, shared by all the handlers asking for them
+READS = SingleFlight()
+
 def column_number_to_excel_column_name(n):
     """Returns an Excel-like column name by its order number (e.g. 1 -> A, 27 -> AA)"""
 
@@ -35,6 +86,23 @@ def column_number_to_excel_column_name(n):
         n //= 26
     return result
 
+
+def base_sheet_name(sheet_name) -> str:
+    """Returns the sheet an archive tab belongs to (e.g. registrations_2024 -> registrations)"""
+
+    return sheet_name if sheet_name in SHEET_NUM_COL else sheet_name.rsplit("_", 1)[0]
+
+
+def current_tenant() -> Tenant:
+    return CURRENT_TENANT.get()
+
+
+def use_tenant(chat_id):
+    """Makes the following calls in this context use the tenant of the given chat"""
+
+    CURRENT_TENANT.set(CHAT_TENANTS.get(chat_id, DEFAULT_TENANT))
+
+
 @lru_cache(maxsize=1)
 def authenticate_to_gs():
     """Authenticate with Google Sheets API"""
@@ -50,35 +118,375 @@ def authenticate_to_gs():
     return spreadsheets
 
 
-def read_sheet(sheet_name, columns_number=5) -> tuple[list, str]:
-    """Function to read data from a sheet
-    return list of lists that represents spreadsheet
-    and error in case we cannot connect to a database"""
-    last_column = column_number_to_excel_column_name(SHEET_NUM_COL[sheet_name])
+def execute(request):
+    """Executes a Sheets API request once it is the current tenant's turn.
+    Counts the bytes of the response and the time spent decoding it"""
+
+    tenant = current_tenant()
+    postproc = getattr(request, "postproc", None)
+    if postproc:
+        def measured(resp, content):
+            started = time.perf_counter()
+            result = postproc(resp, content)
+            with tenant.guard:
+                tenant.received_bytes += len(content)
+                tenant.decode_time += time.perf_counter() - started
+            return result
+        request.postproc = measured
+
+    with SCHEDULER.turn(tenant):
+        return request.execute()
+
+
+def fingerprint_rows(rows, fingerprint="") -> str:
+    """Extends the fingerprint of already known rows with the given ones.
+    The fingerprint of a sheet is a hash chain over all its rows"""
+
+    for row in rows:
+        fingerprint = hashlib.sha1(f"{fingerprint}{row!r}".encode()).hexdigest()
+    return fingerprint
+
 
-    log.info(f"read_sheet: reading from {sheet_name} {last_column}")
+def project(rows, columns) -> list:
+    """Keeps only the given columns (1-based) of the rows, in the given order"""
+
+    return [[row[column - 1] if len(row) >= column else "" for column in columns] for row in rows]
+
+
+def fetch_range(sheet_name, first_row=1, columns=None, last_row=None) -> tuple[list, str]:
+    """Fetches rows of the sheet from first_row to last_row (1-based, to the end by default),
+    only the given columns (1-based) if any"""
+
+    if columns:
+        return fetch_columns(sheet_name, columns, first_row)
+    last_column = column_number_to_excel_column_name(SHEET_NUM_COL[base_sheet_name(sheet_name)])
+    last_cell = f"{last_column}{last_row or ''}"
+
+    log.info(f"fetch_range: reading from {sheet_name} A{first_row}:{last_cell}")
     spreadsheets = authenticate_to_gs()
     try:
-        result = (
-            spreadsheets.values()
-            .get(
-                spreadsheetId=GS_SETTINGS.google.spreadsheet_id,
-                range=f"{sheet_name}!A:{last_column}",
+        result = execute(
+            spreadsheets.values().get(
+                spreadsheetId=current_tenant().spreadsheet_id,
+                range=f"{sheet_name}!A{first_row}:{last_cell}",
+                fields="values",
+                **READ_OPTIONS,
             )
-            .execute()
         )
     except:
         return [], f"cannot read {sheet_name}: database unavailable"
-    
+
     return result.get("values", []), ""
 
 
+def fetch_columns(sheet_name, columns, first_row=1) -> tuple[list, str]:
+    """Fetches only the given columns (1-based) of the rows starting from first_row"""
+
+    names = [column_number_to_excel_column_name(column) for column in columns]
+    log.info(f"fetch_columns: reading {','.join(names)} from {sheet_name} starting at {first_row}")
+    spreadsheets = authenticate_to_gs()
+    try:
+        result = execute(
+            spreadsheets.values().batchGet(
+                spreadsheetId=current_tenant().spreadsheet_id,
+                ranges=[f"{sheet_name}!{name}{first_row}:{name}" for name in names],
+                majorDimension="COLUMNS",
+                fields="valueRanges.values",
+                **READ_OPTIONS,
+            )
+        )
+    except:
+        return [], f"cannot read {sheet_name}: database unavailable"
+
+    # Each column comes as a single list, cut after its last non-empty cell
+    values = [(value_range.get("values") or [[]])[0] for value_range in result.get("valueRanges", [])]
+    return [list(row) for row in itertools.zip_longest(*values, fillvalue="")], ""
+
+
+def full_sync(sheet_name) -> tuple[list, str]:
+    """Re-downloads the whole sheet and resets its sync state"""
+
+    tenant = current_tenant()
+    values, err = fetch_range(sheet_name)
+    if err:
+        return [], err
+
+    now = time.time()
+    previous = tenant.sheets.get(sheet_name)
+    state = SheetState(
+        rows=values,
+        fingerprint=fingerprint_rows(values),
+        synced_at=now,
+        full_synced_at=now,
+    )
+    tenant.sheets[sheet_name] = state
+    if SNAPSHOTS and (not previous or previous.fingerprint != state.fingerprint):
+        SNAPSHOTS.replace(tenant.key(sheet_name), state.rows, state.fingerprint, state.synced_at)
+    return values, ""
+
+
+def tail_sync(sheet_name) -> tuple[list, str]:
+    """Fetches only the rows appended since the last sync.
+    The last known row is fetched as well and used as an anchor:
+    if it has changed (a row was deleted or edited) the whole sheet is re-downloaded"""
+
+    tenant = current_tenant()
+    state = tenant.sheets.get(sheet_name)
+    if state and not state.validated:
+        # Serve the snapshot while validate_snapshots() is running.
+        # Writes locating rows by number call validate_sheet() first
+        return state.rows, ""
+    full_resync_interval = GS_SETTINGS.get("sync.full_resync_interval", 600)
+    if not state or not state.rows or time.time() - state.full_synced_at > full_resync_interval:
+        return full_sync(sheet_name)
+
+    known = len(state.rows)
+    values, err = fetch_range(sheet_name, first_row=known)
+    if err:
+        return [], err
+
+    if not values or values[0] != state.rows[-1]:
+        log.info(f"tail_sync: {sheet_name} was changed, doing full resync")
+        return full_sync(sheet_name)
+
+    tail = values[1:]
+    state.synced_at = time.time()
+    if tail:
+        state.rows.extend(tail)
+        state.fingerprint = fingerprint_rows(tail, state.fingerprint)
+        if SNAPSHOTS:
+            SNAPSHOTS.append(tenant.key(sheet_name), known + 1, tail, state.fingerprint, state.synced_at)
+    log.info(f"tail_sync: {sheet_name} got {len(tail)} new rows, {len(state.rows)} in total")
+    return state.rows, ""
+
+
+def forget_row(sheet_name, row_number):
+    """Keeps the sync state in line with a row deleted by us"""
+
+    tenant = current_tenant()
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        if not state:
+            return
+        if row_number > len(state.rows):
+            tenant.sheets.pop(sheet_name, None)
+            return
+        del state.rows[row_number - 1]
+        state.fingerprint = fingerprint_rows(state.rows)
+        if SNAPSHOTS:
+            SNAPSHOTS.delete(tenant.key(sheet_name), row_number, state.fingerprint)
+
+
+def replace_row(sheet_name, row_number, new_data):
+    """Keeps the sync state in line with a row updated by us"""
+
+    tenant = current_tenant()
+    # Sheets returns empty cells as "" and trims the trailing ones
+    row = ["" if value is None else value for value in new_data]
+    while row and row[-1] == "":
+        row.pop()
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        if not state:
+            return
+        if row_number > len(state.rows):
+            tenant.sheets.pop(sheet_name, None)
+            return
+        state.rows[row_number - 1] = row
+        state.fingerprint = fingerprint_rows(state.rows)
+        if SNAPSHOTS:
+            SNAPSHOTS.update(tenant.key(sheet_name), row_number, row, state.fingerprint)
+
+
+def mark_edited(sheet_name):
+    """Tells the other workers about rows updated or deleted by us. Our known rows
+    have the change already, so they stay current unless another worker wrote in between"""
+
+    tenant = current_tenant()
+    version = SHARED.bump(tenant.key(sheet_name), edit=True)
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        if state and state.validated and state.version == version - 1:
+            state.version = version
+
+
+def load_snapshots():
+    """Opens the snapshot store and serves the stored sheets until validate_snapshots() is done"""
+    global SNAPSHOTS
+
+    if not GS_SETTINGS.get("snapshot.enabled", False):
+        return
+    SNAPSHOTS = SnapshotStore(GS_SETTINGS.snapshot.path)
+    for key, (rows, fingerprint, synced_at) in SNAPSHOTS.load().items():
+        tenant_name, _, sheet_name = key.partition(":")
+        if tenant_name not in TENANTS:
+            continue
+        if fingerprint_rows(rows) != fingerprint:
+            log.info(f"load_snapshots: snapshot of {key} is corrupted, skipping it")
+            continue
+        TENANTS[tenant_name].sheets[sheet_name] = SheetState(
+            rows=rows,
+            fingerprint=fingerprint,
+            synced_at=synced_at,
+            full_synced_at=synced_at,
+            validated=False,
+        )
+
+
+def validate_snapshots():
+    """Re-downloads the sheets loaded from the snapshot and replaces the stale ones.
+    Meant to be run in the background right after load_snapshots()"""
+
+    for tenant in TENANTS.values():
+        CURRENT_TENANT.set(tenant)
+        for sheet_name in list(tenant.sheets):
+            with tenant.lock(sheet_name):
+                state = tenant.sheets.get(sheet_name)
+                # A write may have validated it in the meantime
+                if not state or state.validated:
+                    continue
+                err = validate_sheet(sheet_name)
+                if err:
+                    # Make the next read re-download the sheet instead
+                    log.info(f"validate_snapshots: cannot validate {tenant.key(sheet_name)}: {err}")
+                    state.validated = True
+                    state.full_synced_at = 0.0
+                    continue
+                log.info(f"validate_snapshots: {tenant.key(sheet_name)} is up to date: {tenant.sheets[sheet_name].fingerprint == state.fingerprint}")
+
+
+def validate_sheet(sheet_name) -> str:
+    """Replaces the rows loaded from the snapshot with the current ones.
+    Row numbers taken from the snapshot may be stale, writes using them call this first"""
+
+    tenant = current_tenant()
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        if not state or state.validated:
+            return ""
+        version = SHARED.version(tenant.key(sheet_name))
+        _, err = full_sync(sheet_name)
+        if err:
+            return err
+        tenant.sheets[sheet_name].version = version
+        return ""
+
+
+def adopt_rows(sheet_name, shared: SharedRows):
+    """Takes over the rows another worker has published"""
+
+    tenant = current_tenant()
+    previous = tenant.sheets.get(sheet_name)
+    tenant.sheets[sheet_name] = SheetState(
+        rows=list(shared.rows),
+        fingerprint=shared.fingerprint,
+        synced_at=shared.synced_at,
+        full_synced_at=previous.full_synced_at if previous else shared.synced_at,
+        version=shared.version,
+    )
+    if SNAPSHOTS and (not previous or previous.fingerprint != shared.fingerprint):
+        SNAPSHOTS.replace(tenant.key(sheet_name), shared.rows, shared.fingerprint, shared.synced_at)
+
+
+def read_sheet(sheet_name, columns=None) -> tuple[list, str]:
+    """Function to read data from a sheet
+    return list of lists that represents spreadsheet
+    and error in case we cannot connect to a database.
+    Callers needing only some columns (1-based) name them and get only those"""
+
+    tenant = current_tenant()
+    if columns:
+        selection = ",".join(column_number_to_excel_column_name(column) for column in columns)
+    else:
+        selection = f"A:{column_number_to_excel_column_name(SHEET_NUM_COL[base_sheet_name(sheet_name)])}"
+    # Everybody opening the roster at once costs a single read, unless the sheet
+    # was written to since that read started
+    values, err = READS.do(
+        (tenant.key(sheet_name), selection),
+        SHARED.version(tenant.key(sheet_name)),
+        lambda: _read_sheet(sheet_name, columns),
+    )
+    # Handlers get their own copy, the known rows keep changing
+    return list(values), err
+
+
+def _read_sheet(sheet_name, columns=None) -> tuple[list, str]:
+    if not GS_SETTINGS.get("sync.incremental", True):
+        return fetch_range(sheet_name, columns=columns)
+
+    # The known rows are kept whole, they serve all the reads of the sheet
+    with current_tenant().lock(sheet_name):
+        values, err = sync_sheet(sheet_name)
+        if err:
+            return [], err
+        return project(values, columns) if columns else list(values), ""
+
+
+def sync_sheet(sheet_name) -> tuple[list, str]:
+    """Brings the known rows of the sheet up to date, from the shared store or from Sheets"""
+
+    tenant = current_tenant()
+    # Rows younger than max_age are served without asking Sheets,
+    # as long as no worker has written to the sheet since
+    max_age = GS_SETTINGS.get("shared.max_age", 0)
+    version = SHARED.version(tenant.key(sheet_name))
+    # Read after the version: an edit in between makes us resync once more, never less
+    edited = SHARED.edited(tenant.key(sheet_name))
+    state = tenant.sheets.get(sheet_name)
+    if state and state.validated and state.version == version and time.time() - state.synced_at <= max_age:
+        return state.rows, ""
+
+    shared = SHARED.get_rows(tenant.key(sheet_name))
+    if shared and shared.version == version and time.time() - shared.synced_at <= max_age:
+        adopt_rows(sheet_name, shared)
+        return tenant.sheets[sheet_name].rows, ""
+
+    if state and state.validated and state.version < edited:
+        # A row was updated or deleted since, possibly in the middle of the sheet
+        # where the tail anchor would not notice it
+        values, err = full_sync(sheet_name)
+    else:
+        values, err = tail_sync(sheet_name)
+    if err:
+        return [], err
+
+    state = tenant.sheets[sheet_name]
+    if state.validated:
+        state.version = version
+        SHARED.put_rows(tenant.key(sheet_name), SharedRows(version, state.rows, state.fingerprint, state.synced_at))
+    return values, ""
+
+
+def warm_sheet(sheet_name, horizon=0) -> tuple[bool, str]:
+    """Brings the sheet up to date ahead of traffic. Does the full resync now if it
+    would otherwise fall due within horizon seconds, in the middle of a user's request"""
+
+    tenant = current_tenant()
+    full_resync_interval = GS_SETTINGS.get("sync.full_resync_interval", 600)
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        if not state or not state.validated or time.time() + horizon - state.full_synced_at > full_resync_interval:
+            version = SHARED.version(tenant.key(sheet_name))
+            _, err = full_sync(sheet_name)
+            if err:
+                return False, err
+            state = tenant.sheets[sheet_name]
+            state.version = version
+            SHARED.put_rows(tenant.key(sheet_name), SharedRows(version, state.rows, state.fingerprint, state.synced_at))
+            return True, ""
+        _, err = sync_sheet(sheet_name)
+        if err:
+            return False, err
+    return True, ""
+
+
 def find_row_index(sheet_name, search_value, search_value_2=None) -> tuple[int|None, str]:
     """Finds the index of a first row containing search_value in a specified sheet.
     If search_value_2 is given, checks if that value is also in the row"""
 
     log.info(f"find_row_index: reading from {sheet_name} {search_value} {search_value_2}")
-    values, err = read_sheet(sheet_name)
+    # The keys are all we look at
+    values, err = read_sheet(sheet_name, columns=SHEET_KEY_COLS[base_sheet_name(sheet_name)])
     if err:
         return None, f"cannot find index from {sheet_name}: {err}"
 
@@ -103,17 +511,67 @@ def write_to_sheet(sheet_name, new_data) -> tuple[bool,str]:
     spreadsheets = authenticate_to_gs()
     try:
         request = spreadsheets.values().append(
-            spreadsheetId=GS_SETTINGS.google.spreadsheet_id,
+            spreadsheetId=current_tenant().spreadsheet_id,
             range=f"{sheet_name}!A:{last_column}",
             valueInputOption="RAW",
             body={"values": [new_data]},
         )
-        result = request.execute()
+        result = execute(request)
     except:
         return False, f"cannot write to {sheet_name}: database unavailable"
     
     if not result.get("updates", None):
         return False, f"cannot write to {sheet_name}"
+    SHARED.bump(current_tenant().key(sheet_name))
+    return True, ""
+
+
+def append_rows(sheet_name, rows) -> tuple[bool, str]:
+    """Appends many rows to the sheet in a single call"""
+
+    last_column = column_number_to_excel_column_name(SHEET_NUM_COL[base_sheet_name(sheet_name)])
+
+    log.info(f"append_rows: writing {len(rows)} rows to {sheet_name}")
+    spreadsheets = authenticate_to_gs()
+    try:
+        request = spreadsheets.values().append(
+            spreadsheetId=current_tenant().spreadsheet_id,
+            range=f"{sheet_name}!A:{last_column}",
+            valueInputOption="RAW",
+            body={"values": rows},
+        )
+        result = execute(request)
+    except:
+        return False, f"cannot write to {sheet_name}: database unavailable"
+
+    if not result.get("updates", None):
+        return False, f"cannot write to {sheet_name}"
+    SHARED.bump(current_tenant().key(sheet_name))
+    return True, ""
+
+
+def ensure_sheet(sheet_name) -> tuple[bool, str]:
+    """Creates the tab if the spreadsheet does not have it yet.
+    Asks Sheets only once per tab"""
+
+    tenant = current_tenant()
+    if sheet_name in tenant.tabs:
+        return True, ""
+    spreadsheets = authenticate_to_gs()
+    try:
+        result = execute(spreadsheets.get(spreadsheetId=tenant.spreadsheet_id, fields="sheets.properties.title"))
+        titles = [sheet["properties"]["title"] for sheet in result.get("sheets", [])]
+        if sheet_name not in titles:
+            log.info(f"ensure_sheet: creating {sheet_name}")
+            execute(spreadsheets.batchUpdate(
+                spreadsheetId=tenant.spreadsheet_id,
+                body={"requests": [{"addSheet": {"properties": {"title": sheet_name}}}]},
+            ))
+    except:
+        return False, f"cannot create {sheet_name}: database unavailable"
+    with tenant.guard:
+        tenant.tabs.update(titles)
+        tenant.tabs.add(sheet_name)
     return True, ""
 
 
@@ -152,6 +610,15 @@ def delete_row_by_value(sheet_name, search_value, search_value_2=None) -> tuple[
     """Searches for a row containing search_value (or both search_value and search_value_2 if provided) 
     in sheet_name and deletes the first one found"""
 
+    # The row number must not be shifted by another delete before we use it
+    with SHARED.lock(current_tenant().key(f"{sheet_name}:rows")):
+        return _delete_row_by_value(sheet_name, search_value, search_value_2)
+
+
+def _delete_row_by_value(sheet_name, search_value, search_value_2=None) -> tuple[bool, str]:
+    err = validate_sheet(sheet_name)
+    if err:
+        return False, f"cannot delete row from {sheet_name}: {err}"
     row_number, err = find_row_index(sheet_name, search_value, search_value_2)
     log.info(f"delete_row_by_value: deleting from {sheet_name} {row_number}")
     if err:
@@ -163,13 +630,13 @@ def delete_row_by_value(sheet_name, search_value, search_value_2=None) -> tuple[
     spreadsheets = authenticate_to_gs()
     try:
         request = spreadsheets.batchUpdate(
-            spreadsheetId=GS_SETTINGS.google.spreadsheet_id,
+            spreadsheetId=current_tenant().spreadsheet_id,
             body={
                 "requests": [
                     {
                         "deleteDimension": {
                             "range": {
-                                "sheetId": SHEET_IDS[sheet_name],
+                                "sheetId": current_tenant().sheet_ids[sheet_name],
                                 "dimension": "ROWS",
                                 "startIndex": row_number - 1,  # Convert to zero-based index
                                 "endIndex": row_number,
@@ -179,21 +646,106 @@ def delete_row_by_value(sheet_name, search_value, search_value_2=None) -> tuple[
                 ]
             },
         )
-        result = request.execute()
+        result = execute(request)
     except:
         return False, "cannot delete row from {sheet_name}: database unavailable"
     # TODO: result always exist, need to check specific content
     if not result:
         return False, "cannot delete row from {sheet_name}: wrong result"
     
+    forget_row(sheet_name, row_number)
+    mark_edited(sheet_name)
+    return True, ""
+
+
+def delete_rows(sheet_name, row_numbers) -> tuple[bool, str]:
+    """Deletes the given rows (1-based) in a single call.
+    The row numbers must come from rows read after validate_sheet()"""
+
+    # Bottom-up, so every deletion leaves the positions of the remaining ones intact
+    row_numbers = sorted(set(row_numbers), reverse=True)
+    log.info(f"delete_rows: deleting {len(row_numbers)} rows from {sheet_name}")
+    tenant = current_tenant()
+    spreadsheets = authenticate_to_gs()
+    try:
+        request = spreadsheets.batchUpdate(
+            spreadsheetId=tenant.spreadsheet_id,
+            body={
+                "requests": [
+                    {
+                        "deleteDimension": {
+                            "range": {
+                                "sheetId": tenant.sheet_ids[sheet_name],
+                                "dimension": "ROWS",
+                                "startIndex": row_number - 1,  # Convert to zero-based index
+                                "endIndex": row_number,
+                            }
+                        }
+                    }
+                    for row_number in row_numbers
+                ]
+            },
+        )
+        execute(request)
+    except:
+        return False, f"cannot delete rows from {sheet_name}: database unavailable"
+
+    for row_number in row_numbers:
+        forget_row(sheet_name, row_number)
+    mark_edited(sheet_name)
+    return True, ""
+
+
+def update_cells(sheet_name, column, values) -> tuple[bool, str]:
+    """Writes a single cell of the given column (1-based) in many rows with one call.
+    values maps row numbers (1-based) to the new cell values,
+    which must come from rows read after validate_sheet()"""
+
+    column_name = column_number_to_excel_column_name(column)
+    log.info(f"update_cells: updating {len(values)} cells of {sheet_name}!{column_name}")
+    tenant = current_tenant()
+    spreadsheets = authenticate_to_gs()
+    try:
+        request = spreadsheets.values().batchUpdate(
+            spreadsheetId=tenant.spreadsheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": [
+                    {"range": f"{sheet_name}!{column_name}{row_number}", "values": [[value]]}
+                    for row_number, value in values.items()
+                ],
+            },
+        )
+        execute(request)
+    except:
+        return False, f"cannot update cells in {sheet_name}: database unavailable"
+
+    with tenant.lock(sheet_name):
+        state = tenant.sheets.get(sheet_name)
+        for row_number, value in values.items():
+            if not state or row_number > len(state.rows):
+                continue
+            row = list(state.rows[row_number - 1])
+            row.extend([""] * (column - len(row)))
+            row[column - 1] = value
+            replace_row(sheet_name, row_number, row)
+    mark_edited(sheet_name)
     return True, ""
 
 
 def update_row_by_value(sheet_name, search_value, search_value_2, new_data) -> tuple[bool, str]:
     """Searches for a row containing search_value in sheet_name and updates the first one found with new_data"""
 
+    with SHARED.lock(current_tenant().key(f"{sheet_name}:rows")):
+        return _update_row_by_value(sheet_name, search_value, search_value_2, new_data)
+
+
+def _update_row_by_value(sheet_name, search_value, search_value_2, new_data) -> tuple[bool, str]:
     last_column = column_number_to_excel_column_name(len(new_data))
     spreadsheets = authenticate_to_gs()
+    err = validate_sheet(sheet_name)
+    if err:
+        return False, f"cannot update row in {sheet_name}: {err}"
     row_number, err = find_row_index(sheet_name, search_value, search_value_2)
     log.info(f"update_row_by_value: updating {sheet_name} {row_number}")
     if err:
@@ -206,12 +758,12 @@ def update_row_by_value(sheet_name, search_value, search_value_2, new_data) -> t
     
     try:
         request = spreadsheets.values().update(
-            spreadsheetId=GS_SETTINGS.google.spreadsheet_id,
+            spreadsheetId=current_tenant().spreadsheet_id,
             range=f"{sheet_name}!A{row_number}:{last_column}{row_number}",
             valueInputOption="RAW",
             body={"values": [new_data]},
         )
-        result = request.execute()
+        result = execute(request)
         log.info(f"update_row_by_value: result {result}")
     except:
         return False, f"cannot update row in {sheet_name}: database unavailable"
@@ -221,6 +773,8 @@ def update_row_by_value(sheet_name, search_value, search_value_2, new_data) -> t
         log.info(f"update_row_by_value: cannot update row in {sheet_name}: wrong result {result}")
         return False, f"cannot update row in {sheet_name}: wrong result"
     
+    replace_row(sheet_name, row_number, new_data)
+    mark_edited(sheet_name)
     return True, ""
 
 if __name__ == "__main__":
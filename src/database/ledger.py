@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+import database.gs as gs
+from models import Player, LedgerEntry
+
+log = logging.getLogger("database")
+
+# Column of Player.balance in the players sheet (1-based)
+BALANCE_COLUMN = 3
+
+# Error of record() for a user with no balance in the players sheet
+UNKNOWN_PLAYER = "unknown player"
+
+
+class BalanceLedger():
+    """Prepaid games of the players of one tenant.
+    Balance changes are recorded as ledger entries and applied in memory right away.
+    flush() writes the entries to the ledger sheet (the audit trail) and the net
+    change of every touched balance to the players sheet in a single call.
+    The balances are loaded again after a worker wrote to the players sheet or
+    ledger.max_age seconds passed, so balances edited in the sheet are picked up"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        # Balances as last seen in the players sheet, its version and when they were loaded
+        self.balances: dict[str, int]|None = None
+        self.version = -1
+        self.loaded_at = 0.0
+        # Entries not written to the players sheet yet, and their net change per player
+        self.pending: list[LedgerEntry] = []
+        self.deltas: dict[str, int] = {}
+        # How many of the pending entries are already in the ledger sheet
+        self.appended = 0
+
+
+    def _load(self) -> str:
+        players = Player.sheet_name()
+        version = gs.SHARED.version(gs.current_tenant().key(players))
+        max_age = gs.GS_SETTINGS.get("ledger.max_age", 60)
+        if self.balances is not None and version == self.version and time.time() - self.loaded_at <= max_age:
+            return ""
+        # A flush in progress sets the balances it wrote when done,
+        # loading them now would count its changes twice
+        if self.balances is not None and self.flushing.locked():
+            return ""
+
+        values, err = gs.read_sheet(players)
+        if err:
+            return f"cannot load balances: {err}"
+        self.balances = balances_from_rows(values)
+        self.version = version
+        self.loaded_at = time.time()
+        return ""
+
+
+    def balance(self, user_name: str) -> tuple[int|None, str]:
+        """Current balance including the changes not flushed yet"""
+
+        with self.lock:
+            err = self._load()
+            if err:
+                return None, err
+            if user_name not in self.balances:
+                return None, ""
+            return self.balances[user_name] + self.deltas.get(user_name, 0), ""
+
+
+    def record(self, user_name: str, delta: int, reason: str) -> tuple[bool, str]:
+        """Records a balance change. A decrement that would make the balance negative is refused,
+        a change for a user with no balance in the players sheet fails with UNKNOWN_PLAYER"""
+
+        with self.lock:
+            err = self._load()
+            if err:
+                return False, err
+            if user_name not in self.balances:
+                return False, UNKNOWN_PLAYER
+            current = self.balances[user_name] + self.deltas.get(user_name, 0)
+            if current + delta < 0:
+                return False, ""
+            self.pending.append(LedgerEntry(int(time.time()), user_name, delta, reason))
+            self.deltas[user_name] = self.deltas.get(user_name, 0) + delta
+            return True, ""
+
+
+    def replay(self, entries: list[LedgerEntry]) -> str:
+        """Applies entries that are in the ledger sheet but not in the balances (e.g. read back
+        with read_entries() after the players sheet was restored from a backup).
+        The next flush writes them to the players sheet without adding them to the ledger again"""
+
+        with self.flushing:
+            with self.lock:
+                err = self._load()
+                if err:
+                    return err
+                # The first `appended` pending entries are in the ledger sheet already
+                self.pending[:0] = entries
+                self.appended += len(entries)
+                for entry in entries:
+                    self.deltas[entry.user_name] = self.deltas.get(entry.user_name, 0) + entry.delta
+        return ""
+
+
+    def flush(self) -> tuple[int, str]:
+        """Writes the pending entries and the resulting balances. Returns the number of flushed entries"""
+
+        with self.flushing:
+            with self.lock:
+                entries = list(self.pending)
+                deltas = dict(self.deltas)
+                appended = self.appended
+            if not entries:
+                return 0, ""
+
+            # Audit trail first: a failure after this point is retried without duplicating entries
+            if appended < len(entries):
+                _, err = gs.ensure_sheet(LedgerEntry.sheet_name())
+                if err:
+                    return 0, err
+                _, err = gs.append_rows(LedgerEntry.sheet_name(), [list(e) for e in entries[appended:]])
+                if err:
+                    return 0, f"cannot write ledger: {err}"
+                with self.lock:
+                    self.appended = len(entries)
+
+            # Apply the net changes to the freshest balances, so edits made in the sheet
+            # and changes flushed by other workers are kept
+            players = Player.sheet_name()
+            with gs.SHARED.lock(gs.current_tenant().key(f"{players}:rows")):
+                err = gs.validate_sheet(players)
+                if err:
+                    return 0, f"cannot read balances: {err}"
+                # Our own write below bumps it, the balances are loaded once more after that
+                version = gs.SHARED.version(gs.current_tenant().key(players))
+                values, err = gs.read_sheet(players)
+                if err:
+                    return 0, f"cannot read balances: {err}"
+                balances = balances_from_rows(values)
+                updates = {}
+                for row_number, row in enumerate(values, start=1):
+                    if not row or not deltas.get(row[0]):
+                        continue
+                    if row[0] not in balances:
+                        # The entries are in the ledger sheet, the balance has to be fixed by hand
+                        log.info(f"flush: skipping {row[0]}, the balance in row {row_number} is not a number")
+                        continue
+                    updates[row_number] = balances[row[0]] + deltas[row[0]]
+                if updates:
+                    _, err = gs.update_cells(players, BALANCE_COLUMN, updates)
+                    if err:
+                        return 0, f"cannot write balances: {err}"
+
+            with self.lock:
+                self.pending = self.pending[len(entries):]
+                self.appended -= len(entries)
+                for user_name, delta in deltas.items():
+                    self.deltas[user_name] -= delta
+                    if user_name in balances:
+                        balances[user_name] += delta
+                    if not self.deltas[user_name]:
+                        del self.deltas[user_name]
+                self.balances = balances
+                self.version = version
+                self.loaded_at = time.time()
+
+        log.info(f"flush: {len(entries)} ledger entries, {len(updates)} balances updated")
+        return len(entries), ""
+
+
+def read_entries(since: int = 0) -> tuple[list[LedgerEntry], str]:
+    """Entries of the ledger sheet of the current tenant recorded at or after since"""
+
+    _, err = gs.ensure_sheet(LedgerEntry.sheet_name())
+    if err:
+        return [], f"cannot read ledger: {err}"
+    values, err = gs.read_sheet(LedgerEntry.sheet_name())
+    if err:
+        return [], f"cannot read ledger: {err}"
+    entries = []
+    for row in values:
+        try:
+            entry = LedgerEntry.from_list(row)
+        except (ValueError, TypeError) as e:
+            log.info(f"read_entries: skipping malformed entry {row}: {e}")
+            continue
+        if entry.created_at >= since:
+            entries.append(entry)
+    return entries, ""
+
+
+def balances_from_rows(values: list) -> dict[str, int]:
+    balances = {}
+    for row in values:
+        try:
+            balances[row[0]] = int(row[BALANCE_COLUMN - 1])
+        except (IndexError, ValueError):
+            continue
+    return balances
+
+
+# tenant name -> its ledger
+LEDGERS: dict[str, BalanceLedger] = {}
+LEDGERS_LOCK = threading.Lock()
+
+
+def current_ledger() -> BalanceLedger:
+    with LEDGERS_LOCK:
+        return LEDGERS.setdefault(gs.current_tenant().name, BalanceLedger())
+
+
+def flush_all() -> tuple[int, str]:
+    """Flushes the ledgers of all tenants"""
+
+    total = 0
+    errors = []
+    for tenant_name, ledger in list(LEDGERS.items()):
+        gs.CURRENT_TENANT.set(gs.TENANTS[tenant_name])
+        flushed, err = ledger.flush()
+        total += flushed
+        if err:
+            errors.append(f"{tenant_name}: {err}")
+    return total, "; ".join(errors)
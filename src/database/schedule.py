@@ -0,0 +1,118 @@
+import bisect
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+import database.gs as gs
+from models import Game
+
+log = logging.getLogger("database")
+
+
+@dataclass
+class GameDay:
+    """An upcoming game and what the handlers need to know about it"""
+    game_date: str
+    cap: int
+    price: int|None
+    # Registrations after this moment do not make it into the game for sure
+    deadline: datetime
+
+
+class GameCalendar():
+    """Games of one tenant indexed by date, loaded from the games sheet once
+    and again only after a worker wrote to it or max_age seconds passed
+    (the sheet is edited by hand as well).
+    The upcoming games are computed once per load and day"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = -1
+        self.loaded_at = 0.0
+        # game_date -> game, and the dates in order
+        self.games: dict[str, Game] = {}
+        self.dates: list[str] = []
+        # (today, count, default_cap, deadline_hours) -> upcoming games
+        self.upcoming_cache: dict[tuple, list[GameDay]] = {}
+
+
+    def _refresh(self) -> str:
+        tenant = gs.current_tenant()
+        version = gs.SHARED.version(tenant.key(Game.sheet_name()))
+        max_age = gs.GS_SETTINGS.get("calendar.max_age", 300)
+        if version == self.version and time.time() - self.loaded_at <= max_age:
+            return ""
+
+        values, err = gs.read_sheet(Game.sheet_name())
+        if err:
+            return f"cannot load games: {err}"
+        games = {}
+        for row in values:
+            try:
+                game = Game.from_list(row)
+                # Dates are compared as strings
+                datetime.strptime(game.game_date, "%Y-%m-%d")
+            except (ValueError, TypeError) as e:
+                log.info(f"calendar: skipping malformed game {row}: {e}")
+                continue
+            games[game.game_date] = game
+        self.games = games
+        self.dates = sorted(games)
+        self.version = version
+        self.loaded_at = time.time()
+        self.upcoming_cache = {}
+        return ""
+
+
+    def game(self, game_date: str) -> tuple[Game|None, str]:
+        with self.lock:
+            err = self._refresh()
+            if err:
+                return None, err
+            return self.games.get(game_date), ""
+
+
+    def upcoming(self, today: date, count: int, default_cap: int, deadline_hours: int) -> tuple[list[GameDay], str]:
+        """The next count games after today that players can join.
+        Games with cap 0 are skipped weeks and summarized games are over.
+        With no games planned in the sheet at all, the next Sundays are played"""
+
+        key = (today, count, default_cap, deadline_hours)
+        with self.lock:
+            err = self._refresh()
+            if err:
+                return [], err
+            if key in self.upcoming_cache:
+                return self.upcoming_cache[key], ""
+
+            after = today.strftime("%Y-%m-%d")
+            planned = [self.games[d] for d in self.dates[bisect.bisect_right(self.dates, after):]]
+            if not planned:
+                # Sunday is 6, today's game is not offered any more
+                first = today + timedelta(days=(6 - today.weekday() + 7) % 7 or 7)
+                planned = [Game(game_date=(first + timedelta(weeks=i)).strftime("%Y-%m-%d")) for i in range(count)]
+            days = []
+            for game in planned:
+                if game.cap == 0 or game.is_summarized == 1:
+                    continue
+                starts = datetime.strptime(game.game_date, "%Y-%m-%d")
+                days.append(GameDay(
+                    game_date=game.game_date,
+                    cap=game.cap or default_cap,
+                    price=game.price,
+                    deadline=starts - timedelta(hours=deadline_hours),
+                ))
+                if len(days) == count:
+                    break
+            self.upcoming_cache[key] = days
+            return days, ""
+
+
+CALENDARS: dict[str, GameCalendar] = {}
+CALENDARS_LOCK = threading.Lock()
+
+
+def current_calendar() -> GameCalendar:
+    with CALENDARS_LOCK:
+        return CALENDARS.setdefault(gs.current_tenant().name, GameCalendar())
@@ -0,0 +1,254 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Protocol
+
+
+@dataclass
+class SharedRows:
+    """A copy of a sheet published by one of the workers"""
+    version: int
+    rows: list
+    fingerprint: str
+    synced_at: float
+
+
+class SharedStore(Protocol):
+    """State shared between bot workers.
+    Every sheet has a version that is bumped on each write, so workers know
+    their local copy is stale. Writes other than appends (updates, deletes)
+    also record the version they bumped to: rows older than that cannot be
+    brought up to date by fetching the new rows at the end.
+    The latest synced rows are published for other workers to pick up without going to Sheets"""
+
+    def version(self, sheet: str) -> int:
+        raise NotImplementedError
+
+    def edited(self, sheet: str) -> int:
+        """Version of the last write that was not an append"""
+        raise NotImplementedError
+
+    def bump(self, sheet: str, edit: bool = False) -> int:
+        raise NotImplementedError
+
+    def get_rows(self, sheet: str) -> SharedRows|None:
+        raise NotImplementedError
+
+    def put_rows(self, sheet: str, rows: SharedRows):
+        raise NotImplementedError
+
+    def lock(self, name: str):
+        """Context manager holding a lock with the given name across all workers"""
+        raise NotImplementedError
+
+
+class LocalStore():
+    """Process-local store, used when there is a single worker"""
+
+    def __init__(self):
+        self.versions: dict[str, int] = {}
+        self.edits: dict[str, int] = {}
+        self.rows: dict[str, SharedRows] = {}
+        self.guard = threading.Lock()
+        self.locks: dict[str, threading.Lock] = {}
+
+    def version(self, sheet: str) -> int:
+        return self.versions.get(sheet, 0)
+
+    def edited(self, sheet: str) -> int:
+        return self.edits.get(sheet, 0)
+
+    def bump(self, sheet: str, edit: bool = False) -> int:
+        with self.guard:
+            self.versions[sheet] = self.versions.get(sheet, 0) + 1
+            if edit:
+                self.edits[sheet] = self.versions[sheet]
+            return self.versions[sheet]
+
+    def get_rows(self, sheet: str) -> SharedRows|None:
+        return self.rows.get(sheet)
+
+    def put_rows(self, sheet: str, rows: SharedRows):
+        self.rows[sheet] = rows
+
+    @contextmanager
+    def lock(self, name: str):
+        with self.guard:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock:
+            yield
+
+
+class SqliteStore():
+    """File-based store for several workers on the same host (and for tests)"""
+
+    def __init__(self, path: str, lock_timeout: float = 30):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.local = threading.local()
+        # token -> name of the locks held by this process, their leases are renewed until released
+        self.leases: dict[str, str] = {}
+        self.leases_guard = threading.Lock()
+        self.renewer: threading.Thread|None = None
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (sheet TEXT PRIMARY KEY, version INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS edits (sheet TEXT PRIMARY KEY, version INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "sheet TEXT PRIMARY KEY, version INTEGER, data TEXT, fingerprint TEXT, synced_at REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=self.lock_timeout)
+        return self.local.conn
+
+    def version(self, sheet: str) -> int:
+        row = self._conn().execute("SELECT version FROM versions WHERE sheet = ?", (sheet,)).fetchone()
+        return row[0] if row else 0
+
+    def edited(self, sheet: str) -> int:
+        row = self._conn().execute("SELECT version FROM edits WHERE sheet = ?", (sheet,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, sheet: str, edit: bool = False) -> int:
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO versions (sheet, version) VALUES (?, 1) "
+                "ON CONFLICT (sheet) DO UPDATE SET version = version + 1",
+                (sheet,),
+            )
+            version = conn.execute("SELECT version FROM versions WHERE sheet = ?", (sheet,)).fetchone()[0]
+            if edit:
+                # Same transaction, nobody sees the new version without the edit
+                conn.execute("INSERT OR REPLACE INTO edits (sheet, version) VALUES (?, ?)", (sheet, version))
+            return version
+
+    def get_rows(self, sheet: str) -> SharedRows|None:
+        row = self._conn().execute(
+            "SELECT version, data, fingerprint, synced_at FROM rows WHERE sheet = ?", (sheet,)
+        ).fetchone()
+        if not row:
+            return None
+        version, data, fingerprint, synced_at = row
+        return SharedRows(version, json.loads(data), fingerprint, synced_at)
+
+    def put_rows(self, sheet: str, rows: SharedRows):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rows (sheet, version, data, fingerprint, synced_at) VALUES (?, ?, ?, ?, ?)",
+                (sheet, rows.version, json.dumps(rows.rows), rows.fingerprint, rows.synced_at),
+            )
+
+    def _renew_leases(self):
+        """Keeps the locks held by this process from expiring while their holders run"""
+        while True:
+            time.sleep(self.lock_timeout / 3)
+            with self.leases_guard:
+                leases = list(self.leases.items())
+            for token, name in leases:
+                try:
+                    with self._conn() as conn:
+                        conn.execute(
+                            "UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?",
+                            (time.time() + self.lock_timeout, name, token),
+                        )
+                except sqlite3.Error:
+                    # Tried again on the next round, well before the lease runs out
+                    continue
+
+    @contextmanager
+    def lock(self, name: str):
+        # Every acquisition has its own token, so a holder never releases a lock taken after it
+        token = f"{os.getpid()}-{uuid.uuid4().hex}"
+        deadline = time.time() + self.lock_timeout
+        while True:
+            with self._conn() as conn:
+                # Locks of crashed workers expire
+                conn.execute("DELETE FROM locks WHERE name = ? AND expires_at < ?", (name, time.time()))
+                acquired = conn.execute(
+                    "INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (name, token, time.time() + self.lock_timeout),
+                ).rowcount
+            if acquired:
+                break
+            if time.time() > deadline:
+                raise TimeoutError(f"cannot acquire lock {name}")
+            time.sleep(0.05)
+        with self.leases_guard:
+            self.leases[token] = name
+            if not self.renewer:
+                self.renewer = threading.Thread(target=self._renew_leases, name="lease-renewer", daemon=True)
+                self.renewer.start()
+        try:
+            yield
+        finally:
+            with self.leases_guard:
+                self.leases.pop(token, None)
+            with self._conn() as conn:
+                conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, token))
+
+
+class RedisStore():
+    """Store backed by a Redis-compatible server, for workers on different hosts"""
+
+    def __init__(self, url: str, lock_timeout: float = 30, prefix: str = "plutarch"):
+        # Optional dependency, only needed for this backend
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.lock_timeout = lock_timeout
+        self.prefix = prefix
+
+    def version(self, sheet: str) -> int:
+        return int(self.client.get(f"{self.prefix}:version:{sheet}") or 0)
+
+    def edited(self, sheet: str) -> int:
+        return int(self.client.get(f"{self.prefix}:edited:{sheet}") or 0)
+
+    def bump(self, sheet: str, edit: bool = False) -> int:
+        if not edit:
+            return self.client.incr(f"{self.prefix}:version:{sheet}")
+        # Atomically, nobody sees the new version without the edit
+        return self.client.eval(
+            "local v = redis.call('INCR', KEYS[1]) redis.call('SET', KEYS[2], v) return v",
+            2, f"{self.prefix}:version:{sheet}", f"{self.prefix}:edited:{sheet}",
+        )
+
+    def get_rows(self, sheet: str) -> SharedRows|None:
+        data = self.client.get(f"{self.prefix}:rows:{sheet}")
+        if not data:
+            return None
+        return SharedRows(**json.loads(data))
+
+    def put_rows(self, sheet: str, rows: SharedRows):
+        self.client.set(f"{self.prefix}:rows:{sheet}", json.dumps(rows.__dict__))
+
+    @contextmanager
+    def lock(self, name: str):
+        lock = self.client.lock(f"{self.prefix}:lock:{name}", timeout=self.lock_timeout)
+        if not lock.acquire(blocking_timeout=self.lock_timeout):
+            raise TimeoutError(f"cannot acquire lock {name}")
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+def create_shared_store(settings) -> SharedStore:
+    """Creates the store configured in the [shared] section of the settings"""
+
+    backend = settings.get("shared.backend", "local")
+    lock_timeout = settings.get("shared.lock_timeout", 30)
+    if backend == "sqlite":
+        return SqliteStore(settings.shared.path, lock_timeout)
+    if backend == "redis":
+        return RedisStore(settings.shared.url, lock_timeout)
+    return LocalStore()
@@ -0,0 +1,94 @@
+import json
+import logging
+import sqlite3
+import threading
+
+
+class SnapshotStore():
+    """Local copy of the sheets kept in SQLite, so a restarted bot
+    does not have to re-download everything before answering"""
+
+    def __init__(self, path: str):
+
+        self.log = logging.getLogger("database")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sheets ("
+                "sheet TEXT PRIMARY KEY, fingerprint TEXT, synced_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "sheet TEXT, position INTEGER, data TEXT)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS rows_position ON rows (sheet, position)"
+            )
+
+
+    def load(self) -> dict[str, tuple[list, str, float]]:
+        """Returns rows, fingerprint and sync time of every stored sheet"""
+
+        result = {}
+        with self.lock:
+            sheets = self.conn.execute("SELECT sheet, fingerprint, synced_at FROM sheets").fetchall()
+            for sheet, fingerprint, synced_at in sheets:
+                rows = self.conn.execute(
+                    "SELECT data FROM rows WHERE sheet = ? ORDER BY position", (sheet,)
+                ).fetchall()
+                result[sheet] = ([json.loads(data) for data, in rows], fingerprint, synced_at)
+
+        self.log.info(f"snapshot: loaded {len(result)} sheets")
+        return result
+
+
+    def replace(self, sheet: str, rows: list, fingerprint: str, synced_at: float):
+        """Stores the whole sheet, dropping whatever was stored before"""
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM rows WHERE sheet = ?", (sheet,))
+            self.conn.executemany(
+                "INSERT INTO rows (sheet, position, data) VALUES (?, ?, ?)",
+                ((sheet, i, json.dumps(row)) for i, row in enumerate(rows, start=1)),
+            )
+            self._set_meta(sheet, fingerprint, synced_at)
+
+
+    def append(self, sheet: str, first_position: int, rows: list, fingerprint: str, synced_at: float):
+        """Stores rows appended to the sheet starting at first_position (1-based)"""
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO rows (sheet, position, data) VALUES (?, ?, ?)",
+                ((sheet, i, json.dumps(row)) for i, row in enumerate(rows, start=first_position)),
+            )
+            self._set_meta(sheet, fingerprint, synced_at)
+
+
+    def delete(self, sheet: str, position: int, fingerprint: str):
+        """Removes a row and shifts the following ones up, like Sheets does"""
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM rows WHERE sheet = ? AND position = ?", (sheet, position))
+            self.conn.execute(
+                "UPDATE rows SET position = position - 1 WHERE sheet = ? AND position > ?", (sheet, position)
+            )
+            self.conn.execute("UPDATE sheets SET fingerprint = ? WHERE sheet = ?", (fingerprint, sheet))
+
+
+    def update(self, sheet: str, position: int, row: list, fingerprint: str):
+        """Replaces a single row"""
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE rows SET data = ? WHERE sheet = ? AND position = ?", (json.dumps(row), sheet, position)
+            )
+            self.conn.execute("UPDATE sheets SET fingerprint = ? WHERE sheet = ?", (fingerprint, sheet))
+
+
+    def _set_meta(self, sheet: str, fingerprint: str, synced_at: float):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sheets (sheet, fingerprint, synced_at) VALUES (?, ?, ?)",
+            (sheet, fingerprint, synced_at),
+        )
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+SHEET_NAMES = ["players", "games", "registrations", "auctions"]
+
+
+@dataclass
+class Tenant:
+    """A group served by the bot: its spreadsheet, caches and usage of the Sheets API"""
+    name: str
+    spreadsheet_id: str
+    sheet_ids: dict[str, int]
+    quota_per_minute: int = 300
+    # Threads running the storage calls of this tenant, see executor()
+    threads: int = 8
+    # sheet_name -> SheetState of the incremental sync
+    sheets: dict = field(default_factory=dict)
+    # Tabs known to exist in the spreadsheet, see gs.ensure_sheet
+    tabs: set = field(default_factory=set)
+    # Start times of the Sheets calls made during the last minute
+    calls: deque = field(default_factory=deque)
+    total_calls: int = 0
+    # Size of the responses and time spent decoding them
+    received_bytes: int = 0
+    decode_time: float = 0.0
+    locks: dict = field(default_factory=dict)
+    guard: threading.Lock = field(default_factory=threading.Lock)
+    pool: ThreadPoolExecutor|None = None
+
+    def key(self, sheet_name: str) -> str:
+        """Name of the sheet in stores shared by all tenants"""
+        return f"{self.name}:{sheet_name}"
+
+    def lock(self, sheet_name: str) -> threading.RLock:
+        """Guards the sync state of the sheet against concurrent handlers"""
+        with self.guard:
+            return self.locks.setdefault(sheet_name, threading.RLock())
+
+    def executor(self) -> ThreadPoolExecutor:
+        """Threads of this tenant only. A tenant waiting for its quota holds
+        up its own calls, not the threads the other tenants run on"""
+        with self.guard:
+            if not self.pool:
+                self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=f"tenant-{self.name}")
+            return self.pool
+
+    def calls_last_minute(self) -> int:
+        while self.calls and self.calls[0] < time.time() - 60:
+            self.calls.popleft()
+        return len(self.calls)
+
+
+def tenant_from_settings(name: str, config, threads: int = 8) -> Tenant:
+    return Tenant(
+        name=name,
+        spreadsheet_id=config["spreadsheet_id"],
+        sheet_ids={sheet: config[f"{sheet}_sheet_id"] for sheet in SHEET_NAMES},
+        quota_per_minute=config.get("quota_per_minute", 300),
+        threads=config.get("threads", threads),
+    )
+
+
+def load_tenants(settings) -> tuple[Tenant, dict[str, Tenant], dict[int, Tenant]]:
+    """Reads the tenants from the settings.
+    Returns the default tenant (the [google] section), all tenants by name and tenants by chat id"""
+
+    threads = settings.get("scheduler.threads_per_tenant", 8)
+    default = tenant_from_settings("default", settings.google, threads)
+    by_name = {default.name: default}
+    by_chat = {}
+    for name, config in settings.get("tenants", {}).items():
+        tenant = tenant_from_settings(name, config, threads)
+        by_name[name] = tenant
+        for chat_id in config.get("chat_ids", []):
+            by_chat[int(chat_id)] = tenant
+    return default, by_name, by_chat
+
+
+class FairScheduler():
+    """Limits the number of concurrent Sheets calls and hands out the free
+    slots round-robin between tenants, so a busy tenant cannot starve the others.
+    A tenant over its per-minute quota waits until its oldest calls age out,
+    in the threads of its own executor (see Tenant.executor)"""
+
+    def __init__(self, max_concurrent: int = 4):
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.cond = threading.Condition()
+        # tenant name -> waiting tickets in arrival order
+        self.waiting: dict[str, deque] = {}
+        self.order: deque[str] = deque()
+        self.tenants: dict[str, Tenant] = {}
+
+    def _next(self):
+        """Returns the ticket that should run next"""
+        for name in self.order:
+            tenant = self.tenants[name]
+            if self.waiting[name] and tenant.calls_last_minute() < tenant.quota_per_minute:
+                return self.waiting[name][0]
+        return None
+
+    @contextmanager
+    def turn(self, tenant: Tenant):
+        ticket = object()
+        with self.cond:
+            if tenant.name not in self.waiting:
+                self.waiting[tenant.name] = deque()
+                self.order.append(tenant.name)
+                self.tenants[tenant.name] = tenant
+            self.waiting[tenant.name].append(ticket)
+            while self.running >= self.max_concurrent or self._next() is not ticket:
+                # Quotas free up with time, not only when a call ends
+                self.cond.wait(timeout=1)
+            self.waiting[tenant.name].popleft()
+            # The tenant that just got its turn goes to the back of the line
+            self.order.remove(tenant.name)
+            self.order.append(tenant.name)
+            self.running += 1
+            tenant.calls.append(time.time())
+            tenant.total_calls += 1
+            # Let the next in line check whether there is a free slot for it too
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
@@ -0,0 +1,247 @@
+"""In-memory fakes of Google Sheets and the Telegram Bot API, and the updates
+Telegram would send. Used by loadtest.py and the tests, so neither talks to real services"""
+
+import asyncio
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+# The fakes never talk to real services, but the settings have to be there
+os.environ.setdefault("PLUTARCH_GOOGLE__SPREADSHEET_ID", "loadtest")
+for sheet_id, sheet in enumerate(["players", "games", "registrations", "auctions"], start=1):
+    os.environ.setdefault(f"PLUTARCH_GOOGLE__{sheet.upper()}_SHEET_ID", f"@int {sheet_id}")
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import database.gs as gs
+
+BOT_ID = 100000
+TOKEN = f"{BOT_ID}:LOADTEST"
+CHAT_ID_BASE = 500000
+
+
+class FakeRequest():
+    """An executable request to the fake Sheets API"""
+
+    def __init__(self, sheets, action):
+        self.sheets = sheets
+        self.action = action
+        # Decodes the response, as in googleapiclient's HttpRequest
+        self.postproc = lambda resp, content: json.loads(content)
+
+    def execute(self):
+        # Storage calls run in threads, so a blocking sleep is what a real HTTP call costs
+        time.sleep(self.sheets.latency)
+        with self.sheets.lock:
+            self.sheets.calls += 1
+            content = json.dumps(self.action()).encode()
+        return self.postproc(None, content)
+
+
+class FakeSheets():
+    """In-memory stand-in for the `spreadsheets()` resource of the Sheets API"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.data: dict[str, list[list[str]]] = defaultdict(list)
+        self.titles_by_id = {sheet_id: sheet for sheet, sheet_id in gs.DEFAULT_TENANT.sheet_ids.items()}
+
+    @staticmethod
+    def _parse(a1_range: str) -> tuple[str, int, int|None]:
+        sheet, cells = a1_range.split("!")
+        start, _, end = cells.partition(":")
+        end = end or start
+        first_row = int(re.sub(r"[A-Z]", "", start) or 1)
+        last_row = re.sub(r"[A-Z]", "", end)
+        return sheet, first_row, int(last_row) if last_row else None
+
+    def _tab(self, sheet: str) -> list:
+        """Rows of the tab. As in Sheets, a range of a missing tab is an error"""
+        if sheet not in self.data:
+            raise ValueError(f"Unable to parse range: {sheet}")
+        return self.data[sheet]
+
+    @staticmethod
+    def _column(a1_range: str) -> int:
+        """0-based index of the first column of the range"""
+        letters = re.match(r"[A-Z]*", a1_range.split("!")[1]).group()
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - ord("A") + 1
+        return max(index - 1, 0)
+
+    def values(self):
+        return self
+
+    @staticmethod
+    def _render(cell, valueRenderOption=None, **kwargs):
+        return cell if valueRenderOption == "UNFORMATTED_VALUE" else str(cell)
+
+    @staticmethod
+    def _trim(cells: list) -> list:
+        """As in Sheets, trailing empty cells are not returned"""
+        while cells and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    def get(self, spreadsheetId, range=None, fields=None, **kwargs):
+        if range is None:
+            return FakeRequest(self, lambda: {"sheets": [{"properties": {"title": title}} for title in self.data]})
+
+        def action():
+            sheet, first_row, last_row = self._parse(range)
+            rows = [self._trim([self._render(cell, **kwargs) for cell in row]) for row in self._tab(sheet)[first_row - 1:last_row]]
+            return {"values": rows} if rows else {}
+        return FakeRequest(self, action)
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension="ROWS", fields=None, **kwargs):
+        def action():
+            value_ranges = []
+            for a1_range in ranges:
+                sheet, first_row, last_row = self._parse(a1_range)
+                column = self._column(a1_range)
+                cells = self._trim([self._render(row[column], **kwargs) if len(row) > column else "" for row in self._tab(sheet)[first_row - 1:last_row]])
+                value_ranges.append({"values": [cells]} if cells else {})
+            return {"valueRanges": value_ranges}
+        return FakeRequest(self, action)
+
+    def append(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        def action():
+            sheet, _, _ = self._parse(range)
+            self._tab(sheet).extend([["" if cell is None else cell for cell in row] for row in body["values"]])
+            return {"updates": {"updatedRows": len(body["values"])}}
+        return FakeRequest(self, action)
+
+    def update(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        def action():
+            sheet, first_row, _ = self._parse(range)
+            self._tab(sheet)[first_row - 1] = ["" if cell is None else cell for cell in body["values"][0]]
+            return {"updatedRows": 1}
+        return FakeRequest(self, action)
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def action():
+            for request in body.get("requests", []):
+                if "addSheet" in request:
+                    self.data[request["addSheet"]["properties"]["title"]]
+                if "deleteDimension" in request:
+                    cells = request["deleteDimension"]["range"]
+                    del self.data[self.titles_by_id[cells["sheetId"]]][cells["startIndex"]:cells["endIndex"]]
+            for update in body.get("data", []):
+                sheet, first_row, _ = self._parse(update["range"])
+                first_column = self._column(update["range"])
+                for i, values in enumerate(update["values"]):
+                    row = self._tab(sheet)[first_row - 1 + i]
+                    row.extend([""] * (first_column + len(values) - len(row)))
+                    row[first_column:first_column + len(values)] = values
+            return {"replies": []}
+        return FakeRequest(self, action)
+
+
+class FakeBotApi(BaseRequest):
+    """Answers the Bot API calls of the Application without any network"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.message_ids = itertools.count(1)
+        # chat_id -> the last message sent there, users press the buttons of that one
+        self.last_message: dict[int, int] = {}
+        # chat_id -> texts of the messages sent or edited there
+        self.texts: dict[int, list[str]] = defaultdict(list)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs) -> tuple[int, bytes]:
+        await asyncio.sleep(self.latency)
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        bot = {"id": BOT_ID, "is_bot": True, "first_name": "Plutarch", "username": "plutarch_bot"}
+
+        if endpoint == "getMe":
+            result = bot
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id", CHAT_ID_BASE))
+            message_id = int(params.get("message_id", 0)) or next(self.message_ids)
+            if endpoint == "sendMessage":
+                self.last_message[chat_id] = message_id
+            self.texts[chat_id].append(params.get("text", ""))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": bot,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# Telegram numbers updates across all users, sessions of the same user included
+UPDATE_IDS = itertools.count(1)
+
+
+class Traffic():
+    """Builds updates as Telegram would send them for a single user"""
+
+    def __init__(self, application, user_number: int):
+        self.application = application
+        self.user = {
+            "id": CHAT_ID_BASE + user_number,
+            "is_bot": False,
+            "first_name": f"Load{user_number}",
+            "username": f"loaduser{user_number}",
+        }
+        self.chat = {"id": self.user["id"], "type": "private"}
+        self.update_ids = UPDATE_IDS
+
+    def command(self, text: str) -> Update:
+        data = {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.update_ids),
+                "date": int(time.time()),
+                "chat": self.chat,
+                "from": self.user,
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+            },
+        }
+        return Update.de_json(data, self.application.bot)
+
+    def button(self, callback_data: str) -> Update:
+        update_id = next(self.update_ids)
+        data = {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self.user,
+                "chat_instance": str(self.chat["id"]),
+                "data": callback_data,
+                "message": {
+                    "message_id": self.application.bot.request.last_message.get(self.chat["id"], update_id),
+                    "date": int(time.time()),
+                    "chat": self.chat,
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "Plutarch"},
+                    "text": "...",
+                },
+            },
+        }
+        return Update.de_json(data, self.application.bot)
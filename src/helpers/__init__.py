@@ -1,4 +1,5 @@
 """
 Collection of helper functions
 """
-from .helpers import get_this_sunday, get_next_sunday
\ No newline at end of file
+from .helpers import get_this_sunday, get_next_sunday, next_peak
+from .profiling import timed, sample_loop_lag, SamplingProfiler, profile_report
\ No newline at end of file
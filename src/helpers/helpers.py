@@ -11,4 +11,23 @@ def get_next_sunday():
     today = datetime.today()
     days_ahead = (6 - today.weekday() + 7) % 7  # Next Sunday
     next_sunday = today + timedelta(days=days_ahead)
-    return next_sunday + timedelta(weeks=1)  # Add 2 weeks
\ No newline at end of file
+    return next_sunday + timedelta(weeks=1)  # Add 2 weeks
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def next_peak(windows: list[str], now: datetime) -> tuple[datetime, datetime]|None:
+    """Returns the start and the end of the current or the next weekly window.
+    Windows look like "Sun 08:00-10:00", in local time"""
+    peaks = []
+    for window in windows:
+        day, hours = window.split()
+        start, end = (datetime.strptime(x, "%H:%M").time() for x in hours.split("-"))
+        days_ahead = (WEEKDAYS.index(day[:3].lower()) - now.weekday() + 7) % 7
+        for week in (-1, 0, 1):
+            date = (now + timedelta(days=days_ahead + 7 * week)).date()
+            peak_start = datetime.combine(date, start)
+            peak_end = datetime.combine(date, end)
+            if peak_end <= peak_start:  # Ends after midnight
+                peak_end += timedelta(days=1)
+            if peak_end > now:
+                peaks.append((peak_start, peak_end))
+    return min(peaks) if peaks else None
@@ -0,0 +1,118 @@
+import asyncio
+import functools
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+# name -> (finished at, duration) of the latest calls
+HANDLER_TIMINGS: dict[str, deque] = defaultdict(lambda: deque(maxlen=1000))
+# (sampled at, lag) of the event loop
+LOOP_LAG: deque = deque(maxlen=1000)
+
+# Innermost functions of a thread that has nothing to do (event loop select, idle thread pool workers)
+IDLE_FUNCTIONS = {"select", "wait", "_worker"}
+
+
+def timed(func):
+    """Records the duration of every call of a handler or a Plutarch method.
+    Costs two clock reads per call, so it stays on all the time"""
+
+    name = func.__qualname__
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                HANDLER_TIMINGS[name].append((time.time(), time.perf_counter() - started))
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            HANDLER_TIMINGS[name].append((time.time(), time.perf_counter() - started))
+    return wrapper
+
+
+async def sample_loop_lag(interval: float = 0.5):
+    """Measures how late the event loop wakes us up, i.e. how long something blocked it"""
+
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.append((time.time(), time.perf_counter() - started - interval))
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of all busy threads (event loop and storage calls alike)
+    at a fixed interval. Does nothing unless it is started"""
+
+    def __init__(self, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.self_counts: Counter = Counter()
+        self.total_counts: Counter = Counter()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                self.samples += 1
+                leaf = True
+                seen = set()
+                while frame:
+                    code = frame.f_code
+                    function = f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+                    if leaf:
+                        self.self_counts[function] += 1
+                        leaf = False
+                    if function not in seen:
+                        self.total_counts[function] += 1
+                        seen.add(function)
+                    frame = frame.f_back
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def percentile(values: list[float], p: int) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def profile_report(profiler: SamplingProfiler, since: float, top: int = 30) -> str:
+    """Handler latencies, event loop lag and the hottest functions since the given time"""
+
+    lines = ["Handler latency, ms", f"{'handler':<40}{'calls':>7}{'mean':>9}{'p95':>9}{'max':>9}"]
+    for name, timings in sorted(HANDLER_TIMINGS.items()):
+        durations = [duration * 1000 for finished_at, duration in list(timings) if finished_at >= since]
+        if not durations:
+            continue
+        lines.append(
+            f"{name:<40}{len(durations):>7}{sum(durations) / len(durations):>9.1f}"
+            f"{percentile(durations, 95):>9.1f}{max(durations):>9.1f}"
+        )
+
+    lags = [lag * 1000 for sampled_at, lag in list(LOOP_LAG) if sampled_at >= since]
+    if lags:
+        lines.append("")
+        lines.append(f"Event loop lag, ms: mean {sum(lags) / len(lags):.1f}, p95 {percentile(lags, 95):.1f}, max {max(lags):.1f}")
+
+    samples = max(profiler.samples, 1)
+    for title, counts in (("cumulative", profiler.total_counts), ("self", profiler.self_counts)):
+        lines.append("")
+        lines.append(f"Top functions by {title} samples ({profiler.samples} samples in total)")
+        for function, count in counts.most_common(top):
+            lines.append(f"{count:>8} {count * 100 / samples:>6.1f}%  {function}")
+
+    return "\n".join(lines)
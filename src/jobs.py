@@ -0,0 +1,165 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from telegram import Message
+from telegram.error import TelegramError, RetryAfter
+from models import AvailableSlot, Registration
+from plutarch import Plutarch
+
+log = logging.getLogger("jobs")
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+@dataclass
+class Job:
+    """A settlement of one game running in the background"""
+    id: str
+    game_date: str
+    # Lock key of the game, unique across tenants
+    key: str
+    status: str = RUNNING
+    total: int = 0
+    # "buyer link" of every settled player, in roster order
+    lines: list[str] = field(default_factory=list)
+    resumed: int = 0
+    error: str = ""
+    cancelled: bool = False
+    task: asyncio.Task|None = None
+
+
+class Settlements():
+    """Runs /summarize as background jobs. The progress is streamed to the admin's
+    message, no more often than edit_interval seconds. Players are settled one by
+    one, each of them checkpointed by the auction row collect_money writes, so a
+    job that failed or was cancelled is resumed by running it again.
+    A failing player is retried a few times before the job gives up"""
+
+    def __init__(self, plutarch: Plutarch, edit_interval: float = 2, retries: int = 2, retry_delay: float = 5, keep: int = 20):
+        self.plutarch = plutarch
+        self.edit_interval = edit_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.keep = keep
+        self.ids = itertools.count(1)
+        # job id -> job, finished ones included
+        self.jobs: dict[str, Job] = {}
+
+
+    def start(self, game_date: str, key: str, message: Message) -> tuple[Job, bool]:
+        """Starts settling the game, the progress goes to the message.
+        Returns the job and False if the game is being settled already"""
+
+        for job in self.jobs.values():
+            if job.key == key and job.status == RUNNING:
+                return job, False
+        # Finished jobs are kept around for a while for /cancel to tell about them
+        for job_id in [job.id for job in self.jobs.values() if job.status != RUNNING][:-self.keep or None]:
+            del self.jobs[job_id]
+        job = Job(id=str(next(self.ids)), game_date=game_date, key=key)
+        self.jobs[job.id] = job
+        # Not Application.create_task: stopping the application waits for those to finish.
+        # The task inherits the tenant of the handler
+        job.task = asyncio.create_task(self._run(job, message))
+        return job, True
+
+
+    def cancel(self, job_id: str) -> Job|None:
+        """Stops the job after the player being settled now"""
+
+        job = self.jobs.get(job_id)
+        if job and job.status == RUNNING:
+            job.cancelled = True
+        return job
+
+
+    def stop(self):
+        for job in self.jobs.values():
+            if job.task:
+                job.task.cancel()
+
+
+    def text(self, job: Job) -> str:
+        text = f"Let's see who pays whom for on {job.game_date} (job {job.id})\n"
+        if job.resumed:
+            text += f"Resuming, {job.resumed} players were settled before\n"
+        text += "Current list is:\n"
+        text += "".join(f"{line}\n" for line in job.lines)
+        if job.status == RUNNING:
+            text += f"{len(job.lines)}/{job.total} done, /cancel {job.id} to stop\n"
+        elif job.status == FAILED:
+            text += f"Stopped at {len(job.lines)}/{job.total}: {job.error}. Run /summarize {job.game_date} again to resume\n"
+        elif job.status == CANCELLED:
+            text += f"Cancelled at {len(job.lines)}/{job.total}. Run /summarize {job.game_date} again to resume\n"
+        return text
+
+
+    async def _edit(self, job: Job, message: Message):
+        try:
+            await message.edit_text(text=self.text(job), parse_mode="HTML")
+        except RetryAfter as e:
+            # Progress is not worth waiting for, the next edit shows it
+            log.info(f"settlement {job.id}: edits are rate limited for {e.retry_after}s")
+        except TelegramError as e:
+            log.info(f"settlement {job.id}: cannot edit the progress: {e}")
+
+
+    async def _settle(self, job: Job, registration: Registration) -> tuple[AvailableSlot|None, str]:
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * attempt)
+            player, err = await self.plutarch.db.run(self.plutarch.get_player, registration.user_name)
+            if not err and not player:
+                return None, f"{registration.user_name} is not a player"
+            if not err:
+                slot, err = await self.plutarch.db.run(self.plutarch.collect_money, player, registration)
+                if not err:
+                    return slot, ""
+            log.info(f"settlement {job.id}: attempt {attempt + 1} for {registration.user_name} failed: {err}")
+        return None, err
+
+
+    async def _run(self, job: Job, message: Message):
+        try:
+            await self._settle_all(job, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.info(f"settlement {job.id}: {e}")
+            job.status, job.error = FAILED, "something went wrong"
+        # All the balances spent are written in one go
+        _, err = await asyncio.to_thread(self.plutarch.flush_balances)
+        if err and job.status == DONE:
+            job.lines.append("Balances are not saved yet, I will retry later")
+        await self._edit(job, message)
+
+
+    async def _settle_all(self, job: Job, message: Message):
+        participants, settled, err = await self.plutarch.db.run(self.plutarch.settlement, job.game_date)
+        if err:
+            job.status, job.error = FAILED, err
+            return
+        job.total = len(participants)
+        edited_at = 0.0
+        for registration in participants:
+            if job.cancelled:
+                job.status = CANCELLED
+                return
+            slot = settled.get(registration.user_name)
+            if slot:
+                job.resumed += 1
+            else:
+                slot, err = await self._settle(job, registration)
+                if err:
+                    job.status, job.error = FAILED, f"cannot settle {registration.user_name}, {err}"
+                    return
+            job.lines.append(f"{slot.buyer_user_name} {slot.tikkie_link}")
+            if time.monotonic() - edited_at >= self.edit_interval:
+                edited_at = time.monotonic()
+                await self._edit(job, message)
+        job.status = DONE
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Offline load test of the bot.
+
+Builds the real Application from main.py against a fake Bot API and an
+in-memory fake of Google Sheets, then replays synthetic traffic: users
+arrive at a given rate and go through /start -> "Join The Games" ->
+join_game:<date>, look at the roster or leave a game they joined.
+Reports throughput, latency percentiles per conversation step,
+event loop lag and memory growth.
+
+Usage:
+$ python loadtest.py --users 300 --rate 20 --sheets-latency 150
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import random
+import resource
+import statistics
+import time
+from collections import defaultdict
+
+# Sets the settings the storage needs, so it goes before the bot
+from fakes import FakeSheets, FakeBotApi, Traffic, TOKEN
+from telegram import Update
+
+import database.gs as gs
+import main
+from helpers import get_this_sunday, get_next_sunday
+
+log = logging.getLogger("loadtest")
+
+
+class Stats():
+    """Latencies per conversation step, errors and event loop lag"""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors = 0
+        self.loop_lag: list[float] = []
+
+    def report(self, elapsed: float):
+        steps = sum(len(v) for v in self.latencies.values())
+        lines = [f"{steps} steps in {elapsed:.1f}s: {steps / elapsed:.1f} steps/s, {self.errors} errors", ""]
+        lines.append(f"{'step':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for step, values in sorted(self.latencies.items()):
+            lines.append(
+                f"{step:<20}{len(values):>7}"
+                f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}"
+                f"{percentile(values, 99):>10.1f}{max(values) * 1000:>10.1f}"
+            )
+        if self.loop_lag:
+            lines.append("")
+            lines.append(
+                f"event loop lag: mean {statistics.mean(self.loop_lag) * 1000:.1f} ms, "
+                f"p99 {percentile(self.loop_lag, 99):.1f} ms, max {max(self.loop_lag) * 1000:.1f} ms"
+            )
+        return "\n".join(lines)
+
+
+def percentile(values: list[float], p: int) -> float:
+    """Returns the p-th percentile of the values in milliseconds"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+    return ordered[index] * 1000
+
+
+def memory_kb() -> int:
+    """Current resident memory of the process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+
+
+async def step(application, stats: Stats, name: str, update: Update):
+    started = time.perf_counter()
+    await application.process_update(update)
+    stats.latencies[name].append(time.perf_counter() - started)
+
+
+async def user_session(application, stats: Stats, user_number: int, joined: list[int], think_time: float, mix: dict[str, float]):
+    """Plays a single user: join a game, look at the roster or leave a game joined before"""
+
+    traffic = Traffic(application, user_number)
+    scenario = random.choices(list(mix), weights=list(mix.values()))[0]
+    game_date = get_this_sunday().strftime("%Y-%m-%d")
+
+    if scenario == "leave" and joined:
+        # Someone who joined before comes back to leave
+        traffic = Traffic(application, joined.pop(random.randrange(len(joined))))
+        await step(application, stats, "/start", traffic.command("/start"))
+        await asyncio.sleep(random.expovariate(1 / think_time))
+        await step(application, stats, "leave_the_games", traffic.button("leave_the_games"))
+        await asyncio.sleep(random.expovariate(1 / think_time))
+        await step(application, stats, "leave_game", traffic.button(f"leave_game:{game_date}"))
+        return
+
+    await step(application, stats, "/start", traffic.command("/start"))
+    await asyncio.sleep(random.expovariate(1 / think_time))
+    if scenario == "roster":
+        await step(application, stats, "see_the_roster", traffic.button("see_the_roster"))
+        return
+    await step(application, stats, "join_the_games", traffic.button("join_the_games"))
+    await asyncio.sleep(random.expovariate(1 / think_time))
+    await step(application, stats, "join_game", traffic.button(f"join_game:{game_date}"))
+    joined.append(user_number)
+
+
+async def sample_loop_lag(stats: Stats, interval: float = 0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(time.perf_counter() - started - interval)
+
+
+async def run(args) -> str:
+    sheets = FakeSheets(latency=args.sheets_latency / 1000)
+    gs.authenticate_to_gs = lambda: sheets
+    for sheet in gs.DEFAULT_TENANT.sheet_ids:
+        sheets.data[sheet] = []
+    if args.quota_per_minute:
+        gs.DEFAULT_TENANT.quota_per_minute = args.quota_per_minute
+    for i in range(args.users):
+        sheets.data["players"].append([f"@loaduser{i}", f"Load {i}", random.randint(0, 5), 1, random.randint(1, 3)])
+    for game in (get_this_sunday(), get_next_sunday()):
+        sheets.data["games"].append([game.strftime("%Y-%m-%d"), 14, 10, 0])
+
+    application = main.build_application(
+        TOKEN, request=FakeBotApi(args.bot_latency / 1000), get_updates_request=FakeBotApi(0)
+    )
+    stats = Stats()
+
+    async def count_error(update, context):
+        stats.errors += 1
+        log.warning(f"handler failed: {context.error!r}")
+    application.add_error_handler(count_error)
+
+    mix = {"join": args.join, "roster": args.roster, "leave": args.leave}
+    joined: list[int] = []
+    await application.initialize()
+    # post_init only runs with run_polling, start what the harness needs by hand
+    main.notifier.start(application)
+    gc.collect()
+    memory_before = memory_kb()
+    lag_sampler = asyncio.create_task(sample_loop_lag(stats))
+
+    started = time.perf_counter()
+    sessions = []
+    for user_number in range(args.users):
+        sessions.append(asyncio.create_task(
+            user_session(application, stats, user_number, joined, args.think_time, mix)
+        ))
+        # Poisson arrivals
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - started
+    await main.notifier.queue.join()
+
+    lag_sampler.cancel()
+    await application.shutdown()
+    gc.collect()
+    memory_after = memory_kb()
+
+    report = [stats.report(elapsed)]
+    report.append(f"memory: {memory_before} KB -> {memory_after} KB ({memory_after - memory_before:+} KB)")
+    report.append(f"Sheets API calls: {sheets.calls}, Bot API calls: {application.bot.request.calls}")
+    tenants = gs.TENANTS.values()
+    received = sum(tenant.received_bytes for tenant in tenants)
+    decoding = sum(tenant.decode_time for tenant in tenants)
+    report.append(f"Sheets responses: {received / 1024:.1f} KB, {decoding * 1000:.1f} ms decoding")
+    report.append(f"notices: {main.notifier.sent} sent, {main.notifier.dropped} dropped")
+    return "\n".join(report)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay synthetic Telegram traffic against the bot")
+    parser.add_argument("--users", type=int, default=200, help="number of user sessions")
+    parser.add_argument("--rate", type=float, default=20, help="new users per second")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean pause between a user's clicks, seconds")
+    parser.add_argument("--sheets-latency", type=float, default=150, help="latency of a Sheets API call, ms")
+    parser.add_argument("--bot-latency", type=float, default=50, help="latency of a Bot API call, ms")
+    parser.add_argument("--join", type=float, default=0.6, help="share of users joining a game")
+    parser.add_argument("--roster", type=float, default=0.3, help="share of users looking at the roster")
+    parser.add_argument("--leave", type=float, default=0.1, help="share of users leaving a game they joined")
+    parser.add_argument("--quota-per-minute", type=int, default=None, help="override the Sheets quota of the tenant")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    # Storage logs every call, which would dominate the run
+    logging.getLogger().setLevel(logging.WARNING)
+    print(asyncio.run(run(args)))
@@ -15,19 +15,29 @@ Send /start to initiate the conversation.
 Press Ctrl-C on the command line to stop the bot.
 """
 
+import asyncio
+import html
+import io
 import logging
+import time
 from plutarch import Plutarch
+from notifications import Notifier
+from conversations import ConversationSweeper
+from jobs import Settlements
+from persistence import SqlitePersistence
 from dynaconf import Dynaconf
-from datetime import datetime
+from datetime import datetime, timedelta
 from models import Priorities, BotStorage
-from helpers import get_this_sunday, get_next_sunday
+from helpers import get_this_sunday, next_peak, timed, sample_loop_lag, SamplingProfiler, profile_report
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
 )
 
 # Enable loggings
@@ -47,8 +57,42 @@ settings = Dynaconf(
     sysenv_fallback=True,
 )
 
+# Tells players about roster changes that concern them, without holding any handler
+notifier = Notifier(
+    workers=settings.get("notifications.workers", 4),
+    global_rate=settings.get("notifications.global_rate", 25),
+    chat_rate=settings.get("notifications.chat_rate", 1),
+)
+plutarch.notify = notifier.notify
+
+# Ends idle conversations and removes their keyboards
+sweeper = ConversationSweeper(
+    timeout=settings.get("conversations.timeout", 900),
+    interval=settings.get("conversations.sweep_interval", 60),
+    max_conversations=settings.get("conversations.max_conversations", 10000),
+    edit_batch=settings.get("conversations.edit_batch", 20),
+    edit_rate=settings.get("conversations.edit_rate", 5),
+)
+
+# Settles games in the background, see /summarize
+settlements = Settlements(
+    plutarch,
+    edit_interval=settings.get("summarize.edit_interval", 2),
+    retries=settings.get("summarize.retries", 2),
+    retry_delay=settings.get("summarize.retry_delay", 5),
+)
+
 START_ROUTES, HELPERS = range(2)
 
+ADMIN_USER_NAME = "@kchestnov"
+
+# The profiler of the running /profile window, if any
+profiler: SamplingProfiler|None = None
+
+# Tasks running for as long as the bot does, cancelled in post_stop.
+# Application.create_task is not used for them: stopping the application waits for those to finish
+background_tasks: list[asyncio.Task] = []
+
 # 3 horizontally splitted buttons
 START_REPLY_MARKUP = [
             [InlineKeyboardButton("Join The Games", callback_data="join_the_games")],
@@ -56,17 +100,29 @@ START_REPLY_MARKUP = [
             [InlineKeyboardButton("Show The Roster", callback_data="see_the_roster")],
     ]
 
+@timed
+async def use_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs before any other handler: serves the update from the spreadsheet of its chat"""
+    plutarch.db.use_tenant(update.effective_chat.id if update.effective_chat else None)
+
+
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send message on `/start`."""
     # Get user that sent /start and log his name
     # Store it in a context
     user_name = update.message.from_user.name
-    context.bot_data[BotStorage.USER_ID] = user_name
+    context.user_data[BotStorage.USER_ID] = user_name
+    # Private chats have the id of the user, this is where notices go
+    notifier.remember(user_name, update.message.from_user.id)
     # HTML-formatted header of the reply
     reply = [f"Greetings <b>{user_name}</b>!"]
-    # Check if player is added to the list of players 
-    player, err = plutarch.get_player(user_name)
-    context.bot_data[BotStorage.PLAYER] = player
+    # Check if player is added to the list of players, the games are looked up meanwhile
+    (player, err), (games, games_err) = await asyncio.gather(
+        plutarch.db.run(plutarch.get_player, user_name),
+        plutarch.db.run(plutarch.upcoming_games, settings.get("calendar.upcoming", 2)),
+    )
+    context.user_data[BotStorage.PLAYER] = player
     # If we cannot get details from the DB - return
     if err:
         reply.append(f"I cannot foresee your future now - please come later")
@@ -81,13 +137,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
     
     # Check if the user already registered
-    upcoming_games = [
-        get_this_sunday().strftime("%Y-%m-%d"),
-        get_next_sunday().strftime("%Y-%m-%d")
-    ]
-    context.bot_data[BotStorage.UPCOMING_GAME_DATES] = upcoming_games
+    if games_err:
+        reply.append(f"I cannot foresee your future now - please come later")
+        text = "\n".join(reply)
+        await update.message.reply_text(text=text, parse_mode="HTML")
+        return ConversationHandler.END
+    if not games:
+        reply.append(f"No games are planned yet, come back later")
+        text = "\n".join(reply)
+        await update.message.reply_text(text=text, parse_mode="HTML")
+        return ConversationHandler.END
+    upcoming_games = [game.game_date for game in games]
+    context.user_data[BotStorage.UPCOMING_GAME_DATES] = upcoming_games
+    context.user_data[BotStorage.UPCOMING_GAMES] = games
 
-    registrations = plutarch.is_registered(user_name, upcoming_games)
+    registrations = await plutarch.db.run(plutarch.is_registered, user_name, upcoming_games)
    
 
     registration_dates = []
@@ -102,8 +166,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             registration_dates.append(registration.game_date)
             registration_objects.append(registration)
 
-    context.bot_data[BotStorage.REGISTRATION_DATES] = registration_dates
-    context.bot_data[BotStorage.REGISTRATIONS] = registration_objects
+    context.user_data[BotStorage.REGISTRATION_DATES] = registration_dates
+    context.user_data[BotStorage.REGISTRATIONS] = registration_objects
 
     if registration_dates:
         reply.append(f"I see you have been registered for " + " and ".join(registration_dates) + ". Great!")
@@ -115,27 +179,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # To minimize amount of calls, from here onwards in any other handler we assume:
     # User is valid and registered
     # Game does exist
-    # TODO: this should be handled via, returning closest Sundays
-    #   get_this_sunday - closest available game
-    #   get_next_sunday - closest available game after that
-    
-    
-    
-    if len(registration_dates) == 2:
+    # Upcoming games come from the calendar, see Plutarch.upcoming_games
+    if len(registration_dates) == len(upcoming_games):
         # Do not show "Join The Games", already joined everything
         buttons = START_REPLY_MARKUP[1:]
-    elif len(registration_dates) == 1:
+    elif registration_dates:
         # Show all options
         buttons = START_REPLY_MARKUP
     else:
         # do not show "Yield The Arena"
         buttons = START_REPLY_MARKUP[:1] + START_REPLY_MARKUP[2:]
     reply_markup = InlineKeyboardMarkup(buttons)
-    await update.message.reply_text(text=text, parse_mode="HTML", reply_markup=reply_markup)
+    message = await update.message.reply_text(text=text, parse_mode="HTML", reply_markup=reply_markup)
+    sweeper.track(update, message)
     # Tell ConversationHandler to send those buttons
     return START_ROUTES
 
 
+@timed
 async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Returns `ConversationHandler.END`, which tells the
     ConversationHandler that the conversation is over.
@@ -145,26 +206,38 @@ async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.edit_message_text(text="See you next time!", parse_mode="HTML")
     return ConversationHandler.END
 
+@timed
 async def join_the_games(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Propose to join a game in this sunday or sunday in 2 weeks"""
     query = update.callback_query
     await query.answer()
 
-    upcoming_games = context.bot_data[BotStorage.UPCOMING_GAME_DATES]
-    registrations = context.bot_data[BotStorage.REGISTRATION_DATES]
+    upcoming_games = context.user_data[BotStorage.UPCOMING_GAME_DATES]
+    registrations = context.user_data[BotStorage.REGISTRATION_DATES]
+
+    # Caps, prices and deadlines as /start has seen them
+    details = {game.game_date: game for game in context.user_data.get(BotStorage.UPCOMING_GAMES, [])}
 
     keyboard = [[]]
+    text = ["You can register for this games"]
     for game in upcoming_games:
         if not game in registrations:
             keyboard[0].append(InlineKeyboardButton(f"Join on {game}", callback_data=f"join_game:{game}"))
+            if game in details:
+                line = f"<b>{game}</b>: {details[game].cap} players"
+                if details[game].price:
+                    line += f", {details[game].price} per game"
+                line += f", register before {details[game].deadline.strftime('%a %H:%M')}"
+                text.append(line)
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
-        text=f"You can register for this games", parse_mode="HTML", reply_markup=reply_markup
+        text="\n".join(text), parse_mode="HTML", reply_markup=reply_markup
     )
     return HELPERS
 
 
+@timed
 async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Calls Plutarch to register user on a given date. 
     Obtains date from callback_date and user from context
@@ -173,9 +246,10 @@ async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.answer()
 
     game_date = query.data.split(':')[1]
-    player = context.bot_data[BotStorage.PLAYER]
+    player = context.user_data[BotStorage.PLAYER]
 
-    _, err = plutarch.register(player, game_date)
+    # Double taps and redelivered callbacks are answered without registering twice
+    _, err = await plutarch.db.run(plutarch.register, player, game_date, query.id)
     if not err:
         reply = f"You were registered for a game on {game_date}!"
     else:
@@ -185,14 +259,15 @@ async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed
 async def leave_the_games(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Propose to leave a game in this sunday or sunday in 2 weeks"""
 
     query = update.callback_query
     await query.answer()
 
-    upcoming_games = context.bot_data[BotStorage.UPCOMING_GAME_DATES]
-    registrations = context.bot_data[BotStorage.REGISTRATION_DATES]
+    upcoming_games = context.user_data[BotStorage.UPCOMING_GAME_DATES]
+    registrations = context.user_data[BotStorage.REGISTRATION_DATES]
 
     keyboard = [[]]
     for game in upcoming_games:
@@ -208,6 +283,7 @@ async def leave_the_games(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return HELPERS
 
 
+@timed
 async def leave_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Calls Plutarch to unregister the user on a given date and try to sell his slot 
     Obtains date from callback_date and user from context.
@@ -215,16 +291,15 @@ async def leave_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
-    player = context.bot_data[BotStorage.PLAYER]
-    registrations = context.bot_data[BotStorage.REGISTRATIONS]
-    print(registrations)
+    player = context.user_data[BotStorage.PLAYER]
+    registrations = context.user_data[BotStorage.REGISTRATIONS]
     # We trust this is set to a date where user is already registered
     game_date = query.data.split(':')[1]
 
     # Just a bit of syntax sugar here. Get registration for matching date
     registration = [r for r in registrations if r.game_date == game_date][0]
 
-    unergistered, sold, err = plutarch.leave_game(player, registration, "pay to https://payme")
+    unergistered, sold, err = await plutarch.db.run(plutarch.leave_game, player, registration, "pay to https://payme", query.id)
     if unergistered:
         reply = f"You were un-registered from a game on {game_date}"
         if sold:
@@ -239,6 +314,7 @@ async def leave_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed
 async def see_the_roster(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show new choice of buttons"""
     query = update.callback_query
@@ -250,11 +326,11 @@ async def see_the_roster(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         3: "🎲" # The Reaped – One Game, One Fate!
     }
 
-    upcoming_games = context.bot_data[BotStorage.UPCOMING_GAME_DATES]
+    upcoming_games = context.user_data[BotStorage.UPCOMING_GAME_DATES]
     
     reply = []
     for game in upcoming_games:
-        participants, err = plutarch.list_participants(game)
+        participants, err = await plutarch.db.run(plutarch.list_participants, game)
         if err:
             reply = "I cannot foresee the future <b>now</b> - please come later"
             await query.edit_message_text(text=reply)
@@ -273,8 +349,10 @@ async def see_the_roster(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reply.append(f"<b>{game}</b>\n───────────────\n<i>Hold tight. The arena is filling up…</i>\n")
         
         # Trying to split participants between current and waiting list
-        main_section = participants[:14]
-        waiting_section = participants[14:]
+        caps = {g.game_date: g.cap for g in context.user_data.get(BotStorage.UPCOMING_GAMES, [])}
+        cap = caps.get(game) or (await plutarch.db.run(plutarch.cap, game))[0]
+        main_section = participants[:cap]
+        waiting_section = participants[cap:]
         
         reply.extend(main_section)
         
@@ -288,11 +366,14 @@ async def see_the_roster(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.edit_message_text(text=text, parse_mode="HTML")
     return ConversationHandler.END
 
+@timed
 async def summarize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Settles a game in the background: `/summarize [YYYY-MM-DD]`, this Sunday by default.
+    Running it again for a game that was not settled to the end resumes it"""
 
     user_name = update.message.from_user.name
-    context.bot_data[BotStorage.USER_ID] = user_name
-    if user_name != "@kchestnov":
+    context.user_data[BotStorage.USER_ID] = user_name
+    if user_name != ADMIN_USER_NAME:
         return ConversationHandler.END
     
     # TODO: Validate input
@@ -303,40 +384,250 @@ async def summarize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     text = f"Let's see who pays whom for on {game_date}\n" 
     message = await update.message.reply_text(text=text, parse_mode="HTML")
-    participants, err = plutarch.list_participants(game_date)
+    job, started = settlements.start(game_date, plutarch.db.key(f"game:{game_date}"), message)
+    if not started:
+        await message.edit_text(text=f"The game on {game_date} is being settled already by job {job.id}, /cancel {job.id} to stop it")
+    return ConversationHandler.END
+
+
+@timed
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Stops a settlement: `/cancel job_id`, the players settled so far stay settled"""
+
+    user_name = update.message.from_user.name
+    if user_name != ADMIN_USER_NAME:
+        return ConversationHandler.END
+
+    if len(context.args) != 1:
+        await update.message.reply_text(text="Usage: /cancel job_id")
+        return ConversationHandler.END
+
+    job = settlements.cancel(context.args[0])
+    if not job:
+        await update.message.reply_text(text=f"There is no job {context.args[0]}")
+    elif job.cancelled:
+        await update.message.reply_text(text=f"Job {job.id} stops after the player being settled now")
+    else:
+        await update.message.reply_text(text=f"Job {job.id} is {job.status} already")
+    return ConversationHandler.END
+
+
+@timed
+async def archive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Moves past games to the archive: `/archive [YYYY-MM-DD]`, everything before the date"""
+
+    user_name = update.message.from_user.name
+    if user_name != ADMIN_USER_NAME:
+        return ConversationHandler.END
+
+    keep_days = settings.get("archive.keep_days", 28)
+    latest = datetime.today().date() - timedelta(days=keep_days)
+    try:
+        if len(context.args) > 1:
+            raise ValueError("too many arguments")
+        before = datetime.strptime(context.args[0], "%Y-%m-%d").date() if context.args else latest
+    except ValueError:
+        await update.message.reply_text(text="Usage: /archive [YYYY-MM-DD]")
+        return ConversationHandler.END
+    if before > latest:
+        # Games that are not played yet, or were played recently, stay in the hot tabs
+        await update.message.reply_text(text=f"Games of the last {keep_days} days are kept, archive before {latest} at the latest")
+        return ConversationHandler.END
+    before = before.strftime("%Y-%m-%d")
+
+    message = await update.message.reply_text(text=f"Archiving games before {before}", parse_mode="HTML")
+    moved, err = await plutarch.db.run(plutarch.archive, before)
     if err:
-        reply = "I cannot help you <b>now</b> - please come later"
-        await message.edit_text(text=reply)
+        await message.edit_text(text=f"Archived {moved} rows, but I cannot finish it <b>now</b> - please come later", parse_mode="HTML")
         return ConversationHandler.END
-    
-    text += "Current list is:\n"
-    registrations = participants[:14]
-    for registration in registrations:
-        player, err = plutarch.get_player(registration.user_name)
-        # if player.balance > 0:
-        #     text += f"{registration.user_name}'s balance: {player.balance}\n"
-        #     err = plutarch.update_balance(player)
-        #     if err:
-        #         reply = "I cannot help you now - please come later"
-        #         await message.edit_text(text=reply)
-        #         return ConversationHandler.END
-        # else:
-        slot, err = plutarch.collect_money(player, registration)
-        if err:
-            reply = "I cannot help you <b>now</b> - please come later"
-            await message.edit_text(text=reply)
-            return ConversationHandler.END
-        text += f"{slot.buyer_user_name} {slot.tikkie_link}\n"
-            
-        await message.edit_text(text=text, parse_mode="HTML")
 
+    await message.edit_text(text=f"Archived {moved} rows of games before {before}", parse_mode="HTML")
     return ConversationHandler.END
-    
 
-def main() -> None:
-    """Run the bot."""
+
+@timed
+async def top_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Adds prepaid games to a player: `/topup @user_name games`"""
+
+    user_name = update.message.from_user.name
+    if user_name != ADMIN_USER_NAME:
+        return ConversationHandler.END
+
+    if len(context.args) != 2 or not context.args[1].lstrip("-").isdigit():
+        await update.message.reply_text(text="Usage: /topup @user_name games")
+        return ConversationHandler.END
+
+    player_name, games = context.args[0], int(context.args[1])
+    balance, err = await plutarch.db.run(plutarch.top_up, player_name, games)
+    if err:
+        await update.message.reply_text(text=f"I cannot top up {player_name}: {err}")
+        return ConversationHandler.END
+
+    await update.message.reply_text(text=f"{player_name} has {balance} prepaid games now")
+    return ConversationHandler.END
+
+
+@timed
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Reports attendance, fill rates and payments: `/stats [YYYY]`, top players of the season"""
+
+    user_name = update.message.from_user.name
+    if user_name != ADMIN_USER_NAME:
+        return ConversationHandler.END
+
+    if len(context.args) > 1 or (context.args and not (len(context.args[0]) == 4 and context.args[0].isdigit())):
+        await update.message.reply_text(text="Usage: /stats [YYYY]")
+        return ConversationHandler.END
+
+    season = context.args[0] if context.args else None
+    report, err = await plutarch.db.run(plutarch.stats, season)
+    if err:
+        await update.message.reply_text(text="I cannot gather the stats <b>now</b> - please come later", parse_mode="HTML")
+        return ConversationHandler.END
+
+    await update.message.reply_text(text=f"<pre>{html.escape(report)}</pre>", parse_mode="HTML")
+    return ConversationHandler.END
+
+
+@timed
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Profiles the bot for a while: `/profile [seconds]`, the report is sent as a file"""
+    global profiler
+
+    user_name = update.message.from_user.name
+    if user_name != ADMIN_USER_NAME:
+        return ConversationHandler.END
+
+    if len(context.args) > 1 or (context.args and not context.args[0].isdigit()):
+        await update.message.reply_text(text="Usage: /profile [seconds]")
+        return ConversationHandler.END
+
+    if profiler:
+        await update.message.reply_text(text="I am already watching myself, wait for the report")
+        return ConversationHandler.END
+
+    seconds = int(context.args[0]) if context.args else 30
+    seconds = min(max(seconds, 1), settings.get("profile.max_seconds", 300))
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    await update.message.reply_text(text=f"Profiling for {seconds} seconds")
+    # Report later without holding this conversation. Cancelled in post_stop if the bot stops first
+    task = asyncio.create_task(send_profile(update.effective_chat.id, context, time.time(), seconds))
+    background_tasks.append(task)
+    task.add_done_callback(profile_done)
+    return ConversationHandler.END
+
+
+def profile_done(task: asyncio.Task):
+    """Forgets the finished /profile window, stops the profiler if the bot stopped first"""
+    global profiler
+
+    if task in background_tasks:
+        background_tasks.remove(task)
+    if task.cancelled() and profiler:
+        profiler.stop()
+        profiler = None
+
+
+async def send_profile(chat_id: int, context: ContextTypes.DEFAULT_TYPE, started_at: float, seconds: int):
+    global profiler
+
+    await asyncio.sleep(seconds)
+    profiler.stop()
+    report = profile_report(profiler, since=started_at)
+    profiler = None
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=io.BytesIO(report.encode()),
+        filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt",
+    )
+
+
+async def flush_balances(interval: float):
+    """Writes the recorded balance changes every interval seconds"""
+
+    while True:
+        await asyncio.sleep(interval)
+        flushed, err = await asyncio.to_thread(plutarch.flush_balances)
+        if err:
+            log.info(f"flush_balances: cannot flush, {flushed} entries written")
+
+
+async def prewarm_peaks(windows: list[str], lead: float, interval: float):
+    """Warms the caches shortly before every peak window and keeps them
+    (and the connection to Sheets) warm until the window is over"""
+
+    while True:
+        peak = next_peak(windows, datetime.now())
+        if not peak:
+            return
+        start, end = peak
+        await asyncio.sleep(max((start - datetime.now()).total_seconds() - lead, 0))
+        log.info(f"prewarm_peaks: warming up for the peak {start} - {end}")
+        while datetime.now() < end:
+            # Full resyncs that would fall due before the next round are done now
+            warmed, err = await asyncio.to_thread(plutarch.prewarm, settings.get("calendar.upcoming", 2), interval)
+            if err:
+                log.info(f"prewarm_peaks: warmed {warmed} sheets, the rest failed")
+            await asyncio.sleep(interval)
+
+
+async def post_init(application: Application) -> None:
+    # Cheap enough to run all the time, /profile reports it
+    background_tasks.append(asyncio.create_task(sample_loop_lag()))
+    notifier.start(application)
+    sweeper.start(application)
+    background_tasks.append(asyncio.create_task(flush_balances(settings.get("ledger.flush_interval", 60))))
+    if settings.get("prewarm.windows"):
+        background_tasks.append(asyncio.create_task(prewarm_peaks(
+            settings.prewarm.windows,
+            settings.get("prewarm.lead_minutes", 10) * 60,
+            settings.get("prewarm.interval", 60),
+        )))
+
+
+async def post_stop(application: Application) -> None:
+    notifier.stop()
+    sweeper.stop()
+    settlements.stop()
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    # Let them clean up (e.g. stop the profiler) before the loop goes away
+    await asyncio.gather(*tasks, return_exceptions=True)
+    background_tasks.clear()
+
+
+async def post_shutdown(application: Application) -> None:
+    # Do not lose the balance changes recorded since the last flush
+    await asyncio.to_thread(plutarch.flush_balances)
+
+
+def build_application(token: str, request: BaseRequest|None = None, get_updates_request: BaseRequest|None = None) -> Application:
+    """Creates the Application with all the handlers.
+    request and get_updates_request replace the connection to the Bot API (see fakes.py)"""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(settings.telegram.token).build()
+    # Storage calls run in threads, so updates of different chats can be served concurrently
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(settings.get("telegram.concurrent_updates", 16))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if settings.get("persistence.enabled", False):
+        # Conversations and user data survive restarts
+        builder = builder.persistence(SqlitePersistence(
+            settings.persistence.path,
+            update_interval=settings.get("persistence.update_interval", 60),
+        ))
+    if request:
+        builder = builder.request(request)
+    if get_updates_request:
+        builder = builder.get_updates_request(get_updates_request)
+    application = builder.build()
 
     # Setup conversation handler with the states FIRST and SECOND
     # Use the pattern parameter to pass CallbackQueries with specific
@@ -345,7 +636,15 @@ def main() -> None:
     # $ means "end of line/string"
     # So ^ABC$ will only allow 'ABC'
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start), CommandHandler("summarize", summarize)],
+        entry_points=[
+            CommandHandler("start", start),
+            CommandHandler("summarize", summarize),
+            CommandHandler("cancel", cancel),
+            CommandHandler("archive", archive),
+            CommandHandler("topup", top_up),
+            CommandHandler("stats", stats),
+            CommandHandler("profile", profile),
+        ],
         states={
             START_ROUTES: [
                 CallbackQueryHandler(join_the_games, pattern=r"join_the_games"),
@@ -359,16 +658,28 @@ def main() -> None:
         },
         fallbacks=[CommandHandler("start", start)],
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="main",
+        persistent=application.persistence is not None,
     )
 
     # Add ConversationHandler to application that will be used for handling updates
+    sweeper.watch(conv_handler)
+    # Buttons of expired menus never reach the storage
+    application.add_handler(TypeHandler(Update, sweeper.guard), group=-2)
+    application.add_handler(TypeHandler(Update, use_tenant), group=-1)
     application.add_handler(conv_handler)
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
+    application = build_application(settings.telegram.token)
+    # Serve the first requests from the local snapshot, if enabled
+    plutarch.db.restore()
     # This handles CTR+C under the hood
-    # TODO: Need to close all on-going conversations
-    # or remove buttons from them
-    # TODO: Need to terminage conversations (remove buttons and send Conversation.END)
-    # for every request after certain threshold
+    # Without persistence conversations do not survive a restart,
+    # buttons of the menus sent before it are refused by sweeper.guard
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
@@ -1 +1 @@
-from .models import Storable, Player, Game, Registration, AvailableSlot, Priorities, BotStorage
\ No newline at end of file
+from .models import Storable, Player, Game, Registration, AvailableSlot, Partition, LedgerEntry, Event, Priorities, BotStorage
\ No newline at end of file
@@ -13,6 +13,7 @@ class BotStorage(StrEnum):
     REGISTRATIONS = "registrations"
     REGISTRATION_DATES = "registration_dates"
     UPCOMING_GAME_DATES = "upcoming_game_dates"
+    UPCOMING_GAMES = "upcoming_games"
     PLAYER = "player"
 
 @dataclass
@@ -159,4 +160,97 @@ class AvailableSlot(Storable):
             raise ValueError(f"Expected exactly {len(fields(cls))} values")
         
         game_date, seller_user_name, requested_at, tikkie_link, is_sent, buyer_user_name = data                    # Unpack strings
-        return cls(game_date, seller_user_name, int(requested_at), tikkie_link, int(is_sent), buyer_user_name)     # Convert fields    
\ No newline at end of file
+        return cls(game_date, seller_user_name, int(requested_at), tikkie_link, int(is_sent), buyer_user_name)     # Convert fields
+
+
+@dataclass
+class Partition(Storable):
+    table: str
+    game_date: str
+    sheet: str|None = None
+
+    @classmethod
+    def sheet_name(cls) -> str:
+        """Returns key attributes used for searching."""
+        return "partitions"
+
+    @property
+    def unique_keys(self) -> tuple[str, str]:
+        """Returns key attributes used for searching."""
+        return self.table, self.game_date
+
+    def __iter__(self):
+        return iter((self.table, self.game_date, self.sheet))
+
+    @classmethod
+    def from_list(cls, data: list[str]):
+        """Parses and converts a list of strings into a Partition instance."""
+
+        if len(data) != len(fields(cls)):
+            raise ValueError(f"Expected exactly {len(fields(cls))} values")
+
+        table, game_date, sheet = data                  # Unpack strings
+        return cls(table, game_date, sheet)
+
+
+@dataclass
+class LedgerEntry(Storable):
+    created_at: int
+    user_name: str
+    delta: int
+    reason: str|None = None
+
+    @classmethod
+    def sheet_name(cls) -> str:
+        """Returns key attributes used for searching."""
+        return "ledger"
+
+    @property
+    def unique_keys(self) -> tuple[str, str]:
+        """Returns key attributes used for searching."""
+        return self.user_name, str(self.created_at)
+
+    def __iter__(self):
+        return iter((self.created_at, self.user_name, self.delta, self.reason))
+
+    @classmethod
+    def from_list(cls, data: list[str]):
+        """Parses and converts a list of strings into a LedgerEntry instance."""
+
+        if len(data) != len(fields(cls)):
+            raise ValueError(f"Expected exactly {len(fields(cls))} values")
+
+        created_at, user_name, delta, reason = data                 # Unpack strings
+        return cls(int(created_at), user_name, int(delta), reason)  # Convert fields
+
+
+@dataclass
+class Event(Storable):
+    created_at: int
+    table: str
+    action: str
+    game_date: str
+    data: str
+
+    @classmethod
+    def sheet_name(cls) -> str:
+        """Returns key attributes used for searching."""
+        return "events"
+
+    @property
+    def unique_keys(self) -> tuple[str, str]:
+        """Returns key attributes used for searching."""
+        return self.game_date, str(self.created_at)
+
+    def __iter__(self):
+        return iter((self.created_at, self.table, self.action, self.game_date, self.data))
+
+    @classmethod
+    def from_list(cls, data: list[str]):
+        """Parses and converts a list of strings into an Event instance."""
+
+        if len(data) != len(fields(cls)):
+            raise ValueError(f"Expected exactly {len(fields(cls))} values")
+
+        created_at, table, action, game_date, event_data = data         # Unpack strings
+        return cls(int(created_at), table, action, game_date, event_data)  # Convert fields
@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import logging
+import threading
+from dataclasses import dataclass, field
+from telegram.error import Forbidden, BadRequest, RetryAfter, NetworkError
+from telegram.ext import Application
+
+log = logging.getLogger("notifications")
+
+# Lower goes first
+URGENT = 0
+NORMAL = 1
+
+
+@dataclass(order=True)
+class Notice:
+    """A message to a player. A newer notice with the same topic for the
+    same chat supersedes the one still waiting in the queue"""
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    topic: str = field(compare=False)
+    text: str = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class Notifier():
+    """Queue of outgoing notices, sent in the background by a few workers
+    within Telegram's limits: about 30 messages per second overall and
+    one message per second per chat. Handlers and Plutarch (from its
+    threads) only queue notices and never wait for them to be sent"""
+
+    def __init__(self, workers: int = 4, global_rate: float = 25, chat_rate: float = 1, max_attempts: int = 5):
+        self.workers = workers
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        # user_name -> id of the private chat with the user
+        self.chats: dict[str, int] = {}
+        self.guard = threading.Lock()
+        self.seq = itertools.count()
+        # (chat_id, topic) -> seq of the latest notice
+        self.latest: dict[tuple[int, str], int] = {}
+        self.queue: asyncio.PriorityQueue|None = None
+        self.loop: asyncio.AbstractEventLoop|None = None
+        self.application: Application|None = None
+        self.tasks: list[asyncio.Task] = []
+        self.next_global = 0.0
+        self.next_chat: dict[int, float] = {}
+        self.sent = 0
+        self.dropped = 0
+
+
+    def start(self, application: Application):
+        """Starts the workers, to be called from post_init"""
+
+        self.application = application
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.PriorityQueue()
+        # Not Application.create_task: stopping the application waits for those to finish
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+
+    def stop(self):
+        """Stops the workers, notices still in the queue are lost"""
+
+        for task in self.tasks:
+            task.cancel()
+
+
+    def remember(self, user_name: str, chat_id: int):
+        with self.guard:
+            self.chats[user_name] = chat_id
+
+
+    def notify(self, user_name: str, topic: str, text: str, priority: int = NORMAL):
+        """Queues a notice to the player. Safe to call from any thread"""
+
+        with self.guard:
+            chat_id = self.chats.get(user_name)
+        if chat_id is None:
+            log.info(f"notify: {user_name} has no chat with the bot yet, dropping {topic}")
+            return
+        if not self.loop:
+            log.info(f"notify: not started, dropping {topic} for {user_name}")
+            return
+        notice = Notice(priority, next(self.seq), chat_id, topic, text)
+        self.loop.call_soon_threadsafe(self._put, notice)
+
+
+    def _put(self, notice: Notice):
+        self.latest[(notice.chat_id, notice.topic)] = notice.seq
+        self.queue.put_nowait(notice)
+
+
+    async def _wait_turn(self, chat_id: int):
+        # Reserve the earliest moment allowed by both limits, then sleep until then
+        now = self.loop.time()
+        at = max(now, self.next_global, self.next_chat.get(chat_id, 0.0))
+        self.next_global = at + 1 / self.global_rate
+        self.next_chat[chat_id] = at + 1 / self.chat_rate
+        await asyncio.sleep(at - now)
+
+
+    def _forget(self, notice: Notice):
+        # Unless a newer notice is waiting already
+        if self.latest.get((notice.chat_id, notice.topic)) == notice.seq:
+            del self.latest[(notice.chat_id, notice.topic)]
+
+
+    def _retry(self, notice: Notice, delay: float):
+        notice.attempts += 1
+        if notice.attempts >= self.max_attempts:
+            log.info(f"notify: giving up on {notice.topic} for {notice.chat_id}")
+            self._forget(notice)
+            self.dropped += 1
+            return
+        self.loop.call_later(delay, self.queue.put_nowait, notice)
+
+
+    async def _work(self):
+        while True:
+            notice = await self.queue.get()
+            try:
+                if self.latest.get((notice.chat_id, notice.topic)) != notice.seq:
+                    continue  # Superseded by a newer notice
+                await self._wait_turn(notice.chat_id)
+                # Might have been superseded while waiting
+                if self.latest.get((notice.chat_id, notice.topic)) != notice.seq:
+                    continue
+                await self.application.bot.send_message(chat_id=notice.chat_id, text=notice.text, parse_mode="HTML")
+                self._forget(notice)
+                self.sent += 1
+            except RetryAfter as e:
+                log.info(f"notify: rate limited, retrying in {e.retry_after}s")
+                # Everybody waits, not only this chat
+                self.next_global = max(self.next_global, self.loop.time() + e.retry_after)
+                self._retry(notice, e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot or deleted the chat, retrying will not help
+                log.info(f"notify: cannot notify {notice.chat_id}: {e}")
+                self._forget(notice)
+                self.dropped += 1
+            except NetworkError as e:
+                log.info(f"notify: {e}, retrying")
+                self._retry(notice, 2 ** notice.attempts)
+            except Exception as e:
+                log.info(f"notify: cannot send {notice.topic}: {e}")
+                self._forget(notice)
+                self.dropped += 1
+            finally:
+                self.queue.task_done()
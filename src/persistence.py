@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from telegram.ext import BasePersistence, PersistenceInput
+
+log = logging.getLogger("persistence")
+
+
+class SqlitePersistence(BasePersistence):
+    """Keeps user, chat and bot data and conversation states in SQLite, one row per entry.
+    Only entries that changed since they were last written are written, all changes
+    of one persistence run (every update_interval seconds) in a single transaction.
+    User and chat data are loaded on the first update of that user or chat"""
+
+    def __init__(self, path: str, update_interval: float = 60):
+        # Callback data is not used, all buttons carry plain strings
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.guard = threading.Lock()
+        with self.guard, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS data (kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))")
+        # (kind, key) -> digest of what is stored
+        self.digests: dict[tuple[str, str], str] = {}
+        # (kind, key) -> value to write, None to delete
+        self.pending: dict[tuple[str, str], bytes|None] = {}
+        self.writing: asyncio.Task|None = None
+        self.loaded: set[tuple[str, str]] = set()
+
+
+    def _load(self, kind: str, key: str) -> bytes|None:
+        if (kind, key) in self.pending:
+            return self.pending[(kind, key)]
+        with self.guard:
+            row = self.conn.execute("SELECT value FROM data WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else None
+
+
+    def _write_batch(self, batch: dict[tuple[str, str], bytes|None]):
+        with self.guard, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO data (kind, key, value) VALUES (?, ?, ?)",
+                [(kind, key, value) for (kind, key), value in batch.items() if value is not None],
+            )
+            self.conn.executemany(
+                "DELETE FROM data WHERE kind = ? AND key = ?",
+                [(kind, key) for (kind, key), value in batch.items() if value is None],
+            )
+
+
+    async def _write(self):
+        # Everything staged by the current persistence run is in by now
+        batch, self.pending = self.pending, {}
+        self.writing = None
+        await asyncio.to_thread(self._write_batch, batch)
+        log.info(f"write: {len(batch)} entries")
+
+
+    async def _stage(self, kind: str, key: str, value: object|None):
+        if value is None:
+            self.digests.pop((kind, key), None)
+            self.pending[(kind, key)] = None
+        elif value == {} and (kind, key) not in self.digests:
+            return  # Nothing stored and nothing to store
+        else:
+            data = pickle.dumps(value)
+            digest = hashlib.sha1(data).hexdigest()
+            if self.digests.get((kind, key)) == digest:
+                return  # Unchanged
+            self.digests[(kind, key)] = digest
+            self.pending[(kind, key)] = data
+        if not self.writing:
+            # Starts once all the updates of this run have been staged
+            self.writing = asyncio.create_task(self._write())
+        await asyncio.shield(self.writing)
+
+
+    async def _refresh(self, kind: str, key: str, data: dict):
+        if (kind, key) in self.loaded:
+            return
+        self.loaded.add((kind, key))
+        value = self._load(kind, key)
+        if value is None:
+            return
+        self.digests[(kind, key)] = hashlib.sha1(value).hexdigest()
+        data.update(pickle.loads(value))
+
+
+    async def get_user_data(self) -> dict:
+        # Loaded user by user in refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        value = self._load("bot", "")
+        if value is None:
+            return {}
+        self.digests[("bot", "")] = hashlib.sha1(value).hexdigest()
+        return pickle.loads(value)
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        with self.guard:
+            rows = self.conn.execute("SELECT key, value FROM data WHERE kind = ?", (f"conversation:{name}",)).fetchall()
+        conversations = {}
+        for key, value in rows:
+            self.digests[(f"conversation:{name}", key)] = hashlib.sha1(value).hexdigest()
+            conversations[tuple(json.loads(key))] = pickle.loads(value)
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object|None) -> None:
+        await self._stage(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._stage("user", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._stage("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._stage("bot", "", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.loaded.discard(("user", str(user_id)))
+        await self._stage("user", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.loaded.discard(("chat", str(chat_id)))
+        await self._stage("chat", str(chat_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh("user", str(user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh("chat", str(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self.writing:
+            await self.writing
+        if self.pending:
+            await self._write()
+        with self.guard:
+            self.conn.close()
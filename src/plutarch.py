@@ -1,10 +1,21 @@
 import logging
 import time
+from typing import Callable
 from models import Player, Game, Registration, AvailableSlot, Priorities
-from database import Database
+from database import Database, create_database
+from database.flights import Idempotency
+from database.ledger import UNKNOWN_PLAYER
+from database.schedule import GameDay
 from dataclasses import dataclass
+from datetime import date
+from helpers import timed
+import analytics
 
 REGISTRATION_DEADLINE = 24 # Hours
+DEFAULT_CAP = 14 # Players in a game, unless the game says otherwise
+# Seconds a repeated join or leave is answered without writing:
+REQUEST_TTL = 600 # redelivered callbacks
+DOUBLE_TAP_TTL = 10 # same user and game, kept short as other workers may change it meanwhile
 
 
 class Plutarch():
@@ -12,30 +23,127 @@ class Plutarch():
     def __init__(self):
         # Required
         self.log = logging.getLogger("plutarch")
-        self.db: Database = Database()
+        self.db: Database = create_database()
+        # Joins and leaves already done, so double taps and redelivered callbacks are not written twice
+        self.writes = Idempotency()
+        # Optional
+        # Called with (user_name, topic, text) to tell a player about a change that concerns them
+        self.notify: Callable[[str, str, str], None]|None = None
 
 
+    @timed
+    def _notify(self, user_name: str, topic: str, text: str):
+        if self.notify and user_name:
+            self.notify(user_name, topic, text)
+
+
+    @timed
+    def _roster_moves(self, game_date: str, before: list[Registration], after: list[Registration], actor: str):
+        """Tells the players who got into the game or were moved to the waiting list by the actor"""
+
+        cap, err = self.cap(game_date)
+        if err:
+            self.log.info(f"roster_moves: cannot read game: {err}")
+        order = lambda x: (x.prio, x.requested_at)
+        playing_before = {r.user_name for r in sorted(before, key=order)[:cap]}
+        playing_after = {r.user_name for r in sorted(after, key=order)[:cap]}
+        for user_name in playing_after - playing_before - {actor}:
+            self._notify(user_name, f"roster:{game_date}", f"Good news: you are <b>in</b> the game on {game_date}!")
+        for user_name in playing_before - playing_after - {actor}:
+            self._notify(user_name, f"roster:{game_date}", f"You were moved to the <b>waiting list</b> for the game on {game_date}")
+
+
+    @timed
     def _get_game(self, game_date: str) -> tuple[Game|None, str]:
-        return self.db.read(Game(game_date=game_date))
+        # Served from memory, the games sheet is read again only after it changed
+        return self.db.calendar().game(game_date)
 
 
+    @timed
+    def cap(self, game_date: str) -> tuple[int, str]:
+        """Players in the game, the rest is the waiting list. DEFAULT_CAP if it cannot be read"""
+
+        game, err = self._get_game(game_date)
+        return game.cap if game and game.cap else DEFAULT_CAP, err
+
+
+    @timed
+    def upcoming_games(self, count: int = 2) -> tuple[list[GameDay], str]:
+        """The next games players can join, with their caps, prices and deadlines"""
+
+        games, err = self.db.calendar().upcoming(date.today(), count, DEFAULT_CAP, REGISTRATION_DEADLINE)
+        if err:
+            self.log.info(f"upcoming_games: cannot read games: {err}")
+            return [], "try again later"
+        return games, ""
+
+
+    @timed
     def get_player(self, user_name: str) -> tuple[Player|None, str]:
-        return self.db.read(Player(user_name=user_name))
+        p, err = self.db.read(Player(user_name=user_name))
+        if err or not p:
+            return p, err
+        # The sheet may lag behind the balance changes that are not flushed yet
+        balance, err = self.db.ledger().balance(user_name)
+        if err:
+            return None, err
+        if balance is not None:
+            p.balance = balance
+        return p, ""
     
 
-    def register(self, player: Player, game_date: str) -> tuple[bool, str]:
+    @timed
+    def _idempotency_keys(self, action: str, game_date: str, user_name: str, request_id: str) -> dict[str, float]:
+        keys = {self.db.key(f"{action}:{game_date}:{user_name}"): DOUBLE_TAP_TTL}
+        if request_id:
+            # Request ids only identify a request together with its action
+            keys[self.db.key(f"request:{action}:{request_id}")] = REQUEST_TTL
+        return keys
+
+
+    @timed
+    def register(self, player: Player, game_date: str, request_id: str = "") -> tuple[bool, str]:
         """Register the user for a game
         return success or failure and an error if any
         True, "" means success
         False "some error" has context of failure
+        A repeated request (same request_id, or same user and game) is answered
+        with the result of the first one without writing again
         """
+        def register():
+            # Keep registrations of a game in order across all bot workers
+            try:
+                with self.db.lock(f"game:{game_date}"):
+                    registered, err = self._register(player, game_date)
+            except TimeoutError as e:
+                self.log.info(f"register: {e}")
+                return False, "try again later"
+            if registered:
+                self.writes.forget(self.db.key(f"leave:{game_date}:{player.user_name}"))
+            return registered, err
+
+        return self.writes.do(self._idempotency_keys("register", game_date, player.user_name, request_id), register)
+
+
+    @timed
+    def _register(self, player: Player, game_date: str) -> tuple[bool, str]:
+        # Also tells the others what changed for them
+        before, err = self.list_participants(game_date)
+        if err:
+            self.log.info(f"register: cannot read registrations: {err}")
+            return False, "try again later"
+        if any(r.user_name == player.user_name for r in before):
+            # A duplicate that reached another worker or came after the idempotency keys expired
+            self.log.info(f"register: {player.user_name} is registered for {game_date} already")
+            return True, ""
+
         # Remove user from auction if it sells the ticket
         slot = AvailableSlot(game_date=game_date, seller_user_name=player.user_name)
         _, err = self.db.delete(slot)
         if err:
             self.log.info(f"register: cannot remove slot from auction: {err}")
             return False, "try again later"
-                 
+
         registration = Registration(
             requested_at=int(time.time()),
             game_date=game_date,
@@ -46,6 +154,8 @@ class Plutarch():
         if err:
             self.log.info(f"register: cannot register: {err}")
             return False, "try again later"
+        if self.notify:
+            self._roster_moves(game_date, before, before + [registration], player.user_name)
         return True, ""
         # # Here we need to make sure high-prioriy members have a slot
         # # Fetch participants and prioritize them
@@ -71,6 +181,7 @@ class Plutarch():
         # # TODO: Inform unregistered people
         # return True, ""
         
+    @timed
     def is_registered(self, user_name: str, game_dates: list[str]) -> list[tuple[Registration|None, str]]:
         result = []
         for game_date in game_dates:
@@ -84,6 +195,7 @@ class Plutarch():
                 result.append((registration, ""))
         return result
 
+    @timed
     def list_participants(self, game_date: str) -> tuple[list[Registration], str]:
 
         registrations, err = self.db.read_table("registrations", game_date)
@@ -96,20 +208,45 @@ class Plutarch():
         return registrations, ""
     
 
-    def leave_game(self, player: Player, registration: Registration, payment_link: str) -> tuple[bool, bool, str]:
+    @timed
+    def leave_game(self, player: Player, registration: Registration, payment_link: str, request_id: str = "") -> tuple[bool, bool, str]:
         """Tries to unregister the user and sell his slot
         Returns statuses for unregistration, selling and error why they might fail, if any
         True True "" means unregistered, sold, without errors
         True False "some error" means user was unregistered but his slot was not sold for some error
         False False "some error" means user was not unregistered neither his slot was sold
+        A repeated request is answered like register does
         """
+        game_date = registration.game_date
+
+        def leave():
+            try:
+                with self.db.lock(f"game:{game_date}"):
+                    unregistered, sold, err = self._leave_game(player, registration, payment_link)
+            except TimeoutError as e:
+                self.log.info(f"leave_game: {e}")
+                return False, False, "try again later"
+            if unregistered:
+                self.writes.forget(self.db.key(f"register:{game_date}:{player.user_name}"))
+            return unregistered, sold, err
+
+        return self.writes.do(self._idempotency_keys("leave", game_date, player.user_name, request_id), leave)
+
 
+    @timed
+    def _leave_game(self, player: Player, registration: Registration, payment_link: str) -> tuple[bool, bool, str]:
         # Unregistering first regardless of priority
         # If subsequent placing to auction fails, user can retry by simply registering back
+        before, err = self.list_participants(registration.game_date) if self.notify else ([], "")
+        known = self.notify and not err
+
         _, err = self.db.delete(registration)
         if err:
             self.log.info(f"leave_game: cannot delete registration: {err}")
             return  False, False, "try again later"
+        if known:
+            after = [r for r in before if r.user_name != registration.user_name]
+            self._roster_moves(registration.game_date, before, after, player.user_name)
         # If person does not have full subscription, he cannot sell thus fast return
         if player.prio != Priorities.FULL:
             return True, False, "" # This is not an error
@@ -131,21 +268,70 @@ class Plutarch():
         return True, True, ""
 
 
+    @timed
     def _move_to_waiting_list(self, r: Registration):
         self.log.info(f"Moving {r.user_name} to a waiting list")
 
 
-    def _update_balance(self, p: Player) -> tuple[bool, str]:
+    @timed
+    def _update_balance(self, p: Player, reason: str) -> tuple[bool, str]:
         self.log.info(f"Updating balance of {p.user_name}. Current balance {p.balance}")
-        if p.balance <= 0:
-            return False, "" # Nothing to update
-        p.balance = p.balance -1
-        _, err = self.db.update(p)
+        # Recorded in the ledger, the sheet is updated by flush_balances
+        updated, err = self.db.ledger().record(p.user_name, -1, reason)
+        if err == UNKNOWN_PLAYER:
+            # No prepaid games to take from
+            return False, ""
         if err:
             self.log.info(f"update_balance: cannot query db: {err}")
             return False, "try again later"
-        return True, ""
+        if updated:
+            p.balance = p.balance - 1
+        return updated, ""
+
+
+    @timed
+    def top_up(self, user_name: str, games: int) -> tuple[int|None, str]:
+        """Adds prepaid games to the balance of the player. Returns the new balance"""
 
+        updated, err = self.db.ledger().record(user_name, games, "top up")
+        if err == UNKNOWN_PLAYER:
+            return None, err
+        if err:
+            self.log.info(f"top_up: cannot query db: {err}")
+            return None, "try again later"
+        if not updated:
+            return None, "balance cannot become negative"
+        balance, err = self.db.ledger().balance(user_name)
+        if err:
+            self.log.info(f"top_up: cannot query db: {err}")
+            return None, "try again later"
+        return balance, ""
+
+
+    @timed
+    def flush_balances(self) -> tuple[int, str]:
+        """Writes the recorded balance changes to the players sheet"""
+
+        flushed, err = self.db.flush_ledgers()
+        if err:
+            self.log.info(f"flush_balances: {err}")
+            return flushed, "try again later"
+        return flushed, ""
+
+    def _refund(self, p: Player, r: Registration):
+        refunded, err = self.db.ledger().record(p.user_name, 1, f"refund game {r.game_date}")
+        if err:
+            self.log.info(f"collect_money: cannot refund {p.user_name}: {err}")
+            return
+        if refunded:
+            p.balance = p.balance + 1
+        # Best effort, flush_balances writes it later otherwise
+        _, err = self.db.ledger().flush()
+        if err:
+            self.log.info(f"collect_money: cannot write refund of {p.user_name}: {err}")
+
+
+    @timed
     def collect_money(self, p: Player, r: Registration) -> tuple[AvailableSlot| None, str]:
         """Given Player and its registration
         If Player balance > 0 updates balance
@@ -153,15 +339,42 @@ class Plutarch():
         Then sent tikkie link back
         In case no slots are available admin link is sent
         """
+        # Make sure a slot is never sold twice by different bot workers
+        try:
+            with self.db.lock(f"game:{r.game_date}"):
+                return self._collect_money(p, r)
+        except TimeoutError as e:
+            self.log.info(f"collect_money: {e}")
+            return None, "try again later"
+
+
+    @timed
+    def _collect_money(self, p: Player, r: Registration) -> tuple[AvailableSlot| None, str]:
         # TODO: This is a VERY HEAVY query, need to optimize
         admin_tikkie = "https://make-me-rich"
+
+        available_slots, err = self.db.read_table("auctions", r.game_date)
+        if err:
+            self.log.info(f"collect_money: cannot read auction: {err}")
+            return None, "try again later"
+        # Settled by an earlier run that did not finish, never charge twice
+        for slot in available_slots:
+            if slot.is_sent == 1 and slot.buyer_user_name == p.user_name:
+                return slot, ""
         
-        updated, err = self._update_balance(p)
+        updated, err = self._update_balance(p, f"game {r.game_date}")
         if err:
             self.log.info(f"collect_money: cannot update balance: {err}")
             return None, "try again later"
         # We need to add a record just for the sake of it
         if updated:
+            # The auction row below tells a rerun the player paid, so the charge
+            # has to be in the players sheet first or a crash in between loses it
+            _, err = self.db.ledger().flush()
+            if err:
+                self.log.info(f"collect_money: cannot write balance: {err}")
+                self._refund(p, r)
+                return None, "try again later"
             # Send admin link
             slot = AvailableSlot(
                 game_date=r.game_date,
@@ -175,14 +388,12 @@ class Plutarch():
             _, err = self.db.create(slot)
             if err:
                 self.log.info(f"collect_money: cannot write auction: {err}")
+                # Without the auction row a rerun charges again, so give the game back
+                self._refund(p, r)
                 return None, "try again later" 
             return slot, ""            
 
         # Now we need to process remaining players (with balance = 0)
-        available_slots, err = self.db.read_table("auctions", r.game_date)
-        if err:
-            self.log.info(f"collect_money: cannot read auction: {err}")
-            return None, "try again later"
         # The topmost slot that was not yet processed
         slots = sorted(                                      
             (x for x in available_slots if x.is_sent == 0),  # Filter before sorting
@@ -210,14 +421,88 @@ class Plutarch():
                 return None, "try again later" 
             return slot, ""
         # Update DB
-        # TODO: Fix db.update
         slot.is_sent = 1
-        _, err = self.db.delete(slot)
-        if err:
-            self.log.info(f"collect_money: cannot write auction: {err}")
-            return None, "try again later"
-        _, err = self.db.create(slot)
+        _, err = self.db.update(slot)
         if err:
             self.log.info(f"collect_money: cannot write auction: {err}")
             return None, "try again later" 
-        return slot, ""
\ No newline at end of file
+        self._notify(
+            slot.seller_user_name,
+            f"sold:{slot.game_date}",
+            f"Your slot for the game on {slot.game_date} was bought by {slot.buyer_user_name}, expect a payment to {slot.tikkie_link}",
+        )
+        return slot, ""
+
+
+    @timed
+    def settlement(self, game_date: str) -> tuple[list[Registration], dict[str, AvailableSlot], str]:
+        """Players of the game who pay for it and the slots of those settled already.
+        A settled player is the buyer of a sent auction row, which collect_money
+        writes last, so a settlement that did not finish resumes after them"""
+
+        participants, err = self.list_participants(game_date)
+        if err:
+            return [], {}, err
+        cap, err = self.cap(game_date)
+        if err:
+            self.log.info(f"settlement: cannot read game: {err}")
+            return [], {}, "try again later"
+        slots, err = self.db.read_table("auctions", game_date)
+        if err:
+            self.log.info(f"settlement: cannot read auction: {err}")
+            return [], {}, "try again later"
+        settled = {slot.buyer_user_name: slot for slot in slots if slot.is_sent == 1}
+        return participants[:cap], settled, ""
+
+
+    @timed
+    def prewarm(self, count: int = 2, horizon: float = 0) -> tuple[int, str]:
+        """Loads what the requests about the upcoming games of every tenant need before they arrive"""
+
+        def game_dates() -> tuple[list[str], str]:
+            games, err = self.upcoming_games(count)
+            return [game.game_date for game in games], err
+
+        warmed, err = self.db.prewarm(game_dates, horizon)
+        if err:
+            self.log.info(f"prewarm: {err}")
+            return warmed, "try again later"
+        return warmed, ""
+
+
+    @timed
+    def stats(self, season: str|None = None) -> tuple[str, str]:
+        """Attendance, fill rates, waiting lists, resales and admin payments over all seasons.
+        The history is loaded into NumPy arrays once and again only after it changed"""
+
+        rows = {}
+        fingerprints = []
+        for table in (Registration.sheet_name(), AvailableSlot.sheet_name(), Game.sheet_name()):
+            rows[table], fingerprint, err = self.db.history(table)
+            if err:
+                self.log.info(f"stats: cannot read {table}: {err}")
+                return "", "try again later"
+            fingerprints.append(fingerprint)
+        history = analytics.load(
+            "|".join(fingerprints),
+            rows[Registration.sheet_name()],
+            rows[AvailableSlot.sheet_name()],
+            rows[Game.sheet_name()],
+            DEFAULT_CAP,
+        )
+        return history.report(season), ""
+
+
+    @timed
+    def archive(self, before: str) -> tuple[int, str]:
+        """Moves registrations and auctions of the games played before the given date
+        to the per-season archive, so reads of the upcoming games stay small"""
+
+        total = 0
+        for table in (Registration.sheet_name(), AvailableSlot.sheet_name()):
+            moved, err = self.db.archive(table, before)
+            if err:
+                self.log.info(f"archive: cannot archive {table}: {err}")
+                return total, "try again later"
+            total += moved
+        return total, ""
@@ -0,0 +1,32 @@
+import pytest
+
+# Sets the settings the storage needs and brings the fake Sheets API
+import fakes
+import database.gs as gs
+import database.archive as archive
+import database.ledger as ledger
+import database.schedule as schedule
+from database.flights import SingleFlight
+from database.shared import LocalStore
+
+
+@pytest.fixture
+def sheets(monkeypatch) -> fakes.FakeSheets:
+    """Fake Sheets API of the default tenant, with nothing cached or shared yet"""
+
+    fake = fakes.FakeSheets(latency=0)
+    for sheet in gs.DEFAULT_TENANT.sheet_ids:
+        fake.data[sheet] = []
+    monkeypatch.setattr(gs, "authenticate_to_gs", lambda: fake)
+    monkeypatch.setattr(gs, "SHARED", LocalStore())
+    monkeypatch.setattr(gs, "READS", SingleFlight())
+    monkeypatch.setattr(gs, "SNAPSHOTS", None)
+    monkeypatch.setattr(archive, "ROUTES", {})
+    monkeypatch.setattr(ledger, "LEDGERS", {})
+    monkeypatch.setattr(schedule, "CALENDARS", {})
+    gs.DEFAULT_TENANT.sheets.clear()
+    gs.DEFAULT_TENANT.tabs.clear()
+    gs.CURRENT_TENANT.set(gs.DEFAULT_TENANT)
+    yield fake
+    gs.DEFAULT_TENANT.sheets.clear()
+    gs.DEFAULT_TENANT.tabs.clear()
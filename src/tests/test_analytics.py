@@ -0,0 +1,39 @@
+import warnings
+import numpy as np
+from analytics import History
+
+GAMES = [["2025-01-05", 2, 5, 1], ["2025-01-12", 0, 5, 1]]
+REGISTRATIONS = [
+    ["2025-01-05", 1, "@a", 1],
+    ["2025-01-05", 2, "@b", 1],
+    ["2025-01-05", 3, "@c", 1],
+    ["2025-01-12", 1, "@a", 1],
+]
+AUCTIONS = [["2025-01-05", "@a", 1, "pay to @a", 1, "@c"]]
+
+
+def test_malformed_rows_are_skipped():
+    registrations = [["game_date", "requested_at", "user_name", "prio"], ["2025-01-05", "soon", "@d", 1], []]
+    auctions = [["game_date", "seller_user_name", "requested_at", "tikkie_link", "is_sent", "buyer_user_name"]]
+    games = [["game_date", "cap", "price", "is_summarized"], ["2025-01-19", "many", 5, 0]]
+
+    history = History.from_rows(REGISTRATIONS + registrations, AUCTIONS + auctions, GAMES + games, 10)
+
+    assert list(history.dates) == ["2025-01-05", "2025-01-12"]
+    assert list(history.users) == ["@a", "@b", "@c"]
+    assert "2025" in history.report()
+
+
+def test_games_with_cap_zero_have_no_fill_rate():
+    history = History.from_rows(REGISTRATIONS, AUCTIONS, GAMES, 10)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        registered, fill_rate, waiting, resold = history.per_game()
+        report = history.report()
+
+    assert list(registered) == [3, 1]
+    assert np.allclose(fill_rate, [1, 0])
+    assert list(waiting) == [1, 1]
+    assert list(resold) == [1, 0]
+    assert "nan" not in report
@@ -0,0 +1,63 @@
+from database import Database
+
+
+def test_spreadsheet_without_partitions_tab(sheets):
+    sheets.data["registrations"] = [["2024-12-01", 1, "@a", 1], ["2025-01-05", 2, "@b", 1]]
+    db = Database()
+
+    rows, err = db.read_table("registrations", "2025-01-05")
+
+    assert not err
+    assert [r.user_name for r in rows] == ["@b"]
+    assert sheets.data["partitions"] == []
+
+
+def test_archive_on_spreadsheet_without_partitions_tab(sheets):
+    sheets.data["registrations"] = [["2024-12-01", 1, "@a", 1], ["2025-01-05", 2, "@b", 1]]
+    db = Database()
+
+    moved, err = db.archive("registrations", "2025-01-01")
+
+    assert not err and moved == 1
+    assert sheets.data["registrations"] == [["2025-01-05", 2, "@b", 1]]
+    assert sheets.data["registrations_2024"] == [["2024-12-01", 1, "@a", 1]]
+    assert sheets.data["partitions"] == [["registrations", "2024-12-01", "registrations_2024"]]
+    rows, err = db.read_table("registrations", "2024-12-01")
+    assert not err
+    assert [r.user_name for r in rows] == ["@a"]
+
+
+def test_existing_tabs_are_checked_once(sheets):
+    db = Database()
+    db.read_table("registrations", "2025-01-05")
+    calls = sheets.calls
+
+    db.read_table("registrations", "2025-01-12")
+
+    assert sheets.calls - calls <= 1
+
+
+def test_archive_before_a_malformed_date_moves_nothing(sheets):
+    sheets.data["registrations"] = [["2024-12-01", 1, "@a", 1], ["31-12-2024", 2, "@b", 1]]
+    db = Database()
+
+    moved, err = db.archive("registrations", "foo")
+
+    assert err and not moved
+    assert len(sheets.data["registrations"]) == 2
+
+    moved, err = db.archive("registrations", "2025-1-1")
+
+    assert not err and moved == 1
+    assert sheets.data["registrations"] == [["31-12-2024", 2, "@b", 1]]
+
+
+def test_malformed_routes_are_skipped(sheets):
+    sheets.data["registrations_2024"] = [["2024-12-01", 1, "@a", 1]]
+    sheets.data["partitions"] = [["registrations"], ["registrations", "2024-12-01", "registrations_2024"]]
+    db = Database()
+
+    rows, err = db.read_table("registrations", "2024-12-01")
+
+    assert not err
+    assert [r.user_name for r in rows] == ["@a"]
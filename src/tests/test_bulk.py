@@ -0,0 +1,41 @@
+import io
+import sys
+import pytest
+import bulk
+from database import Database
+
+REGISTRATIONS = [["2025-01-05", 1, "@a", 1], ["2025-01-05", 2, "@b", 0], ["2025-01-12", 3, "@a", 1]]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_exported_table_imports_back_the_same(sheets, tmp_path, fmt):
+    sheets.data["registrations"] = [list(row) for row in REGISTRATIONS]
+    path = str(tmp_path / f"registrations.{fmt}")
+
+    assert bulk.export_table(Database(), "registrations", path, fmt, chunk_size=2) == ""
+    sheets.data["registrations"] = []
+    assert bulk.import_table(Database(), "registrations", path, fmt, chunk_size=2) == ""
+
+    assert sheets.data["registrations"] == REGISTRATIONS
+
+
+def test_invalid_lines_are_skipped(sheets, tmp_path):
+    path = tmp_path / "registrations.jsonl"
+    path.write_text('{"game_date": "2025-01-05", "requested_at": 1, "user_name": "@a", "prio": 1}\n'
+                    'not json\n'
+                    '["2025-01-05", "soon", "@b", 1]\n')
+
+    assert bulk.import_table(Database(), "registrations", str(path), "jsonl", chunk_size=10) == ""
+
+    assert sheets.data["registrations"] == [REGISTRATIONS[0]]
+
+
+def test_export_to_stdout_leaves_it_open(sheets, monkeypatch):
+    sheets.data["registrations"] = [list(row) for row in REGISTRATIONS]
+    stdout = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", stdout)
+
+    assert bulk.export_table(Database(), "registrations", "-", "csv", chunk_size=10) == ""
+
+    assert not stdout.closed
+    assert stdout.getvalue().splitlines()[:2] == ["game_date,requested_at,user_name,prio", "2025-01-05,1,@a,1"]
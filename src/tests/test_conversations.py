@@ -0,0 +1,120 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import pytest
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+from conversations import ConversationSweeper, EXPIRED_TEXT
+
+USER = 7
+PRIVATE, GROUP = (USER, USER), (-100, USER)
+
+
+class Handler():
+    """The parts of ConversationHandler the sweeper uses"""
+
+    def __init__(self):
+        self._conversations = {}
+
+    def _update_state(self, state, key):
+        if state == ConversationHandler.END:
+            self._conversations.pop(key, None)
+        else:
+            self._conversations[key] = state
+
+
+class Application():
+    def __init__(self):
+        self.dropped: list[int] = []
+
+    def drop_user_data(self, user_id: int):
+        self.dropped.append(user_id)
+
+
+def sweeper(*keys: tuple) -> ConversationSweeper:
+    sweeper = ConversationSweeper(timeout=60)
+    sweeper.watch(Handler())
+    sweeper.application = Application()
+    for key in keys:
+        sweeper.handler._update_state(1, key)
+        sweeper.seen(key, time.monotonic())
+    return sweeper
+
+
+def update(key: tuple, message_id: int|None = None):
+    """An update of the conversation, a button press on the given message if any"""
+
+    answers = []
+
+    async def answer(text=None):
+        answers.append(text)
+
+    query = None
+    if message_id:
+        query = SimpleNamespace(message=SimpleNamespace(chat_id=key[0], message_id=message_id), answer=answer)
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=key[0]),
+        effective_user=SimpleNamespace(id=key[1]),
+        callback_query=query,
+    ), answers
+
+
+def test_idle_conversations_end():
+    s = sweeper(PRIVATE)
+    s.last_seen[PRIVATE] -= 120
+
+    s.sweep()
+
+    assert not s.active(PRIVATE)
+    assert s.ended == 1
+    assert s.application.dropped == [USER]
+
+
+def test_user_data_is_kept_while_another_chat_of_the_user_is_active():
+    s = sweeper(PRIVATE, GROUP)
+    s.last_seen[PRIVATE] -= 120
+
+    s.sweep()
+
+    assert not s.active(PRIVATE) and s.active(GROUP)
+    assert s.application.dropped == []
+
+    s.last_seen[GROUP] -= 120
+    s.sweep()
+
+    assert s.application.dropped == [USER]
+
+
+def test_buttons_of_a_stale_menu_are_refused():
+    s = sweeper(PRIVATE)
+    s.track(update(PRIVATE)[0], SimpleNamespace(chat_id=PRIVATE[0], message_id=1))
+    s.track(update(PRIVATE)[0], SimpleNamespace(chat_id=PRIVATE[0], message_id=2))
+
+    live, answers = update(PRIVATE, message_id=2)
+    asyncio.run(s.guard(live, None))
+    assert answers == []
+
+    stale, answers = update(PRIVATE, message_id=1)
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(s.guard(stale, None))
+    assert answers == [EXPIRED_TEXT]
+    assert (PRIVATE[0], 1) in s.stale
+
+
+def test_buttons_of_an_ended_conversation_are_refused():
+    s = sweeper(PRIVATE)
+    s.track(update(PRIVATE)[0], SimpleNamespace(chat_id=PRIVATE[0], message_id=1))
+    s.end(PRIVATE)
+
+    stale, answers = update(PRIVATE, message_id=1)
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(s.guard(stale, None))
+    assert answers == [EXPIRED_TEXT]
+
+
+def test_least_recently_active_conversations_over_the_limit_end():
+    s = sweeper(PRIVATE, GROUP)
+    s.max_conversations = 1
+
+    s.sweep()
+
+    assert not s.active(PRIVATE) and s.active(GROUP)
@@ -0,0 +1,58 @@
+import pytest
+from database import Database
+from database.events import EventDatabase
+from models import AvailableSlot
+
+GAME = "2025-01-05"
+ADMIN = "@admin"
+
+
+def slot(seller: str, requested_at: int, buyer: str = "empty") -> AvailableSlot:
+    return AvailableSlot(GAME, seller, requested_at, "pay to admin", int(buyer != "empty"), buyer)
+
+
+def slots(db: Database) -> list[list]:
+    rows, err = db.read_table(AvailableSlot.sheet_name(), GAME)
+    assert not err
+    return [list(row) for row in rows]
+
+
+@pytest.mark.parametrize("storage", [Database, EventDatabase])
+def test_slots_of_the_same_seller_are_kept_apart(sheets, storage):
+    db = storage()
+    for requested_at in [1, 2, 3]:
+        assert db.create(slot(ADMIN, requested_at)) == (True, "")
+
+    assert [row[2] for row in slots(db)] == [1, 2, 3]
+
+    # Updates and deletes apply to the first slot, as they do to the first row of the sheet
+    assert db.update(slot(ADMIN, 1, "@b")) == (True, "")
+    assert [row[5] for row in slots(db)] == ["@b", "empty", "empty"]
+    assert db.read(slot(ADMIN, 0))[0].buyer_user_name == "@b"
+
+    assert db.delete(slot(ADMIN, 0)) == (True, "")
+    assert [row[2] for row in slots(db)] == [2, 3]
+
+
+def test_event_storage_reads_what_sheet_storage_reads(sheets):
+    def scenario(db: Database) -> list[list]:
+        db.create(slot(ADMIN, 1))
+        db.create(slot("@a", 2))
+        db.create(slot(ADMIN, 3))
+        db.update(slot("@a", 2, "@b"))
+        db.delete(slot(ADMIN, 0))
+        return slots(db)
+
+    rows = scenario(Database())
+    sheets.data["auctions"] = []
+
+    assert scenario(EventDatabase()) == rows
+
+
+def test_update_without_an_item_fails(sheets):
+    db = EventDatabase()
+
+    ok, err = db.update(slot(ADMIN, 1))
+
+    assert not ok and err
+    assert sheets.data["events"] == []
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from database.flights import SingleFlight
+
+
+def in_flight(flights: SingleFlight, callers: int, generation: int = 1, error: Exception|None = None) -> list:
+    """Runs callers identical concurrent calls, the first one held until all others joined it.
+    Returns what each caller got, its result or its exception"""
+
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        if error:
+            raise error
+        return ["row"]
+
+    def call():
+        try:
+            return flights.do("registrations", generation, fetch)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(callers) as pool:
+        futures = [pool.submit(call)]
+        while not calls:
+            time.sleep(0.001)
+        futures += [pool.submit(call) for _ in range(callers - 1)]
+        while flights.shared < callers - 1:
+            time.sleep(0.001)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    return results
+
+
+def test_concurrent_identical_calls_run_once():
+    flights = SingleFlight()
+
+    results = in_flight(flights, 5)
+
+    assert results == [["row"]] * 5
+    assert results[0] is results[4]
+    assert flights.calls == 1 and flights.shared == 4
+    assert not flights.flights
+
+
+def test_exception_reaches_every_waiter():
+    flights = SingleFlight()
+    error = TimeoutError("sheets timed out")
+
+    results = in_flight(flights, 3, error=error)
+
+    assert results == [error] * 3
+    assert not flights.flights
+    # The failure is not cached, the next call runs again
+    assert flights.do("registrations", 1, lambda: ["fresh"]) == ["fresh"]
+
+
+def test_calls_of_a_newer_generation_do_not_join():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def stale():
+        release.wait(5)
+        return ["old"]
+
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(flights.do, "registrations", 1, stale)
+        while not flights.calls:
+            time.sleep(0.001)
+        # A write moved the sheet to the next version meanwhile
+        assert flights.do("registrations", 2, lambda: ["new"]) == ["new"]
+        release.set()
+        assert future.result() == ["old"]
+
+    assert flights.calls == 2 and flights.shared == 0
+
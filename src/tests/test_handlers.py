@@ -0,0 +1,64 @@
+import asyncio
+import fakes
+import main
+
+
+def run_commands(user_name: str, *commands: str, stop: bool = False) -> tuple[list[str], list[Exception]]:
+    """Sends the commands as the user, returns the texts the bot sent back and the handler errors.
+    With stop, the bot is stopped afterwards as run_polling would do"""
+
+    async def scenario():
+        bot_api = fakes.FakeBotApi(0)
+        application = main.build_application(fakes.TOKEN, request=bot_api, get_updates_request=fakes.FakeBotApi(0))
+        errors = []
+
+        async def collect_error(update, context):
+            errors.append(context.error)
+        application.add_error_handler(collect_error)
+
+        await application.initialize()
+        traffic = fakes.Traffic(application, 0)
+        traffic.user["username"] = user_name.lstrip("@")
+        for command in commands:
+            await application.process_update(traffic.command(command))
+        if stop:
+            await main.post_stop(application)
+        await application.shutdown()
+        return bot_api.texts[traffic.chat["id"]], errors
+
+    return asyncio.run(scenario())
+
+
+def test_profile_rejects_seconds_that_are_not_a_number(sheets):
+    texts, errors = run_commands(main.ADMIN_USER_NAME, "/profile abc", "/profile 1 2")
+
+    assert not errors
+    assert texts == ["Usage: /profile [seconds]"] * 2
+    assert main.profiler is None
+
+
+def test_profile_window_is_cancelled_when_the_bot_stops(sheets):
+    texts, errors = run_commands(main.ADMIN_USER_NAME, "/profile 300", stop=True)
+
+    assert not errors
+    assert texts == ["Profiling for 300 seconds"]
+    assert main.profiler is None
+    assert not main.background_tasks
+
+
+def test_archive_rejects_malformed_and_recent_dates(sheets):
+    sheets.data["registrations"] = [["2099-01-04", 1, "@a", 1]]
+
+    texts, errors = run_commands(main.ADMIN_USER_NAME, "/archive foo", "/archive 31-12-2024", "/archive 2099-01-01")
+
+    assert not errors
+    assert texts[:2] == ["Usage: /archive [YYYY-MM-DD]"] * 2
+    assert texts[2].startswith("Games of the last")
+    assert sheets.data["registrations"] == [["2099-01-04", 1, "@a", 1]]
+
+
+def test_stats_rejects_seasons_that_are_not_a_year(sheets):
+    texts, errors = run_commands(main.ADMIN_USER_NAME, "/stats 25", "/stats season", "/stats 2025 2026")
+
+    assert not errors
+    assert texts == ["Usage: /stats [YYYY]"] * 3
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+import fakes
+from models import Player, Registration
+from plutarch import Plutarch
+
+GAME = "2025-01-05"
+
+
+def setup(sheets) -> tuple[Plutarch, Player]:
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    sheets.data["games"] = [[GAME, 14, 5, 0]]
+    return Plutarch(), Player("@a", "A", 5, 1, 1)
+
+
+def test_repeated_request_is_written_once(sheets):
+    plutarch, player = setup(sheets)
+
+    assert plutarch.register(player, GAME, "1") == (True, "")
+    sheets.data["registrations"].clear()
+    assert plutarch.register(player, GAME, "1") == (True, "")
+
+    assert sheets.data["registrations"] == []
+    assert plutarch.writes.duplicates == 1
+
+
+def test_request_ids_of_register_and_leave_do_not_collide(sheets):
+    plutarch, player = setup(sheets)
+    plutarch.register(player, GAME, "1")
+    registration, _ = plutarch.db.read(Registration(game_date=GAME, user_name="@a"))
+
+    unregistered, _, err = plutarch.leave_game(player, registration, "pay to @a", "1")
+
+    assert unregistered and not err
+    assert sheets.data["registrations"] == []
+    assert plutarch.writes.duplicates == 0
+
+
+def test_sessions_of_the_same_user_get_new_update_ids():
+    application = SimpleNamespace(bot=None)
+    join, leave = fakes.Traffic(application, 1), fakes.Traffic(application, 1)
+
+    ids = {join.command("/start").update_id for _ in range(3)}
+    ids |= {leave.command("/start").update_id for _ in range(3)}
+
+    assert len(ids) == 6
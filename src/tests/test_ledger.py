@@ -0,0 +1,138 @@
+import database.gs as gs
+import database.ledger as ledger
+from models import Registration
+from plutarch import Plutarch
+
+KEY = "default:players"
+GAME = "2025-01-05"
+
+
+def edit_balance(sheets, balance: int):
+    """Edits the balance of @a in the sheet by hand"""
+
+    sheets.data["players"][0][2] = balance
+    gs.DEFAULT_TENANT.sheets.clear()
+
+
+def test_balance_edited_in_the_sheet_is_picked_up_after_max_age(sheets):
+    sheets.data["players"] = [["@a", "A", 0, 1, 1]]
+    plutarch = Plutarch()
+    assert plutarch.get_player("@a")[0].balance == 0
+
+    edit_balance(sheets, 5)
+    assert plutarch.get_player("@a")[0].balance == 0
+    ledger.current_ledger().loaded_at -= gs.GS_SETTINGS.get("ledger.max_age", 60) + 1
+
+    assert plutarch.get_player("@a")[0].balance == 5
+
+
+def test_balance_written_by_another_worker_is_picked_up_right_away(sheets):
+    sheets.data["players"] = [["@a", "A", 0, 1, 1]]
+    plutarch = Plutarch()
+    plutarch.get_player("@a")
+
+    edit_balance(sheets, 5)
+    gs.SHARED.bump(KEY, edit=True)
+
+    assert plutarch.get_player("@a")[0].balance == 5
+
+
+def test_changes_not_flushed_yet_survive_a_reload(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    plutarch = Plutarch()
+    assert plutarch.top_up("@a", -1) == (4, "")
+
+    edit_balance(sheets, 10)
+    gs.SHARED.bump(KEY, edit=True)
+
+    assert plutarch.get_player("@a")[0].balance == 9
+
+
+def test_flushed_changes_are_not_counted_twice(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    plutarch = Plutarch()
+    plutarch.top_up("@a", -1)
+
+    assert plutarch.flush_balances() == (1, "")
+
+    assert sheets.data["players"][0][2] == 4
+    assert plutarch.get_player("@a")[0].balance == 4
+    assert sheets.data["ledger"][0][1:] == ["@a", -1, "top up"]
+
+
+def test_top_up_of_an_unknown_player_is_refused(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    plutarch = Plutarch()
+
+    assert plutarch.top_up("@nobody", 3) == (None, "unknown player")
+
+    assert plutarch.flush_balances() == (0, "")
+    assert sheets.data["ledger"] == []
+
+
+def test_flush_skips_balances_that_are_not_numbers(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1], ["@b", "B", 5, 1, 1]]
+    plutarch = Plutarch()
+    plutarch.top_up("@a", 1)
+    plutarch.top_up("@b", 1)
+    # Edited by hand before the flush
+    edit_balance(sheets, "five")
+
+    assert plutarch.flush_balances() == (2, "")
+
+    assert sheets.data["players"][0][2] == "five"
+    assert sheets.data["players"][1][2] == 6
+
+
+def test_balances_are_rebuilt_from_the_ledger(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    plutarch = Plutarch()
+    plutarch.top_up("@a", 2)
+    plutarch.top_up("@a", -1)
+    plutarch.flush_balances()
+    # The players sheet is restored from a backup taken before the changes
+    edit_balance(sheets, 5)
+    gs.SHARED.bump(KEY, edit=True)
+
+    entries, err = ledger.read_entries(since=0)
+    assert not err and [e.delta for e in entries] == [2, -1]
+    assert ledger.current_ledger().replay(entries) == ""
+    assert plutarch.get_player("@a")[0].balance == 6
+    assert plutarch.flush_balances() == (2, "")
+
+    assert sheets.data["players"][0][2] == 6
+    assert len(sheets.data["ledger"]) == 2
+
+
+def test_settlement_rerun_after_a_crash_charges_once(sheets):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    sheets.data["games"] = [[GAME, 14, 5, 0]]
+    plutarch = Plutarch()
+    player, _ = plutarch.get_player("@a")
+    slot, err = plutarch.collect_money(player, Registration(GAME, 1, "@a", 1))
+    assert slot and not err
+    # The worker dies before flush_balances, the rerun starts with an empty ledger
+    ledger.LEDGERS.clear()
+    gs.DEFAULT_TENANT.sheets.clear()
+
+    plutarch = Plutarch()
+    player, _ = plutarch.get_player("@a")
+    assert plutarch.collect_money(player, Registration(GAME, 1, "@a", 1)) == (slot, "")
+
+    assert sheets.data["players"][0][2] == 4
+    assert len(sheets.data["ledger"]) == 1
+    assert len(sheets.data["auctions"]) == 1
+
+
+def test_charge_that_cannot_be_written_is_not_checkpointed(sheets, monkeypatch):
+    sheets.data["players"] = [["@a", "A", 5, 1, 1]]
+    sheets.data["games"] = [[GAME, 14, 5, 0]]
+    plutarch = Plutarch()
+    player, _ = plutarch.get_player("@a")
+    monkeypatch.setattr(ledger.current_ledger(), "flush", lambda: (0, "cannot write ledger: quota"))
+
+    assert plutarch.collect_money(player, Registration(GAME, 1, "@a", 1)) == (None, "try again later")
+
+    assert sheets.data["auctions"] == []
+    assert player.balance == 5
+    assert plutarch.get_player("@a")[0].balance == 5
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+from telegram.error import Forbidden, RetryAfter
+from notifications import Notifier, URGENT, NORMAL
+
+
+class Bot():
+    """Records the messages sent, failing with the given errors first"""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: str):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+def run(bot: Bot, scenario, done: int, **kwargs) -> Notifier:
+    """Runs the scenario with a started notifier, returns it once done notices were sent or dropped"""
+
+    async def main():
+        notifier = Notifier(workers=1, global_rate=1000, chat_rate=1000, **kwargs)
+        notifier.remember("@a", 1)
+        notifier.remember("@b", 2)
+        notifier.start(SimpleNamespace(bot=bot))
+        scenario(notifier)
+        # Retries are queued again later, an empty queue does not mean they are done
+        for _ in range(500):
+            await asyncio.sleep(0.01)
+            if notifier.sent + notifier.dropped >= done and not notifier.queue.qsize():
+                break
+        notifier.stop()
+        return notifier
+
+    return asyncio.run(main())
+
+
+def test_newer_notice_supersedes_the_queued_one():
+    bot = Bot()
+
+    def scenario(notifier):
+        notifier.notify("@a", "roster", "you are 3rd")
+        notifier.notify("@a", "roster", "you are 2nd")
+        notifier.notify("@a", "payment", "pay to @b")
+
+    notifier = run(bot, scenario, done=2)
+
+    assert bot.sent == [(1, "you are 2nd"), (1, "pay to @b")]
+    assert notifier.sent == 2 and notifier.dropped == 0
+
+
+def test_urgent_notices_go_first():
+    bot = Bot()
+
+    def scenario(notifier):
+        notifier.notify("@a", "roster", "you are 3rd", NORMAL)
+        notifier.notify("@b", "payment", "pay to @a", URGENT)
+
+    run(bot, scenario, done=2)
+
+    assert bot.sent == [(2, "pay to @a"), (1, "you are 3rd")]
+
+
+def test_rate_limited_notice_is_retried():
+    bot = Bot(RetryAfter(0))
+
+    def scenario(notifier):
+        notifier.notify("@a", "roster", "you are 3rd")
+        notifier.notify("@b", "roster", "you are 4th")
+
+    notifier = run(bot, scenario, done=2)
+
+    assert sorted(bot.sent) == [(1, "you are 3rd"), (2, "you are 4th")]
+    assert notifier.sent == 2
+
+
+def test_notice_waiting_for_a_retry_is_superseded():
+    notifiers = []
+
+    class Superseding(Bot):
+        async def send_message(self, chat_id: int, text: str, parse_mode: str):
+            if text == "you are 3rd":
+                # A newer notice comes while this one waits for its retry
+                notifiers[0].notify("@a", "roster", "you are 2nd")
+                raise RetryAfter(0)
+            await super().send_message(chat_id, text, parse_mode)
+
+    bot = Superseding()
+
+    def scenario(notifier):
+        notifiers.append(notifier)
+        notifier.notify("@a", "roster", "you are 3rd")
+
+    notifier = run(bot, scenario, done=1)
+
+    assert bot.sent == [(1, "you are 2nd")]
+    assert notifier.sent == 1 and notifier.dropped == 0
+
+
+def test_notice_is_dropped_after_max_attempts():
+    bot = Bot(RetryAfter(0), RetryAfter(0))
+
+    notifier = run(bot, lambda notifier: notifier.notify("@a", "roster", "you are 3rd"), done=1, max_attempts=2)
+
+    assert bot.sent == []
+    assert notifier.dropped == 1
+    assert not notifier.latest
+
+
+def test_notice_to_a_chat_that_blocked_the_bot_is_not_retried():
+    bot = Bot(Forbidden("blocked"))
+
+    notifier = run(bot, lambda notifier: notifier.notify("@a", "roster", "you are 3rd"), done=1)
+
+    assert bot.sent == []
+    assert notifier.dropped == 1
+
+
+def test_unknown_user_is_not_notified():
+    bot = Bot()
+
+    notifier = run(bot, lambda notifier: notifier.notify("@nobody", "roster", "hi"), done=0)
+
+    assert bot.sent == [] and notifier.sent == 0
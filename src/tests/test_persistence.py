@@ -0,0 +1,87 @@
+import asyncio
+from persistence import SqlitePersistence
+
+
+def test_data_and_conversations_survive_a_restart(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def first_run():
+        persistence = SqlitePersistence(path)
+        await asyncio.gather(
+            persistence.update_user_data(7, {"player": "@a"}),
+            persistence.update_chat_data(7, {"menu": 2}),
+            persistence.update_bot_data({"version": 1}),
+            persistence.update_conversation("main", (7, 7), 1),
+        )
+        await persistence.flush()
+
+    async def second_run():
+        persistence = SqlitePersistence(path)
+        user_data, chat_data = {}, {}
+        await persistence.refresh_user_data(7, user_data)
+        await persistence.refresh_chat_data(7, chat_data)
+        conversations = await persistence.get_conversations("main")
+        bot_data = await persistence.get_bot_data()
+        await persistence.flush()
+        return user_data, chat_data, conversations, bot_data
+
+    asyncio.run(first_run())
+    user_data, chat_data, conversations, bot_data = asyncio.run(second_run())
+
+    assert user_data == {"player": "@a"}
+    assert chat_data == {"menu": 2}
+    assert conversations == {(7, 7): 1}
+    assert bot_data == {"version": 1}
+
+
+def test_ended_conversations_and_dropped_data_are_deleted(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def first_run():
+        persistence = SqlitePersistence(path)
+        await persistence.update_user_data(7, {"player": "@a"})
+        await persistence.update_conversation("main", (7, 7), 1)
+        await persistence.drop_user_data(7)
+        await persistence.update_conversation("main", (7, 7), None)
+        await persistence.flush()
+
+    async def second_run():
+        persistence = SqlitePersistence(path)
+        user_data = {}
+        await persistence.refresh_user_data(7, user_data)
+        conversations = await persistence.get_conversations("main")
+        await persistence.flush()
+        return user_data, conversations
+
+    asyncio.run(first_run())
+
+    assert asyncio.run(second_run()) == ({}, {})
+
+
+def test_only_changed_entries_are_written(tmp_path, monkeypatch):
+    persistence = SqlitePersistence(str(tmp_path / "bot.db"))
+    batches = []
+    write_batch = persistence._write_batch
+
+    def record(batch):
+        batches.append(sorted(batch))
+        write_batch(batch)
+    monkeypatch.setattr(persistence, "_write_batch", record)
+
+    async def scenario():
+        # One persistence run, written in a single batch
+        await asyncio.gather(
+            persistence.update_user_data(7, {"player": "@a"}),
+            persistence.update_user_data(8, {"player": "@b"}),
+            persistence.update_user_data(9, {}),
+        )
+        # The next run changes only one of them
+        await asyncio.gather(
+            persistence.update_user_data(7, {"player": "@a"}),
+            persistence.update_user_data(8, {"player": "@c"}),
+        )
+        await persistence.flush()
+
+    asyncio.run(scenario())
+
+    assert batches == [[("user", "7"), ("user", "8")], [("user", "8")]]
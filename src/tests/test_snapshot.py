@@ -0,0 +1,60 @@
+import threading
+import database.gs as gs
+
+
+def load_snapshot(sheet_name, rows):
+    """Puts the rows in place as load_snapshots() does, not validated yet"""
+
+    gs.DEFAULT_TENANT.sheets[sheet_name] = gs.SheetState(
+        rows=rows, fingerprint=gs.fingerprint_rows(rows), validated=False,
+    )
+
+
+def test_reads_are_served_from_the_snapshot(sheets):
+    sheets.data["players"] = [["@a", "A", 1, 1, 1], ["@b", "B", 2, 1, 1]]
+    load_snapshot("players", [["@a", "A", 1, 1, 1]])
+
+    values, err = gs.read_sheet("players")
+
+    assert not err
+    assert values == [["@a", "A", 1, 1, 1]]
+    assert sheets.calls == 0
+
+
+def test_update_does_not_use_row_numbers_of_a_stale_snapshot(sheets):
+    # A row was deleted since the snapshot was taken, @b moved up
+    sheets.data["players"] = [["@b", "B", 2, 1, 1], ["@c", "C", 3, 1, 1]]
+    load_snapshot("players", [["@a", "A", 1, 1, 1], ["@b", "B", 2, 1, 1], ["@c", "C", 3, 1, 1]])
+
+    ok, err = gs.update_row_by_value("players", "@b", None, ["@b", "B", 5, 1, 1])
+
+    assert ok and not err
+    assert sheets.data["players"] == [["@b", "B", 5, 1, 1], ["@c", "C", 3, 1, 1]]
+    assert gs.DEFAULT_TENANT.sheets["players"].validated
+
+
+def test_delete_does_not_use_row_numbers_of_a_stale_snapshot(sheets):
+    sheets.data["registrations"] = [["2025-01-05", 2, "@b", 1], ["2025-01-05", 3, "@c", 1]]
+    load_snapshot("registrations", [["2025-01-05", 1, "@a", 1], ["2025-01-05", 2, "@b", 1], ["2025-01-05", 3, "@c", 1]])
+
+    ok, err = gs.delete_row_by_value("registrations", "2025-01-05", "@b")
+
+    assert ok and not err
+    assert sheets.data["registrations"] == [["2025-01-05", 3, "@c", 1]]
+
+
+def test_validation_waits_for_the_sheet_lock(sheets):
+    sheets.data["players"] = [["@a", "A", 2, 1, 1]]
+    load_snapshot("players", [["@a", "A", 1, 1, 1]])
+
+    validation = threading.Thread(target=gs.validate_snapshots)
+    with gs.DEFAULT_TENANT.lock("players"):
+        validation.start()
+        validation.join(timeout=0.2)
+        assert validation.is_alive()
+        assert not gs.DEFAULT_TENANT.sheets["players"].validated
+    validation.join(timeout=5)
+
+    state = gs.DEFAULT_TENANT.sheets["players"]
+    assert state.validated
+    assert state.rows == [["@a", "A", 2, 1, 1]]
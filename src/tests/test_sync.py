@@ -0,0 +1,119 @@
+import threading
+import time
+import pytest
+import database.gs as gs
+from database.shared import SqliteStore
+
+KEY = "default:players"
+
+
+def players(*balances):
+    return [[f"@p{i}", f"P{i}", balance, 1, 1] for i, balance in enumerate(balances)]
+
+
+def test_appends_of_other_workers_are_tail_synced(sheets, monkeypatch):
+    sheets.data["players"] = players(0, 0)
+    gs.read_sheet("players")
+
+    # Another worker appends a row
+    sheets.data["players"].append(["@p2", "P2", 0, 1, 1])
+    gs.SHARED.bump(KEY)
+    full_syncs = []
+    monkeypatch.setattr(gs, "full_sync", lambda sheet_name: full_syncs.append(sheet_name))
+
+    values, err = gs.read_sheet("players")
+
+    assert not err
+    assert values == players(0, 0, 0)
+    assert not full_syncs
+
+
+def test_edits_of_other_workers_in_the_middle_are_resynced(sheets):
+    sheets.data["players"] = players(0, 0, 0)
+    gs.read_sheet("players")
+
+    # Another worker updates a row that is not the last one
+    sheets.data["players"][0] = ["@p0", "P0", 5, 1, 1]
+    version = gs.SHARED.bump(KEY, edit=True)
+
+    values, err = gs.read_sheet("players")
+
+    assert not err
+    assert values == players(5, 0, 0)
+    published = gs.SHARED.get_rows(KEY)
+    assert published.version == version
+    assert published.rows == players(5, 0, 0)
+
+
+def test_own_edits_are_seen_by_other_workers(sheets):
+    sheets.data["players"] = players(0, 0, 0)
+    gs.read_sheet("players")
+
+    ok, err = gs.update_row_by_value("players", "@p0", None, ["@p0", "P0", 5, 1, 1])
+
+    assert ok and not err
+    assert gs.SHARED.edited(KEY) == gs.SHARED.version(KEY)
+
+
+def test_own_edits_do_not_resync(sheets, monkeypatch):
+    sheets.data["players"] = players(0, 0, 0)
+    gs.read_sheet("players")
+
+    gs.update_row_by_value("players", "@p2", None, ["@p2", "P2", 5, 1, None])
+    gs.update_cells("players", 3, {1: 7})
+    # Another worker appends a row, the last known one is the anchor
+    sheets.data["players"].append(["@p3", "P3", 0, 1, 1])
+    gs.SHARED.bump(KEY)
+    full_syncs = []
+    monkeypatch.setattr(gs, "full_sync", lambda sheet_name: full_syncs.append(sheet_name))
+
+    values, err = gs.read_sheet("players")
+
+    assert not err
+    assert values == [["@p0", "P0", 7, 1, 1], ["@p1", "P1", 0, 1, 1], ["@p2", "P2", 5, 1], ["@p3", "P3", 0, 1, 1]]
+    assert not full_syncs
+
+
+def test_sqlite_store_shares_edits(tmp_path):
+    worker, other = SqliteStore(str(tmp_path / "shared.db")), SqliteStore(str(tmp_path / "shared.db"))
+
+    worker.bump(KEY)
+    edited = worker.bump(KEY, edit=True)
+    worker.bump(KEY)
+
+    assert other.version(KEY) == 3
+    assert other.edited(KEY) == edited == 2
+
+
+def test_sqlite_lock_outlives_its_timeout_while_held(tmp_path):
+    worker = SqliteStore(str(tmp_path / "shared.db"), lock_timeout=0.3)
+    other = SqliteStore(str(tmp_path / "shared.db"), lock_timeout=0.3)
+
+    with worker.lock("game"):
+        time.sleep(0.6)
+        with pytest.raises(TimeoutError):
+            with other.lock("game"):
+                pass
+
+
+def test_sqlite_lock_taken_over_is_not_released_by_the_old_holder(tmp_path):
+    store = SqliteStore(str(tmp_path / "shared.db"))
+    acquired, release = threading.Event(), threading.Event()
+
+    def take_over():
+        with store.lock("game"):
+            acquired.set()
+            release.wait(5)
+
+    with store.lock("game"):
+        # The lease runs out while the holder is stalled
+        with store._conn() as conn:
+            conn.execute("UPDATE locks SET expires_at = 0")
+        thread = threading.Thread(target=take_over)
+        thread.start()
+        assert acquired.wait(5)
+
+    held = store._conn().execute("SELECT count(*) FROM locks").fetchone()[0]
+    release.set()
+    thread.join()
+    assert held == 1
@@ -0,0 +1,70 @@
+import asyncio
+import time
+import fakes
+import database.gs as gs
+from database import Database
+from database.tenants import Tenant, FairScheduler
+from plutarch import Plutarch
+
+
+def tenant(name: str, quota_per_minute: int) -> Tenant:
+    return Tenant(name, name, gs.DEFAULT_TENANT.sheet_ids, quota_per_minute=quota_per_minute, threads=2)
+
+
+def test_tenant_over_quota_does_not_hold_up_the_others(sheets, monkeypatch):
+    scheduler = FairScheduler(max_concurrent=4)
+    monkeypatch.setattr(gs, "SCHEDULER", scheduler)
+    sheets.data["players"] = [["@a", "A", 0, 1, 1]]
+    busy, quiet = tenant("busy", 1), tenant("quiet", 300)
+    # The busy tenant has used up its quota for the next minute
+    busy.calls.append(time.time())
+    db = Database()
+
+    async def read(tenant):
+        gs.CURRENT_TENANT.set(tenant)
+        return await db.run(gs.fetch_range, "players")
+
+    async def scenario():
+        stuck = [asyncio.create_task(read(busy)) for _ in range(10)]
+        await asyncio.sleep(0.1)
+        started = time.perf_counter()
+        values, err = await asyncio.wait_for(read(quiet), timeout=5)
+        elapsed = time.perf_counter() - started
+        assert not any(task.done() for task in stuck)
+        # Let the busy tenant finish
+        with scheduler.cond:
+            busy.quota_per_minute = 300
+            scheduler.cond.notify_all()
+        await asyncio.gather(*stuck)
+        return values, err, elapsed
+
+    values, err, elapsed = asyncio.run(scenario())
+
+    assert not err and values == [["@a", "A", 0, 1, 1]]
+    assert elapsed < 1
+    assert busy.pool._max_workers == 2
+
+
+def test_prewarm_warms_the_games_of_every_tenant(sheets, monkeypatch):
+    other = tenant("other", 300)
+    other_sheets = fakes.FakeSheets(latency=0)
+    for sheet in other.sheet_ids:
+        other_sheets.data[sheet] = []
+    spreadsheets = {gs.DEFAULT_TENANT.name: sheets, other.name: other_sheets}
+    monkeypatch.setattr(gs, "authenticate_to_gs", lambda: spreadsheets[gs.current_tenant().name])
+    monkeypatch.setattr(gs, "TENANTS", {gs.DEFAULT_TENANT.name: gs.DEFAULT_TENANT, other.name: other})
+    sheets.data["games"] = [["2099-01-04", 14, 5, 0]]
+    other_sheets.data["games"] = [["2099-02-01", 14, 5, 0]]
+    plutarch = Plutarch()
+    warmed = {}
+    warm_sheets = plutarch.db.warm_sheets
+
+    def record(game_dates):
+        warmed[gs.current_tenant().name] = game_dates
+        return warm_sheets(game_dates)
+    monkeypatch.setattr(plutarch.db, "warm_sheets", record)
+
+    _, err = plutarch.prewarm(count=1)
+
+    assert not err
+    assert warmed == {"default": ["2099-01-04"], "other": ["2099-02-01"]}